@@ -20,6 +20,17 @@ API_SECRET = ""
 
 # Instrument to market make on BitMEX.
 SYMBOL = "XBTUSD"
+# To market make several instruments from one process, list them here (or on the command line:
+# ./marketmaker XBTUSD ETHUSD). They share one websocket and HTTP connection pool, and each uses its
+# settings-<SYMBOL>.py overrides if present.
+SYMBOLS = []
+# With several SYMBOLS, set this above 1 to spread quoting over that many processes, so they can use more
+# than one CPU core. A separate process then handles the websocket and shares market data with them through
+# shared memory (Python 3.8+). BUS_DEPTH_LEVELS levels of each order book side are shared.
+QUOTING_PROCESSES = 1
+BUS_DEPTH_LEVELS = 25
+# Most open orders shared per symbol. Must be at least 2 * ORDER_PAIRS; checked at startup and on reload.
+BUS_MAX_ORDERS = 64
 # Minumum contracts per side to continue trading
 MIN_CONTRACTS = 5000
 
@@ -83,16 +94,73 @@ DRY_RUN = False
 # order amend/replaces are done, you may hit a ratelimit. If so, email BitMEX if you feel you need a higher limit.
 LOOP_INTERVAL = 5
 
+# If True, requote as soon as the quote, order book, our orders or our position change instead of sleeping
+# LOOP_INTERVAL between passes. Much lower latency, at the cost of more (cheap) passes on busy markets.
+REQUOTE_ON_UPDATE = False
+# When requoting on updates, wait this long (in seconds) after the first change so a burst of messages
+# results in a single requote.
+REQUOTE_DEBOUNCE = 0.05
+# When requoting on updates, requote anyway if nothing has changed for this many seconds. None for LOOP_INTERVAL.
+REQUOTE_MAX_IDLE = None
+
+# How many HTTP connections to keep open to the API. Amends, creates and cancels are sent in parallel
+# over these.
+HTTP_POOL_SIZE = 4
+
+# If less than this fraction of our API rate limit is left, quote proportionally fewer order pairs.
+RATE_LIMIT_LOW_BUDGET = 0.2
+
+# Failed API requests (timeouts, connection errors, 429s and 503s) are retried with exponential backoff
+# and random jitter: between 0 and BASE_DELAY * 2^n seconds before retry n, at most MAX_DELAY.
+HTTP_RETRY_MAX_ATTEMPTS = 10
+HTTP_RETRY_BASE_DELAY = 0.25
+HTTP_RETRY_MAX_DELAY = 5
+# Give up on a request after this many seconds, retries included.
+HTTP_RETRY_DEADLINE = 30
+# Amends go stale quickly; give up on them sooner and requote from fresh data instead.
+HTTP_AMEND_DEADLINE = 5
+
+# If the websocket drops, it reconnects with the same backoff while quoting pauses; our orders stay in the
+# book. If it can't get all our data back within WS_RECONNECT_DEADLINE seconds, the bot restarts.
+WS_RECONNECT_BASE_DELAY = 0.1
+WS_RECONNECT_MAX_DELAY = 5
+WS_RECONNECT_DEADLINE = 60
+
 # Wait times between orders / errors
 API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
 
+# How many of the latest rows to keep for streaming tables. These are held in fixed-size buffers.
+TABLE_CAPACITY = {'trade': 200, 'quote': 200}
+
 # If we're doing a dry run, use these numbers for BTC balances
 DRY_BTC = 50
 
+# JSON library used to decode websocket messages: "orjson", "ujson" or "json".
+# None picks the fastest one installed.
+JSON_DECODER = None
+
+# Record every raw websocket message to this file, to replay through ./backtest later. Recordings are
+# gzipped and only ever appended to. strftime patterns in the name (in UTC) start a new file whenever they
+# change, e.g. "recordings/%Y-%m-%d.gz" for one file a day. None to not record.
+RECORD_FILE = None
+
+# Serve latency histograms and counters (see market_maker/utils/metrics.py) for Prometheus to scrape, at
+# http://127.0.0.1:<port>/metrics. With QUOTING_PROCESSES, the feed handler uses this port and quoting
+# process n the port n + 1 above it. None to not serve them.
+METRICS_PORT = None
+
 # Available levels: logging.(DEBUG|INFO|WARN|ERROR)
 LOG_LEVEL = logging.INFO
 
+# Log records wait in a queue of this size for a background thread to write them, so a slow console never
+# holds up trading. Records that don't fit are dropped and counted. 0 writes them synchronously instead.
+LOG_QUEUE_SIZE = 10000
+
+# If set, executions and order changes are also written here, one JSON object per line. strftime patterns
+# in the path, in UTC, start a new file when they change: e.g. "events/%Y-%m-%d.jsonl".
+EVENT_LOG_FILE = None
+
 # To uniquely identify orders placed by this bot, the bot sends a ClOrdID (Client order ID) that is attached
 # to each order so its source can be identified. This keeps the market maker from cancelling orders that are
 # manually placed, or orders placed by another bot.
@@ -102,7 +170,8 @@ LOG_LEVEL = logging.INFO
 # Max length is 13 characters.
 ORDERID_PREFIX = "mm_bitmex_"
 
-# If any of these files (and this file) changes, reload the bot.
+# If any of these files changes, restart the bot. Changes to this file and settings-<SYMBOL>.py are applied
+# without restarting, except to settings only used at startup (see RESTART_SETTINGS in market_maker.py).
 WATCHED_FILES = [join("market_maker", f) for f in ["market_maker.py", "bitmex.py", __file__]]
 
 
@@ -112,3 +181,7 @@ WATCHED_FILES = [join("market_maker", f) for f in ["market_maker.py", "bitmex.py
 
 # Specify the contracts that you hold. These will be used in portfolio calculations.
 CONTRACTS = ['XBTUSD']
+
+# Warn (and write a delta_threshold event, if there's an EVENT_LOG_FILE) when the total spot delta of the
+# CONTRACTS goes over this many XBT either way, and again when it comes back under. None to turn off.
+DELTA_ALERT_THRESHOLD = None
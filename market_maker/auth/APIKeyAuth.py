@@ -16,6 +16,7 @@ class APIKeyAuth(AuthBase):
         """Init with Key & Secret."""
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        self.signer = Signer(apiSecret)
 
     def __call__(self, r):
         """Called when forming a request - generates api key headers."""
@@ -23,11 +24,32 @@ class APIKeyAuth(AuthBase):
         nonce = generate_nonce()
         r.headers['api-nonce'] = str(nonce)
         r.headers['api-key'] = self.apiKey
-        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, nonce, r.body or '')
+        r.headers['api-signature'] = self.signer.sign(r.method, r.path_url, nonce, r.body)
 
         return r
 
 
+class Signer(object):
+
+    """Signs requests with one API secret.
+
+    The HMAC is keyed once, up front. Each signature starts from a copy of that state instead of
+    re-encoding the secret and keying a new HMAC for every request.
+    """
+
+    def __init__(self, secret):
+        self.hmac = hmac.new(bytes(secret, 'utf8'), digestmod=hashlib.sha256)
+
+    def sign(self, verb, path, nonce, data=None):
+        """Sign a request. `path` is relative and includes the query string, `data` is the exact body
+           sent, as bytes or str."""
+        signature = self.hmac.copy()
+        signature.update((verb + path + str(nonce)).encode('utf8'))
+        if data:
+            signature.update(data if isinstance(data, (bytes, type(b''))) else data.encode('utf8'))
+        return signature.hexdigest()
+
+
 def generate_nonce():
     return int(round(time.time() * 1000))
 
@@ -45,15 +67,15 @@ def generate_nonce():
 # data={"symbol":"XBTZ14","quantity":1,"price":395.01}
 # signature = HEX(HMAC_SHA256(secret, 'POST/api/v1/order1416993995705{"symbol":"XBTZ14","quantity":1,"price":395.01}'))
 def generate_signature(secret, verb, url, nonce, data):
-    """Generate a request signature compatible with BitMEX."""
-    # Parse the url so we can remove the base and extract just the path.
+    """Generate a request signature compatible with BitMEX. For many requests with one secret, keep a
+       Signer around instead."""
+    return Signer(secret).sign(verb, url_path(url), nonce, data)
+
+
+def url_path(url):
+    """Strip the base from a URL, leaving just the path and query string."""
     parsedURL = urlparse(url)
     path = parsedURL.path
     if parsedURL.query:
         path = path + '?' + parsedURL.query
-
-    # print "Computing HMAC: %s" % verb + path + str(nonce) + data
-    message = verb + path + str(nonce) + data
-
-    signature = hmac.new(bytes(secret, 'utf8'), bytes(message, 'utf8'), digestmod=hashlib.sha256).hexdigest()
-    return signature
+    return path
@@ -0,0 +1,465 @@
+"""Replay recorded market data through the OrderManager, with simulated fills, faster than real time.
+
+    ./backtest recordings/2026-10-*.gz [--symbols XBTUSD ETHUSD]
+
+Recordings (see RECORD_FILE) are fed through a BitMEXWebsocket message by message, as they were received.
+The OrderManagers run unchanged, on recorded time: a pass every LOOP_INTERVAL seconds, or after updates
+if REQUOTE_ON_UPDATE, without ever sleeping. The orders they send go to a SimulatedAccount rather than
+BitMEX, which fills them against the recorded trades. The recorded account's own orders, position and
+margin are ignored.
+
+Each symbol uses its settings-<SYMBOL>.py overrides, with DRY_RUN off. Order IDs are sequential and the
+random seed fixed, so the same recordings and settings always give the same result.
+"""
+from __future__ import absolute_import
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import random
+import threading
+from concurrent.futures import Future
+from timeit import default_timer as timer
+
+import requests
+
+from market_maker.market_maker import ExchangeInterface, OrderManager, XBt_to_XBT, logger
+from market_maker.recorder import read_recording
+from market_maker.settings import settings, settings_for
+from market_maker.simulator.engine import contract_value
+from market_maker.utils import constants, errors
+from market_maker.ws.orderbook import OrderBook
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+# The recorded account's tables. We simulate our own instead.
+ACCOUNT_TABLES = {'order', 'execution', 'position', 'margin', 'wallet'}
+
+
+class ReplayWebsocket(BitMEXWebsocket):
+
+    """A BitMEXWebsocket that is fed recorded messages instead of reading a socket."""
+
+    def __init__(self, symbols):
+        BitMEXWebsocket.__init__(self)
+        self.symbols = symbols
+        self.symbol = symbols[0]
+        self.shouldAuth = False
+        for symbol in symbols:
+            self.updated[symbol] = threading.Event()
+        self.account = None  # The SimulatedAccount whose positions stand in for the recorded ones
+
+    def ready(self, symbol):
+        """True once the recording has given us the symbol's instrument and order book."""
+        return 'instrument' in self.data and self.data['instrument'].get(symbol) is not None and \
+            symbol in self.books
+
+    def market_depth(self, symbol):
+        """The book itself: replays apply messages on the thread that reads them, so there's nothing to copy."""
+        if symbol not in self.books:
+            return OrderBook(symbol)
+        return self.books[symbol]
+
+    def position(self, symbol):
+        return self.account.position(symbol)
+
+    def exit(self):
+        self.exited = True
+
+
+class SimulatedAccount(object):
+
+    """Our orders, position and margin, with fills simulated from recorded trades.
+
+    An order joins the back of the queue at its price: everything the order book shows resting there when
+    it is placed trades first. Recorded trades at its price use up that queue before filling it; a trade
+    through its price fills it outright. Fills are at the order's price, and never exceed the size of the
+    trade. Post-only orders that would cross the book are cancelled, as BitMEX does.
+    """
+
+    def __init__(self, ws, startingBalance):
+        self.ws = ws
+        ws.account = self
+        self.orders = {}  # orderID -> our open order
+        self.queues = {}  # orderID -> contracts ahead of it in the queue
+        self.positions = {}
+        self.margin = {'marginBalance': startingBalance, 'availableFunds': startingBalance,
+                       'walletBalance': startingBalance, 'realisedPnl': 0}
+        self.ids = itertools.count(1)
+        self.stats = {}  # symbol -> fills, contracts traded
+
+    #
+    # Orders, as the REST API would take them
+    #
+    def create(self, symbol, orders):
+        created = []
+        for o in orders:
+            orderID = next(self.ids)
+            order = {'orderID': '%036d' % orderID, 'clOrdID': 'backtest%d' % orderID, 'symbol': symbol,
+                     'side': o['side'], 'price': o['price'], 'orderQty': o['orderQty'], 'leavesQty': o['orderQty'],
+                     'cumQty': 0, 'ordStatus': 'New', 'execInst': o.get('execInst', '')}
+            if 'ParticipateDoNotInitiate' in order['execInst'] and self.crosses(order):
+                order.update(leavesQty=0, ordStatus='Canceled')
+            else:
+                self.join_queue(order)
+                self.orders[order['orderID']] = order
+            created.append(dict(order))
+        return created
+
+    def amend(self, amends):
+        if any(a['orderID'] not in self.orders for a in amends):
+            raise _http_error(400, 'Invalid ordStatus')
+        amended = []
+        for a in amends:
+            order = self.orders[a['orderID']]
+            price = a.get('price', order['price'])
+            leavesQty = a.get('leavesQty', order['leavesQty'])
+            if 'orderQty' in a:
+                leavesQty = a['orderQty'] - order['cumQty']
+            if leavesQty <= 0:
+                amended.extend(self.cancel([order['orderID']]))
+                continue
+            requeue = price != order['price'] or leavesQty > order['leavesQty']
+            order.update(price=price, leavesQty=leavesQty, orderQty=order['cumQty'] + leavesQty)
+            if requeue:
+                # A new price or more size goes to the back of the queue.
+                if 'ParticipateDoNotInitiate' in order['execInst'] and self.crosses(order):
+                    amended.extend(self.cancel([order['orderID']]))
+                    continue
+                self.join_queue(order)
+            amended.append(dict(order))
+        return amended
+
+    def cancel(self, orderIDs):
+        cancelled = []
+        for orderID in orderIDs:
+            order = self.orders.pop(orderID, None)
+            self.queues.pop(orderID, None)
+            if order is not None:
+                order.update(leavesQty=0, ordStatus='Canceled')
+                cancelled.append(dict(order))
+        return cancelled
+
+    def open_orders(self, symbol):
+        return [dict(o) for o in self.orders.values() if o['symbol'] == symbol]
+
+    def position(self, symbol):
+        return self.positions.get(symbol) or \
+            {'symbol': symbol, 'currentQty': 0, 'avgCostPrice': 0, 'avgEntryPrice': 0, 'realisedPnl': 0}
+
+    #
+    # Fills
+    #
+    def crosses(self, order):
+        book = self.ws.market_depth(order['symbol'])
+        if order['side'] == 'Buy':
+            return book.best_ask() is not None and order['price'] >= book.best_ask()
+        return book.best_bid() is not None and order['price'] <= book.best_bid()
+
+    def join_queue(self, order):
+        self.queues[order['orderID']] = self.ws.market_depth(order['symbol']).size_at(order['side'],
+                                                                                       order['price'])
+
+    def on_trades(self, trades):
+        """Fill our orders against recorded trades."""
+        if not self.orders:
+            return
+        for trade in trades:
+            # A taker selling hits bids; a taker buying lifts offers.
+            side = 'Buy' if trade['side'] == 'Sell' else 'Sell'
+            available = trade['size']
+            for order in sorted((o for o in self.orders.values()
+                                 if o['symbol'] == trade['symbol'] and o['side'] == side),
+                                key=lambda o: -o['price'] if side == 'Buy' else o['price']):
+                if available <= 0:
+                    break
+                through = trade['price'] < order['price'] if side == 'Buy' else trade['price'] > order['price']
+                if not through:
+                    if trade['price'] != order['price']:
+                        break
+                    ahead = self.queues[order['orderID']]
+                    self.queues[order['orderID']] = max(0, ahead - available)
+                    available -= ahead
+                    if available <= 0:
+                        break
+                qty = min(available, order['leavesQty'])
+                available -= qty
+                self.fill(order, qty)
+
+    def fill(self, order, qty):
+        symbol = order['symbol']
+        order['cumQty'] += qty
+        order['leavesQty'] -= qty
+        order['ordStatus'] = 'PartiallyFilled' if order['leavesQty'] else 'Filled'
+        if not order['leavesQty']:
+            del self.orders[order['orderID']]
+            del self.queues[order['orderID']]
+        stats = self.stats.setdefault(symbol, {'fills': 0, 'contracts': 0})
+        stats['fills'] += 1
+        stats['contracts'] += qty
+
+        instrument = self.ws.get_instrument(symbol)
+        price = order['price']
+        qty = qty if order['side'] == 'Buy' else -qty
+        position = self.positions.setdefault(symbol, self.position(symbol))
+        current, entry = position['currentQty'], position['avgEntryPrice']
+        if current == 0 or (current > 0) == (qty > 0):
+            position['avgEntryPrice'] = price if current == 0 else \
+                (entry * abs(current) + price * abs(qty)) / float(abs(current) + abs(qty))
+        else:
+            closed = min(abs(qty), abs(current)) * (1 if current > 0 else -1)
+            pnl = int(contract_value(instrument, closed, price) - contract_value(instrument, closed, entry))
+            position['realisedPnl'] += pnl
+            for field in ('realisedPnl', 'marginBalance', 'availableFunds', 'walletBalance'):
+                self.margin[field] += pnl
+            if abs(qty) > abs(current):
+                position['avgEntryPrice'] = price
+        position['currentQty'] = current + qty
+        if position['currentQty'] == 0:
+            position['avgEntryPrice'] = 0
+        position['avgCostPrice'] = position['avgEntryPrice']
+        self.ws.update_portfolios('position', [position])
+        # Our orders and position are update-notifying tables live; requote on a fill here too.
+        self.ws.updated[symbol].set()
+
+    def unrealised_pnl(self, symbol):
+        position = self.position(symbol)
+        if not position['currentQty']:
+            return 0
+        instrument = self.ws.get_instrument(symbol)
+        mark = instrument.get('markPrice') or instrument.get('lastPrice')
+        return contract_value(instrument, position['currentQty'], mark) - \
+            contract_value(instrument, position['currentQty'], position['avgEntryPrice'])
+
+
+class ReplayClient(object):
+
+    """Stands in for a BitMEX client: market data comes from the replayed websocket, orders go to the
+       SimulatedAccount. Requests complete immediately, in recorded time."""
+
+    def __init__(self, ws, account, symbol, orderIDPrefix):
+        self.ws = ws
+        self.account = account
+        self.symbol = symbol
+        self.orderIDPrefix = orderIDPrefix
+
+    def for_symbol(self, symbol):
+        return ReplayClient(self.ws, self.account, symbol, self.orderIDPrefix)
+
+    def instrument(self, symbol):
+        return self.ws.get_instrument(symbol)
+
+    def ticker_data(self, symbol=None):
+        return self.ws.get_ticker(symbol or self.symbol)
+
+    def market_depth(self, symbol):
+        return self.ws.market_depth(symbol)
+
+    def last_update(self, symbol):
+        return self.ws.last_update(symbol)
+
+    def seq(self, symbol):
+        """Our orders and position are simulated, not on the websocket, so there's no telling whether they
+           changed. None: every pass runs."""
+        return None
+
+    def recent_trades(self, count=None):
+        return self.ws.recent_trades(count, self.symbol)
+
+    def funds(self):
+        return self.account.margin
+
+    def portfolio(self, symbols):
+        return self.ws.portfolio(symbols)
+
+    def position(self, symbol):
+        return self.account.position(symbol)
+
+    def open_orders(self):
+        return self.account.open_orders(self.symbol)
+
+    def http_open_orders(self):
+        return self.account.open_orders(self.symbol)
+
+    def create_bulk_orders(self, orders):
+        for order in orders:
+            order['execInst'] = 'ParticipateDoNotInitiate'
+        return self.account.create(self.symbol, orders)
+
+    def amend_bulk_orders(self, orders):
+        return self.account.amend(orders)
+
+    def cancel(self, orderID):
+        return self.account.cancel(orderID if isinstance(orderID, list) else [orderID])
+
+    def submit(self, fn, *args, **kwargs):
+        """Run now, rather than on a thread: replays stay deterministic."""
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def rate_limit_budget(self):
+        return 1.0
+
+    def retry_stats(self):
+        return {}
+
+
+class Backtest(object):
+
+    def __init__(self, symbols, startingBalance=None):
+        self.symbols = symbols
+        self.ws = ReplayWebsocket(symbols)
+        if startingBalance is None:
+            startingBalance = settings.DRY_BTC
+        self.account = SimulatedAccount(self.ws, int(startingBalance * constants.XBt_TO_XBT))
+        client = ReplayClient(self.ws, self.account, symbols[0], settings.ORDERID_PREFIX)
+        self.order_managers = []
+        for symbol in symbols:
+            symbol_settings = settings_for(symbol)
+            symbol_settings.update(DRY_RUN=False, API_REST_INTERVAL=0)
+            exchange = ExchangeInterface(False, symbol_settings, client.for_symbol(symbol))
+            self.order_managers.append(_Schedule(OrderManager(symbol_settings, exchange)))
+        self.messages = 0
+        self.feed_time = 0.0
+        self.start = self.end = None
+
+    def run(self, messages):
+        """Replay (received, message) pairs. Returns False if an OrderManager stopped the replay."""
+        for received, message in messages:
+            if self.start is None:
+                self.start = received
+            self.end = received
+            self.messages += 1
+
+            table = _table(message)
+            if table in ACCOUNT_TABLES:
+                continue
+            started = timer()
+            decoded = self.ws.feed(message)
+            if table == 'trade' and decoded.get('action') == 'insert':
+                self.account.on_trades(decoded['data'])
+            self.feed_time += timer() - started
+
+            for schedule in self.order_managers:
+                try:
+                    schedule.tick(received, self.ws)
+                except SystemExit:
+                    logger.error("%s: the order manager exited at %s." % (schedule.symbol, _time(received)))
+                    return False
+        return True
+
+    def report(self, wall):
+        """Summary of the replay and each symbol's results."""
+        replayed = (self.end or 0) - (self.start or 0)
+        lines = ["Replayed %d messages (%s of market data) in %.1f s: %.0fx real time, %.1f us per message." %
+                 (self.messages, datetime.timedelta(seconds=int(replayed)), wall, replayed / wall if wall else 0,
+                  self.feed_time / max(self.messages, 1) * 1e6)]
+        for schedule in self.order_managers:
+            symbol = schedule.symbol
+            times = sorted(schedule.pass_times)
+            stats = self.account.stats.get(symbol, {'fills': 0, 'contracts': 0})
+            position = self.account.position(symbol)
+            lines.append("%s: %d passes, decision time p50 %.2f ms, p99 %.2f ms, max %.2f ms; %d fills, %d contracts; "
+                         "position %d; realised PnL %.6f XBT, unrealised %.6f XBT." % (
+                             symbol, len(times), _percentile(times, 0.5) * 1000, _percentile(times, 0.99) * 1000,
+                             (times[-1] if times else 0) * 1000, stats['fills'], stats['contracts'],
+                             position['currentQty'], XBt_to_XBT(position['realisedPnl']),
+                             XBt_to_XBT(self.account.unrealised_pnl(symbol))))
+        return '\n'.join(lines)
+
+
+class _Schedule(object):
+
+    """When one OrderManager's passes are due, on recorded time, following the same settings as run_loop()."""
+
+    def __init__(self, om):
+        self.om = om
+        self.symbol = om.exchange.symbol
+        # Called for every message, so settings are looked up once.
+        self.on_update = om.settings.REQUOTE_ON_UPDATE
+        self.debounce = om.settings.REQUOTE_DEBOUNCE
+        self.interval = om.settings.LOOP_INTERVAL
+        if self.on_update and om.settings.REQUOTE_MAX_IDLE is not None:
+            self.interval = om.settings.REQUOTE_MAX_IDLE
+        self.started = False
+        self.due = None  # Recorded time of the next pass
+        self.changed = False
+        self.pass_times = []
+
+    def tick(self, now, ws):
+        if not self.started:
+            if ws.ready(self.symbol):
+                self.run(now, self.om.init)
+                self.started = True
+            return
+        if self.on_update and not self.changed and ws.updated[self.symbol].is_set():
+            # Data changed: requote once the burst is over, as wait_for_update() would.
+            self.changed = True
+            self.due = min(self.due, now + self.debounce)
+        if now >= self.due:
+            if self.on_update:
+                ws.updated[self.symbol].clear()
+                self.changed = False
+            self.run(now, self.om.run_once)
+
+    def run(self, now, step):
+        self.due = now + self.interval
+        started = timer()
+        try:
+            step()
+        except (errors.MarketClosedError, errors.MarketEmptyError) as e:
+            logger.warning("%s: %s" % (_time(now), e))
+        self.pass_times.append(timer() - started)
+
+
+def _table(message):
+    """The table a raw message is for, without decoding it. BitMEX sends the table name first."""
+    if message.startswith('{"table":'):
+        start = message.index('"', 9) + 1
+        return message[start:message.index('"', start)]
+    return None
+
+
+def _http_error(status, message):
+    """The HTTPError the REST client raises when BitMEX rejects a request."""
+    response = requests.models.Response()
+    response.status_code = status
+    response._content = json.dumps({'error': {'message': message, 'name': 'HTTPError'}}).encode('utf-8')
+    return requests.exceptions.HTTPError(message, response=response)
+
+
+def _percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0
+
+
+def _time(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+
+parser = argparse.ArgumentParser(prog='backtest', description='Replay recorded market data through the market maker.')
+parser.add_argument('recordings', nargs='+', help='recording files, replayed in the order given')
+parser.add_argument('--symbols', nargs='+', default=None,
+                    help='symbols to quote (default: SYMBOLS, or SYMBOL, from settings)')
+parser.add_argument('--balance', type=float, default=None, help='starting balance in XBT (default: DRY_BTC)')
+parser.add_argument('--seed', type=int, default=0, help='random seed, for RANDOM_ORDER_SIZE')
+parser.add_argument('--verbose', action='store_true', help='log every pass, as a live run does')
+
+
+def run(args=None):
+    args = parser.parse_args(args)
+    symbols = args.symbols or settings.SYMBOLS or [settings.SYMBOL]
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    random.seed(args.seed)
+
+    backtest = Backtest(symbols, args.balance)
+    started = timer()
+    try:
+        backtest.run(read_recording(args.recordings))
+    except KeyboardInterrupt:
+        pass
+    print(backtest.report(timer() - started))
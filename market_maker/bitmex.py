@@ -1,13 +1,18 @@
 """BitMEX API Connector."""
 from __future__ import absolute_import
+import copy
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep, time
 import json
 import base64
 import uuid
 import logging
+import threading
 from market_maker.auth import AccessTokenAuth, APIKeyAuthWithExpires
-from market_maker.utils import constants, errors
+from market_maker.utils import constants, errors, ratelimit, retry
+from market_maker.utils.metrics import metrics
 from market_maker.ws.ws_thread import BitMEXWebsocket
 
 
@@ -17,8 +22,10 @@ class BitMEX(object):
     """BitMEX API Connector."""
 
     def __init__(self, base_url=None, symbol=None, login=None, password=None, otpToken=None,
-                 apiKey=None, apiSecret=None, orderIDPrefix='mm_bitmex_', shouldWSAuth=True):
-        """Init connector."""
+                 apiKey=None, apiSecret=None, orderIDPrefix='mm_bitmex_', shouldWSAuth=True, poolSize=4,
+                 retryPolicy=None, connectWS=True, symbols=None):
+        """Init connector. To trade several instruments over one connection, list them all in `symbols`,
+        then get a client per symbol with for_symbol()."""
         self.logger = logging.getLogger('root')
         self.base_url = base_url
         self.symbol = symbol
@@ -29,20 +36,51 @@ class BitMEX(object):
                             "an API key. You can generate one at https://www.bitmex.com/app/apiKeys")
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        # Auth: Use Access Token by default, API Key/Secret if provided. One instance signs every request.
+        self.auth = AccessTokenAuth(self.token)
+        if self.apiKey:
+            self.auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
         if len(orderIDPrefix) > 13:
             raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
         self.orderIDPrefix = orderIDPrefix
 
-        # Prepare HTTPS session
+        # Prepare HTTPS session. Connections are kept alive and pooled; poolSize of them can be in use at once.
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         # These headers are always sent
         self.session.headers.update({'user-agent': 'liquidbot-' + constants.VERSION})
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
 
-        # Create websocket for streaming data
+        # Paces requests to stay inside our API rate limit. See rate_limit_budget().
+        self.ratelimit = ratelimit.RateLimiter()
+
+        # How failed requests are retried, and how often that has happened. See retry_stats().
+        self.retryPolicy = retryPolicy or retry.RetryPolicy()
+        self.retryStats = retry.RetryStats()
+
+        # Requests sent with submit() run here, so independent calls can be in flight at the same time.
+        self.executor = ThreadPoolExecutor(max_workers=poolSize)
+
+        # Create websocket for streaming data. REST-only clients (and tests) can do without.
         self.ws = BitMEXWebsocket()
-        self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth)
+        # symbol -> our open orders, being fetched while the websocket downloads its data images. Shared with
+        # for_symbol() clients; see http_open_orders().
+        self.prefetchedOrders = {}
+        if connectWS:
+            if self.apiKey:
+                for s in symbols or [symbol]:
+                    self.prefetchedOrders[s] = self.__prefetch_open_orders(s)
+            self.ws.connect(base_url, symbols or [symbol], shouldAuth=shouldWSAuth)
+
+    def for_symbol(self, symbol):
+        """Return a client for another symbol on the same connections. It shares this client's websocket,
+        HTTP connection pool, request threads, rate limit and retry counters."""
+        client = copy.copy(self)
+        client.symbol = symbol
+        return client
 
     #
     # Public methods
@@ -59,19 +97,44 @@ class BitMEX(object):
         """Get market depth / orderbook."""
         return self.ws.market_depth(symbol)
 
-    def recent_trades(self, symbol):
-        """Get recent trades.
+    def recent_trades(self, count=None):
+        """Get the latest `count` trades (all buffered trades if None), oldest first.
 
         Returns
         -------
-        A list of dicts:
-              {u'amount': 60,
-               u'date': 1306775375,
-               u'price': 8.7401099999999996,
-               u'tid': u'93842'},
+        A NumPy structured array. It is a view into the websocket's trade buffer, so copy it if you
+        need to hold on to it. Columns:
+              timestamp, symbol, side, size, price, tickDirection, trdMatchID,
+              grossValue, homeNotional, foreignNotional
 
         """
-        return self.ws.recent_trades(symbol)
+        return self.ws.recent_trades(count, self.symbol)
+
+    def wait_for_update(self, timeout=None, debounce=0):
+        """Block until the quote, order book, orders or position change for our symbol."""
+        return self.ws.wait_for_update(self.symbol, timeout, debounce)
+
+    def last_update(self, symbol):
+        """When the latest market or account data for a symbol was received, as Unix time; None if never."""
+        return self.ws.last_update(symbol)
+
+    def seq(self, symbol):
+        """A number that changes whenever market or account data for a symbol does."""
+        return self.ws.seq(symbol)
+
+    def submit(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) on the request pool, e.g. bitmex.submit(bitmex.cancel, orderIDs).
+        Returns a concurrent.futures.Future; its result() returns or raises what the call did.
+        All the methods on this class are synchronous; this is how to run several at once."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def rate_limit_budget(self):
+        """Fraction of our API rate limit left right now, from 0 to 1."""
+        return self.ratelimit.budget()
+
+    def retry_stats(self):
+        """Counts of REST requests sent, retried (by reason) and given up on."""
+        return self.retryStats.as_dict()
 
     #
     # Authentication required methods
@@ -96,6 +159,11 @@ class BitMEX(object):
         """Get your open position."""
         return self.ws.position(symbol)
 
+    @authentication_required
+    def portfolio(self, symbols):
+        """Get the Portfolio of contracts `symbols`: their delta, kept up to date by the websocket."""
+        return self.ws.portfolio(symbols)
+
     @authentication_required
     def buy(self, quantity, price):
         """Place a buy order.
@@ -147,20 +215,44 @@ class BitMEX(object):
     @authentication_required
     def open_orders(self):
         """Get open orders."""
-        return self.ws.open_orders(self.orderIDPrefix)
+        return self.ws.open_orders(self.orderIDPrefix, self.symbol)
 
     @authentication_required
     def http_open_orders(self):
-        """Get open orders via HTTP. Used on close to ensure we catch them all."""
+        """Get open orders via HTTP. Used on close to ensure we catch them all. The first call gets the ones
+        fetched while connecting."""
+        prefetched = self.prefetchedOrders.pop(self.symbol, None)
+        if prefetched and not prefetched.exception():
+            return prefetched.result()
+        return self._http_open_orders(self.symbol)
+
+    def _http_open_orders(self, symbol, rethrow_errors=False):
         api = "order"
         orders = self._curl_bitmex(
             api=api,
-            query={'filter': json.dumps({'ordStatus.isTerminated': False, 'symbol': self.symbol})},
-            verb="GET"
+            query={'filter': json.dumps({'ordStatus.isTerminated': False, 'symbol': symbol})},
+            verb="GET",
+            rethrow_errors=rethrow_errors
         )
         # Only return orders that start with our clOrdID prefix.
         return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix)]
 
+    def __prefetch_open_orders(self, symbol):
+        """Fetch our open orders for `symbol` in the background. Returns a Future. Runs on a daemon thread
+        rather than the executor, so a failed start doesn't wait on its retries to exit; if it fails,
+        http_open_orders() asks again."""
+        future = Future()
+
+        def fetch():
+            try:
+                future.set_result(self._http_open_orders(symbol, rethrow_errors=True))
+            except Exception as e:
+                future.set_exception(e)
+        thread = threading.Thread(target=fetch, name='prefetch')
+        thread.daemon = True
+        thread.start()
+        return future
+
     @authentication_required
     def cancel(self, orderID):
         """Cancel an existing order."""
@@ -181,8 +273,35 @@ class BitMEX(object):
         }
         return self._curl_bitmex(api=api, postdict=postdict, verb="POST")
 
+    def _recover_duplicate_orders(self, postdict, rethrow_errors=False):
+        """Look up the orders a create rejected as duplicates, by clOrdID, and check they are the ones we
+        posted. Returns them as the create would have: a list for order/bulk, one order otherwise."""
+        posted = postdict.get('orders', [postdict])
+        found = self._curl_bitmex(
+            api='order',
+            query={'filter': json.dumps({'clOrdID': [o['clOrdID'] for o in posted]}), 'count': len(posted)},
+            verb='GET',
+            rethrow_errors=rethrow_errors
+        )
+        byClOrdID = dict((o['clOrdID'], o) for o in found)
+        orders = []
+        for o in posted:
+            order = byClOrdID.get(o['clOrdID'])
+            if order is None or any(key in o and order.get(key) != o[key] for key in ('orderQty', 'price', 'symbol')):
+                raise Exception('Attempted to recover from duplicate clOrdID, but order returned from ' +
+                                'API did not match POST.\nPOST data: %s\nReturned order: %s' % (
+                                    json.dumps(o), json.dumps(order)))
+            orders.append(order)
+        return orders if 'orders' in postdict else orders[0]
+
     def _curl_bitmex(self, api, query=None, postdict=None, timeout=3, verb=None, rethrow_errors=False):
-        """Send a request to BitMEX Servers."""
+        """Send a request to BitMEX Servers.
+
+        Timeouts, connection errors, 429s and 503s are retried with backoff until the endpoint's deadline
+        (see utils/retry.py). Requests that aren't idempotent are not resent after a timeout or connection
+        error, as they may have gone through. When we give up, RetriesExhaustedError is raised if
+        rethrow_errors, otherwise we exit.
+        """
         # Handle URL
         url = self.base_url + api
 
@@ -190,10 +309,11 @@ class BitMEX(object):
         if not verb:
             verb = 'POST' if postdict else 'GET'
 
-        # Auth: Use Access Token by default, API Key/Secret if provided
-        auth = AccessTokenAuth(self.token)
-        if self.apiKey:
-            auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
+        # Serialize the body once, without whitespace, exactly as it is signed and sent.
+        body = None
+        if postdict is not None:
+            body = json.dumps(postdict, separators=(',', ':')).encode('utf-8')
+        prepped = self.session.prepare_request(requests.Request(verb, url, data=body, params=query))
 
         def maybe_exit(e):
             if rethrow_errors:
@@ -201,82 +321,136 @@ class BitMEX(object):
             else:
                 exit(1)
 
-        # Make the request
-        try:
-            req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
-            prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
-            # Make non-200s throw
-            response.raise_for_status()
-
-        except requests.exceptions.HTTPError as e:
-            # 401 - Auth error. This is fatal with API keys.
-            if response.status_code == 401:
-                self.logger.error("Login information or API Key incorrect, please check and restart.")
-                self.logger.error("Error: " + response.text)
-                if postdict:
-                    self.logger.error(postdict)
-                # Always exit, even if rethrow_errors, because this is fatal
-                exit(1)
-                return self._curl_bitmex(api, query, postdict, timeout, verb)
-
-            # 404, can be thrown if order canceled does not exist.
-            elif response.status_code == 404:
-                if verb == 'DELETE':
-                    self.logger.error("Order not found: %s" % postdict['orderID'])
-                    return
-                self.logger.error("Unable to contact the BitMEX API (404). " +
-                                  "Request: %s \n %s" % (url, json.dumps(postdict)))
-                maybe_exit(e)
-
-            # 429, ratelimit
-            elif response.status_code == 429:
-                self.logger.error("Ratelimited on current request. Sleeping, then trying again. Try fewer " +
-                                  "order pairs or contact support@bitmex.com to raise your limits. " +
-                                  "Request: %s \n %s" % (url, json.dumps(postdict)))
-                sleep(1)
-                return self._curl_bitmex(api, query, postdict, timeout, verb)
-
-            # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
-            elif response.status_code == 503:
-                self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
-                                    "Request: %s \n %s" % (url, json.dumps(postdict)))
-                sleep(1)
-                return self._curl_bitmex(api, query, postdict, timeout, verb)
-
-            # Duplicate clOrdID: that's fine, probably a deploy, go get the order and return it
-            elif (response.status_code == 400 and
-                  response.json()['error'] and
-                  response.json()['error']['message'] == 'Duplicate clOrdID'):
-
-                order = self._curl_bitmex('/order',
-                                          query={'filter': json.dumps({'clOrdID': postdict['clOrdID']})},
-                                          verb='GET')[0]
-                if (
-                        order['orderQty'] != postdict['quantity'] or
-                        order['price'] != postdict['price'] or
-                        order['symbol'] != postdict['symbol']):
-                    raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
-                                    'did not match POST.\nPOST data: %s\nReturned order: %s' % (
-                                        json.dumps(postdict), json.dumps(order)))
-                # All good
-                return order
-
-            # Unknown Error
-            else:
-                self.logger.error("Unhandled Error: %s: %s" % (e, response.text))
-                self.logger.error("Endpoint was: %s %s: %s" % (verb, api, json.dumps(postdict)))
-                maybe_exit(e)
-
-        except requests.exceptions.Timeout as e:
-            # Timeout, re-run this request
-            self.logger.warning("Timed out, retrying...")
-            return self._curl_bitmex(api, query, postdict, timeout, verb)
-
-        except requests.exceptions.ConnectionError as e:
-            self.logger.warning("Unable to contact the BitMEX API (ConnectionError). Please check the URL. Retrying. " +
-                                "Request: %s \n %s" % (url, json.dumps(postdict)))
-            sleep(1)
-            return self._curl_bitmex(api, query, postdict, timeout, verb)
-
-        return response.json()
+        # Bulk order calls cost one request per two orders against the rate limit.
+        cost = 1
+        if postdict and 'orders' in postdict:
+            cost = max(1, (len(postdict['orders']) + 1) // 2)
+        priority = request_priority(verb, api)
+        idempotent = retry.is_idempotent(verb, api, postdict)
+        endpoint = api.lstrip('/')
+        # Requests changing orders are timed until the websocket shows them changed. See utils/metrics.py.
+        orderKeys = order_keys(postdict) if endpoint.startswith('order') and verb != 'GET' and postdict else None
+        give_up_at = time() + self.retryPolicy.deadline_for(verb, api)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            reason = None
+
+            # Wait for our turn under the rate limit, but not past the deadline.
+            if not self.ratelimit.acquire(priority, cost, timeout=give_up_at - time()):
+                self.retryStats.record_give_up(deadline_exceeded=True)
+                self.logger.error("Rate limit left no room to send %s %s before its deadline." % (verb, api))
+                maybe_exit(errors.RetriesExhaustedError("%s %s: deadline exceeded" % (verb, api)))
+
+            # Make the request. Signed per attempt, as signatures expire.
+            self.retryStats.record_request()
+            try:
+                self.auth(prepped)
+                sent = time()
+                if orderKeys:
+                    metrics.order_sent(self.symbol, orderKeys, sent, first=attempt == 1)
+                response = self.session.send(prepped, timeout=min(timeout, max(give_up_at - time(), 0.1)))
+                metrics.observe('rest_response_seconds', time() - sent, verb=verb, endpoint=endpoint)
+                metrics.inc('rest_responses_total', verb=verb, endpoint=endpoint, status=response.status_code)
+                self.ratelimit.update(response)
+                # Make non-200s throw
+                response.raise_for_status()
+
+            except requests.exceptions.HTTPError as e:
+                # 401 - Auth error. This is fatal with API keys.
+                if response.status_code == 401:
+                    self.logger.error("Login information or API Key incorrect, please check and restart.")
+                    self.logger.error("Error: " + response.text)
+                    if postdict:
+                        self.logger.error(postdict)
+                    # Always exit, even if rethrow_errors, because this is fatal
+                    exit(1)
+
+                # 404, can be thrown if order canceled does not exist.
+                elif response.status_code == 404:
+                    if verb == 'DELETE':
+                        self.logger.error("Order not found: %s" % postdict['orderID'])
+                        return
+                    self.logger.error("Unable to contact the BitMEX API (404). " +
+                                      "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    maybe_exit(e)
+
+                # 429, ratelimit. The limiter has read `retry-after` and holds the retry back until then.
+                elif response.status_code == 429:
+                    self.logger.error("Ratelimited on current request. Waiting, then trying again. Try fewer " +
+                                      "order pairs or contact support@bitmex.com to raise your limits. " +
+                                      "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    reason = retry.RATELIMITED
+
+                # 503 - BitMEX temporary downtime, likely due to a deploy. The request wasn't processed;
+                # try again.
+                elif response.status_code == 503:
+                    self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
+                                        "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    reason = retry.UNAVAILABLE
+
+                # Duplicate clOrdID: that's fine, probably a deploy or a retry after a timeout. Go get the
+                # orders and return them.
+                elif (response.status_code == 400 and
+                      response.json()['error'] and
+                      response.json()['error']['message'] == 'Duplicate clOrdID'):
+                    return self._recover_duplicate_orders(postdict, rethrow_errors)
+
+                # Unknown Error
+                else:
+                    self.logger.error("Unhandled Error: %s: %s" % (e, response.text))
+                    self.logger.error("Endpoint was: %s %s: %s" % (verb, api, json.dumps(postdict)))
+                    maybe_exit(e)
+
+            except requests.exceptions.Timeout as e:
+                self.logger.warning("Timed out, retrying...")
+                reason = retry.TIMEOUT
+
+            except requests.exceptions.ConnectionError as e:
+                self.logger.warning("Unable to contact the BitMEX API (ConnectionError). Please check the URL. " +
+                                    "Retrying. Request: %s \n %s" % (url, json.dumps(postdict)))
+                reason = retry.CONNECTION_ERROR
+
+            if reason is None:
+                return response.json()
+
+            # Retry, unless that could repeat the request or we're out of attempts or time.
+            remaining = give_up_at - time()
+            if not idempotent and reason in (retry.TIMEOUT, retry.CONNECTION_ERROR):
+                self.retryStats.record_give_up()
+                self.logger.error("Not retrying %s %s: it may already have gone through." % (verb, api))
+                maybe_exit(errors.RetriesExhaustedError("%s %s: %s, not safe to retry" % (verb, api, reason)))
+            if attempt >= self.retryPolicy.max_attempts or remaining <= 0:
+                self.retryStats.record_give_up(deadline_exceeded=remaining <= 0)
+                self.logger.error("Giving up on %s %s after %d attempts." % (verb, api, attempt))
+                maybe_exit(errors.RetriesExhaustedError("%s %s: %s after %d attempts" % (verb, api, reason, attempt)))
+            self.retryStats.record_retry(reason)
+            metrics.inc('rest_retries_total', reason=reason)
+            # After a 429 the rate limiter does the waiting.
+            if reason != retry.RATELIMITED:
+                sleep(min(self.retryPolicy.backoff(attempt), remaining))
+
+
+def order_keys(postdict):
+    """IDs of the orders a request changes: orderIDs, or clOrdIDs for orders that don't have one yet."""
+    keys = []
+    for order in postdict.get('orders', [postdict]):
+        ids = order.get('orderID') or order.get('clOrdID')
+        if isinstance(ids, list):
+            keys.extend(ids)
+        elif ids:
+            keys.append(ids)
+    return keys
+
+
+def request_priority(verb, api):
+    """Rate limiter priority for a request: cancels before amends before creates."""
+    if api.startswith('order'):
+        if verb == 'DELETE':
+            return ratelimit.CANCEL
+        if verb == 'PUT':
+            return ratelimit.AMEND
+        if verb == 'POST':
+            return ratelimit.CREATE
+    return ratelimit.DEFAULT
@@ -0,0 +1,280 @@
+"""Shared-memory market data bus.
+
+Lets one feed-handler process own the websocket and publish what the order managers read - instrument,
+top of book and depth, our open orders, position and margin - to quoting processes on other cores.
+
+Each symbol has a fixed-size slot in one shared memory segment, guarded by a seqlock: the single writer
+bumps the slot's sequence number to odd, writes, and bumps it to even again. Readers copy the slot and
+retry if the sequence number was odd or changed while they copied. Readers never block the writer, so a
+slow quoting process can't stall the feed; at worst it retries a copy.
+
+This relies on the writer's stores becoming visible in order, as they do on x86. Needs Python 3.8+
+(multiprocessing.shared_memory).
+"""
+from __future__ import absolute_import
+import logging
+import time
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from market_maker.ws.orderbook import OrderBook
+from market_maker.ws.ws_thread import ticker_from_instrument
+
+logger = logging.getLogger('root')
+
+# Instrument columns published on the bus. Missing values are NaN, and read back as None.
+INSTRUMENT_FIELDS = [
+    ('symbol', 'U16'), ('state', 'U16'), ('isQuanto', '?'), ('isInverse', '?'),
+    ('tickSize', 'f8'), ('tickLog', 'i8'), ('lotSize', 'f8'),
+    ('bidPrice', 'f8'), ('askPrice', 'f8'), ('lastPrice', 'f8'), ('midPrice', 'f8'), ('markPrice', 'f8'),
+    ('indicativeSettlePrice', 'f8'), ('multiplier', 'f8'), ('underlyingToSettleMultiplier', 'f8'),
+    ('initMargin', 'f8'),
+]
+ORDER_FIELDS = [
+    ('orderID', 'U36'), ('side', 'U4'), ('price', 'f8'), ('orderQty', 'i8'), ('leavesQty', 'i8'),
+]
+POSITION_FIELDS = [
+    ('currentQty', 'i8'), ('avgCostPrice', 'f8'), ('avgEntryPrice', 'f8'),
+]
+MARGIN_FIELDS = [
+    ('marginBalance', 'i8'), ('availableFunds', 'i8'),
+]
+
+HEADER_DTYPE = np.dtype([
+    ('seq', 'u8'), ('heartbeat', 'f8'), ('exited', '?'), ('connected', '?'), ('margin', MARGIN_FIELDS),
+], align=True)
+
+
+def slot_dtype(levels, max_orders):
+    """Layout of one symbol's slot: `levels` levels of depth per side and up to `max_orders` open orders."""
+    return np.dtype([
+        ('seq', 'u8'), ('received', 'f8'),
+        ('instrument', INSTRUMENT_FIELDS),
+        ('bidPrices', 'f8', levels), ('bidSizes', 'i8', levels), ('bidLevels', 'i4'), ('bidTotal', 'i8'),
+        ('askPrices', 'f8', levels), ('askSizes', 'i8', levels), ('askLevels', 'i4'), ('askTotal', 'i8'),
+        ('orders', ORDER_FIELDS, max_orders), ('orderCount', 'i4'),
+        ('position', POSITION_FIELDS),
+    ], align=True)
+
+
+class MarketDataBus(object):
+
+    """One shared memory segment with a slot per symbol, plus a header for account-wide data.
+
+    The process that creates the bus (name=None) owns the segment and unlinks it on close(). Processes it
+    starts with multiprocessing attach by name, with the same symbols, levels and max_orders.
+    """
+
+    def __init__(self, symbols, levels=25, max_orders=64, name=None):
+        if shared_memory is None:
+            raise Exception("The market data bus needs Python 3.8 or later (multiprocessing.shared_memory).")
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.levels = levels
+        self.max_orders = max_orders
+        self.dtype = slot_dtype(levels, max_orders)
+        self.truncated = set()  # Symbols with more open orders than fit, as of the last publish()
+
+        size = HEADER_DTYPE.itemsize + self.dtype.itemsize * len(self.symbols)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.name = self.shm.name
+
+        self.header = np.ndarray(1, HEADER_DTYPE, buffer=self.shm.buf)
+        self.slots = np.ndarray(len(self.symbols), self.dtype, buffer=self.shm.buf, offset=HEADER_DTYPE.itemsize)
+        if self.owner:
+            self.header[:] = np.zeros(1, HEADER_DTYPE)
+            self.slots[:] = np.zeros(len(self.symbols), self.dtype)
+
+    def close(self):
+        del self.header, self.slots  # Views into the buffer must go before it can be closed
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    #
+    # Writer side. Only one process (the feed handler) may write.
+    #
+    def publish(self, symbol, instrument=None, book=None, orders=None, position=None, received=None):
+        """Write one symbol's data, the latest of which the feed received at `received` (Unix time).
+           Arguments left as None keep what was published before."""
+        i = self.index[symbol]
+        slot = self.slots[i:i + 1]
+        value = slot.copy()  # Build the new slot off to the side, then copy it in under the seqlock
+        if instrument is not None:
+            for name in value['instrument'].dtype.names:
+                v = instrument.get(name)
+                value['instrument'][name] = _fill(value['instrument'].dtype[name]) if v is None else v
+        if book is not None:
+            for side, prefix in (('Buy', 'bid'), ('Sell', 'ask')):
+                prices, sizes = book.depth(side, self.levels)
+                value[prefix + 'Prices'][0, :len(prices)] = prices
+                value[prefix + 'Sizes'][0, :len(sizes)] = sizes
+                value[prefix + 'Levels'] = len(prices)
+                value[prefix + 'Total'] = book.total_depth(side)
+        if orders is not None:
+            if len(orders) > self.max_orders:
+                if symbol not in self.truncated:
+                    logger.error("%s has %d open orders; only the first %d fit on the bus. Raise BUS_MAX_ORDERS." %
+                                 (symbol, len(orders), self.max_orders))
+                    self.truncated.add(symbol)
+                orders = orders[:self.max_orders]
+            else:
+                self.truncated.discard(symbol)
+            for j, order in enumerate(orders):
+                value['orders'][0, j] = tuple(order[name] for name, _ in ORDER_FIELDS)
+            value['orderCount'] = len(orders)
+        if position is not None:
+            value['position'] = tuple(position.get(name) or 0 for name, _ in POSITION_FIELDS)
+        if received is not None:
+            value['received'] = received
+
+        seq = int(slot['seq'][0])
+        value['seq'] = seq + 1
+        slot['seq'] = seq + 1  # Odd: write in progress
+        slot[:] = value
+        slot['seq'] = seq + 2
+
+    def publish_account(self, margin=None, exited=False, connected=True):
+        """Write account-wide data and a heartbeat, so readers can tell the feed is alive. `connected` is
+           False while the feed's websocket reconnects."""
+        seq = int(self.header['seq'][0])
+        self.header['seq'] = seq + 1
+        if margin is not None:
+            self.header['margin'] = tuple(margin.get(name) or 0 for name, _ in MARGIN_FIELDS)
+        self.header['heartbeat'] = time.time()
+        self.header['exited'] = exited
+        self.header['connected'] = connected
+        self.header['seq'] = seq + 2
+
+    #
+    # Reader side
+    #
+    def seq(self, symbol):
+        """The symbol's sequence number. It changes whenever the symbol is published."""
+        return int(self.slots['seq'][self.index[symbol]])
+
+    def read(self, symbol):
+        """Return a consistent copy of a symbol's slot."""
+        i = self.index[symbol]
+        return _consistent_copy(self.slots[i:i + 1])[0]
+
+    def read_account(self):
+        return _consistent_copy(self.header)[0]
+
+
+def _consistent_copy(view):
+    """Copy a seqlock-guarded record: retry while it's being written, or if it changed during the copy."""
+    while True:
+        seq = int(view['seq'][0])
+        if seq & 1:
+            time.sleep(0)
+            continue
+        copy = view.copy()
+        if int(view['seq'][0]) == seq:
+            return copy
+
+
+class BusClient(object):
+
+    """Stands in for a BitMEX client in a quoting process.
+
+    Market and account data are read from the bus instead of a websocket; REST calls (orders, cancels) go to
+    `rest`, a BitMEX client without a websocket of its own.
+    """
+
+    def __init__(self, bus, rest, symbol, maxFeedAge=5):
+        self.bus = bus
+        self.rest = rest
+        self.symbol = symbol
+        self.maxFeedAge = maxFeedAge
+        self.ws = self  # ExchangeInterface checks ws.exited and calls ws.exit()
+
+    def for_symbol(self, symbol):
+        return BusClient(self.bus, self.rest.for_symbol(symbol), symbol, self.maxFeedAge)
+
+    def __getattr__(self, name):
+        # Everything we don't read from the bus is a REST call.
+        return getattr(self.rest, name)
+
+    @property
+    def exited(self):
+        """True if the feed handler has stopped, or hasn't published for maxFeedAge seconds."""
+        account = self.bus.read_account()
+        return bool(account['exited']) or time.time() - account['heartbeat'] > self.maxFeedAge
+
+    def exit(self):
+        pass  # The feed handler owns the connection
+
+    def wait_for_connection(self, timeout=None):
+        """Poll until the feed handler's data is live, or `timeout` seconds pass. Returns True if it is."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.bus.read_account()['connected'] and not self.exited:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def instrument(self, symbol):
+        instrument = self.bus.read(symbol)['instrument']
+        return {name: _value(instrument[name]) for name in instrument.dtype.names}
+
+    def ticker_data(self, symbol):
+        return ticker_from_instrument(self.instrument(symbol))
+
+    def market_depth(self, symbol):
+        slot = self.bus.read(symbol)
+        bids = slot['bidPrices'][:slot['bidLevels']].tolist(), slot['bidSizes'][:slot['bidLevels']].tolist()
+        asks = slot['askPrices'][:slot['askLevels']].tolist(), slot['askSizes'][:slot['askLevels']].tolist()
+        return OrderBook.from_depth(symbol, bids, asks, int(slot['bidTotal']), int(slot['askTotal']))
+
+    def open_orders(self):
+        slot = self.bus.read(self.symbol)
+        orders = slot['orders'][:slot['orderCount']]
+        return [dict(zip(orders.dtype.names, order), symbol=self.symbol) for order in orders.tolist()]
+
+    def position(self, symbol):
+        position = self.bus.read(symbol)['position']
+        return dict(zip(position.dtype.names, position.tolist()), symbol=symbol)
+
+    def portfolio(self, symbols):
+        """None: nothing tells us when the bus changes, so there's no Portfolio to keep up to date. The delta
+           is worked out from position() and instrument() instead."""
+        return None
+
+    def funds(self):
+        margin = self.bus.read_account()['margin']
+        return dict(zip(margin.dtype.names, margin.tolist()))
+
+    def last_update(self, symbol):
+        return float(self.bus.read(symbol)['received']) or None
+
+    def seq(self, symbol):
+        return self.bus.seq(symbol)
+
+    def wait_for_update(self, timeout=None, debounce=0):
+        """Poll until our symbol is published again, or `timeout` seconds pass."""
+        seq = self.bus.seq(self.symbol)
+        deadline = None if timeout is None else time.time() + timeout
+        while self.bus.seq(self.symbol) == seq:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.001)
+        if debounce:
+            time.sleep(debounce)
+        return True
+
+
+def _fill(dtype):
+    return {'f': np.nan, 'U': ''}.get(dtype.kind, 0)
+
+
+def _value(v):
+    """Turn a NumPy scalar read off the bus back into a plain Python value; NaN becomes None."""
+    v = v.item()
+    return None if isinstance(v, float) and v != v else v
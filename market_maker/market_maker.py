@@ -1,22 +1,35 @@
 from __future__ import absolute_import
-from time import sleep
+from time import sleep, time
 import sys
 from datetime import datetime
-from os.path import getmtime
 import random
 import requests
 import atexit
 import signal
-from operator import itemgetter
-import numpy as np
+import threading
+import traceback
 
-from market_maker import bitmex
-from market_maker.settings import settings
-from market_maker.utils import log, constants, errors
+from market_maker import bitmex, ladder, reconcile
+from market_maker.settings import settings, settings_for, settings_files, reload_settings, symbol as settings_symbol
+from market_maker.utils import log, constants, errors, retry
+from market_maker.utils.metrics import metrics
+from market_maker.utils.watcher import FileWatcher
 
 # Used for reloading the bot - saves modified times of key files
 import os
-watched_files_mtimes = [(f, getmtime(f)) for f in settings.WATCHED_FILES]
+# Settings and code files. Settings files are reloaded when they change; other files restart the bot.
+watcher = FileWatcher(settings.WATCHED_FILES)
+
+# Settings used once, to connect or set things up. Changing these restarts the bot; the rest are picked up
+# by the next pass.
+RESTART_SETTINGS = frozenset([
+    'BASE_URL', 'API_KEY', 'API_SECRET', 'LOGIN', 'PASSWORD', 'OTPTOKEN', 'SYMBOL', 'SYMBOLS', 'DRY_RUN',
+    'ORDERID_PREFIX', 'QUOTING_PROCESSES', 'BUS_DEPTH_LEVELS', 'BUS_MAX_ORDERS', 'HTTP_POOL_SIZE',
+    'HTTP_RETRY_MAX_ATTEMPTS', 'HTTP_RETRY_BASE_DELAY', 'HTTP_RETRY_MAX_DELAY', 'HTTP_RETRY_DEADLINE',
+    'HTTP_AMEND_DEADLINE', 'WS_RECONNECT_BASE_DELAY', 'WS_RECONNECT_MAX_DELAY', 'WS_RECONNECT_DEADLINE',
+    'TABLE_CAPACITY', 'JSON_DECODER', 'RECORD_FILE', 'METRICS_PORT', 'LOG_QUEUE_SIZE',
+    'EVENT_LOG_FILE', 'WATCHED_FILES', 'DELTA_ALERT_THRESHOLD',
+])
 
 
 #
@@ -25,26 +38,49 @@ watched_files_mtimes = [(f, getmtime(f)) for f in settings.WATCHED_FILES]
 logger = log.setup_custom_logger('root')
 
 
+def connect(symbols, connectWS=True):
+    """Connect to BitMEX, streaming data for all of `symbols` over one websocket.
+       Returns a client for the first symbol; see BitMEX.for_symbol() for the others."""
+    return bitmex.BitMEX(base_url=settings.BASE_URL, symbol=symbols[0], symbols=symbols, connectWS=connectWS,
+                         login=settings.LOGIN,
+                         password=settings.PASSWORD, otpToken=settings.OTPTOKEN, apiKey=settings.API_KEY,
+                         apiSecret=settings.API_SECRET, orderIDPrefix=settings.ORDERID_PREFIX,
+                         poolSize=settings.HTTP_POOL_SIZE,
+                         retryPolicy=retry.RetryPolicy(
+                             max_attempts=settings.HTTP_RETRY_MAX_ATTEMPTS,
+                             base_delay=settings.HTTP_RETRY_BASE_DELAY,
+                             max_delay=settings.HTTP_RETRY_MAX_DELAY,
+                             deadline=settings.HTTP_RETRY_DEADLINE,
+                             deadlines={('PUT', 'order/bulk'): settings.HTTP_AMEND_DEADLINE}))
+
+
 class ExchangeInterface:
-    def __init__(self, dry_run=False):
+    def __init__(self, dry_run=False, settings=settings, client=None):
+        """Pass `client` (and that symbol's settings) to trade on an existing connection."""
         self.dry_run = dry_run
-        if len(sys.argv) > 1:
-            self.symbol = sys.argv[1]
-        else:
-            self.symbol = settings.SYMBOL
-        self.bitmex = bitmex.BitMEX(base_url=settings.BASE_URL, symbol=self.symbol, login=settings.LOGIN,
-                                    password=settings.PASSWORD, otpToken=settings.OTPTOKEN, apiKey=settings.API_KEY,
-                                    apiSecret=settings.API_SECRET, orderIDPrefix=settings.ORDERID_PREFIX)
+        self.settings = settings
+        if client is None:
+            if len(sys.argv) > 1:
+                self.symbol = sys.argv[1]
+            elif self.settings.SYMBOLS:
+                self.symbol = self.settings.SYMBOLS[0]
+            else:
+                self.symbol = self.settings.SYMBOL
+            client = connect([self.symbol])
+        self.symbol = client.symbol
+        self.bitmex = client
+        # The client's Portfolio of CONTRACTS, and the list it was got for; see calc_delta().
+        self.deltaEngine = self.deltaContracts = None
 
     def cancel_order(self, order):
         logger.info("Cancelling: %s %d @ %.2f" % (order['side'], order['orderQty'], "@", order['price']))
         while True:
             try:
                 self.bitmex.cancel(order['orderID'])
-                sleep(settings.API_REST_INTERVAL)
+                sleep(self.settings.API_REST_INTERVAL)
             except ValueError as e:
                 logger.info(e)
-                sleep(settings.API_ERROR_INTERVAL)
+                sleep(self.settings.API_ERROR_INTERVAL)
             else:
                 break
 
@@ -55,8 +91,11 @@ class ExchangeInterface:
         logger.info("Resetting current position. Cancelling all existing orders.")
 
         # In certain cases, a WS update might not make it through before we call this.
-        # For that reason, we grab via HTTP to ensure we grab them all.
-        orders = self.bitmex.http_open_orders()
+        # For that reason, we grab via HTTP to ensure we grab them all. At startup, that was done while
+        # connecting, so add any the websocket has seen since.
+        orders = dict((order['orderID'], order) for order in self.bitmex.http_open_orders())
+        orders.update((order['orderID'], order) for order in self.bitmex.open_orders())
+        orders = list(orders.values())
 
         for order in orders:
             logger.info("Cancelling: %s %d @ %.2f" % (order['side'], order['orderQty'], order['price']))
@@ -64,10 +103,14 @@ class ExchangeInterface:
         if len(orders):
             self.bitmex.cancel([order['orderID'] for order in orders])
 
-        sleep(settings.API_REST_INTERVAL)
+            # Wait (up to API_REST_INTERVAL) for the websocket to show them gone, so we don't try to amend them.
+            cancelled = set(order['orderID'] for order in orders)
+            deadline = time() + self.settings.API_REST_INTERVAL
+            while time() < deadline and any(o['orderID'] in cancelled for o in self.bitmex.open_orders()):
+                self.bitmex.wait_for_update(deadline - time())
 
     def get_portfolio(self):
-        contracts = settings.CONTRACTS
+        contracts = self.settings.CONTRACTS
         portfolio = {}
         for symbol in contracts:
             position = self.bitmex.position(symbol=symbol)
@@ -94,6 +137,13 @@ class ExchangeInterface:
 
     def calc_delta(self):
         """Calculate currency delta for portfolio"""
+        # Clients that are told of every position and instrument change keep the delta up to date as they
+        # go; the rest have it worked out here, from a lookup per contract. Reloaded settings are new lists.
+        if self.settings.CONTRACTS is not self.deltaContracts:
+            self.deltaContracts = self.settings.CONTRACTS
+            self.deltaEngine = self.bitmex.portfolio(self.deltaContracts)
+        if self.deltaEngine is not None:
+            return self.deltaEngine.delta()
         portfolio = self.get_portfolio()
         spot_delta = 0
         mark_delta = 0
@@ -125,7 +175,7 @@ class ExchangeInterface:
 
     def get_margin(self):
         if self.dry_run:
-            return {'marginBalance': float(settings.DRY_BTC), 'availableFunds': float(settings.DRY_BTC)}
+            return {'marginBalance': float(self.settings.DRY_BTC), 'availableFunds': float(self.settings.DRY_BTC)}
         return self.bitmex.funds()
 
     def get_orders(self):
@@ -133,15 +183,19 @@ class ExchangeInterface:
             return []
         return self.bitmex.open_orders()
 
-    def get_highest_buy(self):
-        buys = [o for o in self.get_orders() if o['side'] == 'Buy']
+    def get_highest_buy(self, orders=None):
+        if orders is None:
+            orders = self.get_orders()
+        buys = [o for o in orders if o['side'] == 'Buy']
         if not len(buys):
             return {'price': -2**32, 'orderQty':0}
         highest_buy = max(buys or [], key=lambda o: o['price'])
         return highest_buy if highest_buy else {'price': -2**32}
 
-    def get_lowest_sell(self):
-        sells = [o for o in self.get_orders() if o['side'] == 'Sell']
+    def get_lowest_sell(self, orders=None):
+        if orders is None:
+            orders = self.get_orders()
+        sells = [o for o in orders if o['side'] == 'Sell']
         if not len(sells):
             return {'price': 2**32, 'orderQty':0}
         lowest_sell = min(sells or [], key=lambda o: o['price'])
@@ -162,20 +216,58 @@ class ExchangeInterface:
             symbol = self.symbol
         return self.bitmex.market_depth(symbol)
 
+    def last_update(self):
+        """When the latest market or account data for our symbol was received, as Unix time; None if never."""
+        return self.bitmex.last_update(self.symbol)
+
+    def data_seq(self):
+        """A number that changes whenever market or account data for our symbol does; None if the client
+           can't tell."""
+        return self.bitmex.seq(self.symbol)
+
+    def get_snapshot(self):
+        """Read everything the order manager needs for one pass, once."""
+        return Snapshot(self)
+
+    def wait_for_change(self, seq, timeout):
+        """Block until data_seq() moves on from `seq` (one it returned earlier), or `timeout` seconds pass.
+           Returns True if it did. Clients that can't tell (seq None) are always up to date."""
+        deadline = time() + timeout
+        while seq is not None and self.data_seq() == seq:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            self.bitmex.wait_for_update(remaining)
+        return True
+
+    def wait_for_update(self):
+        """Block until market or account data changes, or REQUOTE_MAX_IDLE (default LOOP_INTERVAL) passes."""
+        maxIdle = self.settings.REQUOTE_MAX_IDLE
+        if maxIdle is None:
+            maxIdle = self.settings.LOOP_INTERVAL
+        return self.bitmex.wait_for_update(maxIdle, self.settings.REQUOTE_DEBOUNCE)
+
     def is_open(self):
         """Check that websockets are still open."""
         return not self.bitmex.ws.exited
 
-    def check_market_open(self):
-        instrument = self.get_instrument()
+    def wait_for_connection(self, timeout=None):
+        """Block until market and account data are live, or `timeout` seconds pass. They aren't while the
+           websocket reconnects. Returns True if they are."""
+        return self.bitmex.ws.wait_for_connection(timeout)
+
+    def check_market_open(self, instrument=None):
+        if instrument is None:
+            instrument = self.get_instrument()
         if instrument["state"] != "Open":
             raise errors.MarketClosedError("The instrument %s is not open. State: %s" %
                                            (self.symbol, instrument["state"]))
             sys.exit()
 
-    def check_if_orderbook_empty(self):
+    def check_if_orderbook_empty(self, instrument=None):
         """This function checks whether the order book is empty"""
-        instrument = self.get_instrument()
+        if instrument is None:
+            instrument = self.get_instrument()
         if instrument['midPrice'] is None:
             raise errors.MarketEmptyError("Orderbook is empty, cannot quote")
             sys.exit()
@@ -195,10 +287,66 @@ class ExchangeInterface:
             return orders
         return self.bitmex.cancel([order['orderID'] for order in orders])
 
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in the background. Returns a Future."""
+        return self.bitmex.submit(fn, *args, **kwargs)
+
+    def get_rate_limit_budget(self):
+        """Fraction of the API rate limit left, from 0 to 1."""
+        if self.dry_run:
+            return 1.0
+        return self.bitmex.rate_limit_budget()
+
+
+class Snapshot:
+    """Market and account data for a single pass of the run loop.
+
+    Built once per pass and handed to every step, so each decision is made against the same data
+    and the websocket tables are only scanned once."""
+
+    def __init__(self, exchange):
+        # Read first: if the data changes while we read it, the next pass sees a new seq.
+        self.seq = exchange.data_seq()
+        # When this pass started, and when the newest data it sees came in. For metrics.
+        self.taken = time()
+        self.received = exchange.last_update()
+        self.instrument = exchange.get_instrument()
+        self.ticker = exchange.get_ticker()
+        self.order_book = exchange.market_depth()
+        self.orders = exchange.get_orders()
+        self.highest_buy = exchange.get_highest_buy(self.orders)
+        self.lowest_sell = exchange.get_lowest_sell(self.orders)
+        self.position = exchange.get_position()
+        self.delta = self.position['currentQty']
+        self.margin = exchange.get_margin()
+        self.rate_limit_budget = exchange.get_rate_limit_budget()
+
+    def merge_orders(self, exchange, orders):
+        """Fold in `orders`, as our own requests returned them, ahead of the websocket showing them: open ones
+           it doesn't show yet are added, closed ones are removed."""
+        merged = dict((o['orderID'], o) for o in self.orders)
+        for order in orders:
+            if order.get('leavesQty', 0) > 0 and order.get('ordStatus') not in ('Filled', 'Canceled', 'Rejected'):
+                merged.setdefault(order['orderID'], order)
+            else:
+                merged.pop(order['orderID'], None)
+        self.orders = list(merged.values())
+        self.highest_buy = exchange.get_highest_buy(self.orders)
+        self.lowest_sell = exchange.get_lowest_sell(self.orders)
+
 
 class OrderManager:
-    def __init__(self):
-        self.exchange = ExchangeInterface(settings.DRY_RUN)
+    def __init__(self, settings=settings, exchange=None, settings_symbol=settings_symbol):
+        """`settings_symbol` is the symbol `settings` were assembled for: see settings_for()."""
+        self.settings = settings
+        self.settings_symbol = settings_symbol
+        self.exchange = exchange or ExchangeInterface(self.settings.DRY_RUN, self.settings)
+        self.settings_files = [os.path.abspath(f) for f in settings_files(settings_symbol)]
+        watcher.watch(self.settings_files)
+        self.watched_files = set(self.settings_files + [os.path.abspath(f) for f in self.settings.WATCHED_FILES])
+        self.file_mtimes = watcher.mtimes()
+        # The snapshot our orders were last converged on; if nothing has changed since, a pass is skipped.
+        self.quoted = None
         # Once exchange is created, register exit handler that will always cancel orders
         # on any error.
         atexit.register(self.exit)
@@ -207,7 +355,7 @@ class OrderManager:
         logger.info("Using symbol %s." % self.exchange.symbol)
 
     def init(self):
-        if settings.DRY_RUN:
+        if self.settings.DRY_RUN:
             logger.info("Initializing dry run. Orders printed below represent what would be posted to BitMEX.")
         else:
             logger.info("Order Manager initializing, connecting to BitMEX. Live run: executing real trades.")
@@ -220,71 +368,70 @@ class OrderManager:
 
     def reset(self):
         self.exchange.cancel_all_orders()
-        self.sanity_check()
-        self.print_status()
+        metrics.milestone('orders_cancelled')
+        snapshot = self.exchange.get_snapshot()
+        self.sanity_check(snapshot)
+        self.print_status(snapshot)
 
         # Create orders and converge.
-        self.place_orders()
+        self.place_orders(snapshot)
+        took = metrics.milestone('first_quote', symbol=self.exchange.symbol)
+        logger.info("Quoting %s %.3f s after starting: %s." % (self.exchange.symbol, took, ', '.join(
+            '%s at %.3f s' % (stage, at) for (stage, labels), at in metrics.milestones.items() if not labels)))
 
-        if settings.DRY_RUN:
+        if self.settings.DRY_RUN:
             sys.exit()
 
-    def print_status(self):
+    def print_status(self, snapshot):
         """Print the current MM status."""
 
-        margin = self.exchange.get_margin()
-        position = self.exchange.get_position()
-        self.running_qty = self.exchange.get_delta()
+        margin = snapshot.margin
+        position = snapshot.position
+        self.running_qty = snapshot.delta
         self.start_XBt = margin["marginBalance"]
 
         logger.info("Current XBT Balance: %.6f" % XBt_to_XBT(self.start_XBt))
         logger.info("Current Contract Position: %d" % self.running_qty)
-        if settings.CHECK_POSITION_LIMITS:
-            logger.info("Position limits: %d/%d" % (settings.MIN_POSITION, settings.MAX_POSITION))
+        if self.settings.CHECK_POSITION_LIMITS:
+            logger.info("Position limits: %d/%d" % (self.settings.MIN_POSITION, self.settings.MAX_POSITION))
         if position['currentQty'] != 0:
             logger.info("Avg Cost Price: %.2f" % float(position['avgCostPrice']))
             logger.info("Avg Entry Price: %.2f" % float(position['avgEntryPrice']))
         logger.info("Contracts Traded This Run: %d" % (self.running_qty - self.starting_qty))
         logger.info("Total Contract Delta: %.4f XBT" % self.exchange.calc_delta()['spot'])
 
-    def get_ticker(self):
-        ticker = self.exchange.get_ticker()
-        order_book = sorted(self.exchange.market_depth(), key=itemgetter('level'))
-        highest_buy = self.exchange.get_highest_buy()
-        lowest_sell = self.exchange.get_lowest_sell()
+    def get_ticker(self, snapshot):
+        self.instrument = snapshot.instrument
+        ticker = snapshot.ticker
+        order_book = snapshot.order_book
+        highest_buy = snapshot.highest_buy
+        lowest_sell = snapshot.lowest_sell
 
         # Set up our buy & sell positions as the smallest possible unit above and below the current spread
         # and we'll work out from there. That way we always have the best price but we don't kill wide
         # and potentially profitable spreads.
         buy_start = ticker["buy"]
         sell_start = ticker["sell"]
-        
+
         # If we're maintaining spreads and we already have orders in place,
         # make sure they're not ours. If they are, we need to adjust, otherwise we'll
         # just work the orders inward until they collide.
-        if settings.MAINTAIN_SPREADS:
-            bid_levels = [x["bidSize"] for x in filter(lambda x: x["bidSize"]!=None, order_book)]
-            bid_prices = [x["bidPrice"] for x in filter(lambda x: x["bidPrice"]!=None, order_book)]
-            bid_index = next(x[0] for x in enumerate(np.cumsum(bid_levels)-highest_buy["orderQty"]) if x[1] > settings.MIN_CONTRACTS)
-            buy_start = bid_prices[bid_index]
-            print("Bid Prices: "+str(bid_prices))
-            print("Bid Levels: "+str(bid_levels))
-            print("Bid Index: "+str(bid_index))
-            ask_levels = [x["askSize"] for x in filter(lambda x: x["askSize"]!=None, order_book)]
-            ask_prices = [x["askPrice"] for x in filter(lambda x: x["askPrice"]!=None, order_book)]
-            ask_index = next(x[0] for x in enumerate(np.cumsum(ask_levels)-lowest_sell["orderQty"]) if x[1] > settings.MIN_CONTRACTS)
-            sell_start = ask_prices[ask_index]
-            print("Ask Prices: "+str(ask_prices))
-            print("Ask Levels: "+str(ask_levels))
-            print("Ask Index: "+str(ask_index))
-                
+        # We start at the first level with more than MIN_CONTRACTS in front of it, not counting our own order.
+        if self.settings.MAINTAIN_SPREADS:
+            buy_depth = self.settings.MIN_CONTRACTS + highest_buy["orderQty"]
+            sell_depth = self.settings.MIN_CONTRACTS + lowest_sell["orderQty"]
+            buy_start = order_book.price_at_depth('Buy', buy_depth) or buy_start
+            sell_start = order_book.price_at_depth('Sell', sell_depth) or sell_start
+            logger.debug("Book: Best Bid: %s, Best Ask: %s, Buy Start: %s, Sell Start: %s" %
+                         (order_book.best_bid(), order_book.best_ask(), buy_start, sell_start))
+
         self.start_position_buy = buy_start + self.instrument['tickSize']
         self.start_position_sell = sell_start - self.instrument['tickSize']
 
         # Back off if our spread is too small.
-        if self.start_position_buy * (1.00 + settings.MIN_SPREAD) > self.start_position_sell:
-            self.start_position_buy *= (1.00 - (settings.MIN_SPREAD / 2))
-            self.start_position_sell *= (1.00 + (settings.MIN_SPREAD / 2))
+        if self.start_position_buy * (1.00 + self.settings.MIN_SPREAD) > self.start_position_sell:
+            self.start_position_buy *= (1.00 - (self.settings.MIN_SPREAD / 2))
+            self.start_position_sell *= (1.00 + (self.settings.MIN_SPREAD / 2))
 
         # Midpoint, used for simpler order placement.
         self.start_position_mid = ticker["mid"]
@@ -300,7 +447,7 @@ class OrderManager:
         """Given an index (1, -1, 2, -2, etc.) return the price for that side of the book.
            Negative is a buy, positive is a sell."""
         # Maintain existing spreads for max profit
-        if settings.MAINTAIN_SPREADS:
+        if self.settings.MAINTAIN_SPREADS:
             start_position = self.start_position_buy if index < 0 else self.start_position_sell
             # First positions (index 1, -1) should start right at start_position, others should branch from there
             index = index + 1 if index < 0 else index - 1
@@ -316,161 +463,186 @@ class OrderManager:
             if index < 0 and start_position > self.start_position_sell:
                 start_position = self.start_position_buy
 
-        return round(start_position * (1 + settings.INTERVAL) ** index, self.instrument['tickLog'])
+        price = start_position * (1 + self.settings.INTERVAL) ** index
+        return float(ladder.round_to_tick(price, self.instrument['tickSize'], self.instrument['tickLog']))
 
     ###
     # Orders
     ###
 
-    def place_orders(self):
+    def place_orders(self, snapshot=None):
         """Create order items for use in convergence."""
 
+        if snapshot is None:
+            snapshot = self.exchange.get_snapshot()
+
         buy_orders = []
         sell_orders = []
         # Create orders from the outside in. This is intentional - let's say the inner order gets taken;
         # then we match orders from the outside in, ensuring the fewest number of orders are amended and only
         # a new order is created in the inside. If we did it inside-out, all orders would be amended
         # down and a new order would be created at the outside.
-        if self.enough_liquidity():
-            for i in reversed(range(1, settings.ORDER_PAIRS + 1)):
-                if not self.long_position_limit_exceeded():
-                    buy_orders.append(self.prepare_order(-i))
-                if not self.short_position_limit_exceeded():
-                    sell_orders.append(self.prepare_order(i))
-
-        return self.converge_orders(buy_orders, sell_orders)
+        # The whole ladder is built in one vectorized pass; prepare_order() is the per-level equivalent.
+        if self.enough_liquidity(snapshot):
+            random_size = None
+            if self.settings.RANDOM_ORDER_SIZE is True:
+                random_size = (self.settings.MIN_ORDER_SIZE, self.settings.MAX_ORDER_SIZE)
+            buy_orders, sell_orders = ladder.build_ladder(
+                self.start_position_buy, self.start_position_sell, self.get_order_pairs(snapshot),
+                self.settings.INTERVAL, self.instrument['tickSize'], self.instrument['tickLog'],
+                maintain_spreads=self.settings.MAINTAIN_SPREADS, random_size=random_size,
+                start_size=self.settings.ORDER_START_SIZE, step_size=self.settings.ORDER_STEP_SIZE,
+                quote_buys=not self.long_position_limit_exceeded(snapshot),
+                quote_sells=not self.short_position_limit_exceeded(snapshot))
+
+        return self.converge_orders(buy_orders, sell_orders, snapshot)
+
+    def get_order_pairs(self, snapshot):
+        """How many order pairs to quote. Fewer when we're running out of API rate limit, so amending
+           the ladder doesn't lock us out of the API entirely."""
+        budget = snapshot.rate_limit_budget
+        if budget >= self.settings.RATE_LIMIT_LOW_BUDGET:
+            return self.settings.ORDER_PAIRS
+        pairs = max(1, int(self.settings.ORDER_PAIRS * budget / self.settings.RATE_LIMIT_LOW_BUDGET))
+        logger.info("Only %d%% of the API rate limit left, quoting %d order pairs." % (budget * 100, pairs))
+        return pairs
 
     def prepare_order(self, index):
         """Create an order object."""
 
-        if settings.RANDOM_ORDER_SIZE is True:
-            quantity = random.randint(settings.MIN_ORDER_SIZE, settings.MAX_ORDER_SIZE)
+        if self.settings.RANDOM_ORDER_SIZE is True:
+            quantity = random.randint(self.settings.MIN_ORDER_SIZE, self.settings.MAX_ORDER_SIZE)
         else:
-            quantity = settings.ORDER_START_SIZE + ((abs(index) - 1) * settings.ORDER_STEP_SIZE)
+            quantity = self.settings.ORDER_START_SIZE + ((abs(index) - 1) * self.settings.ORDER_STEP_SIZE)
 
         price = self.get_price_offset(index)
 
         return {'price': price, 'orderQty': quantity, 'side': "Buy" if index < 0 else "Sell"}
 
-    def converge_orders(self, buy_orders, sell_orders):
+    def converge_orders(self, buy_orders, sell_orders, snapshot):
         """Converge the orders we currently have in the book with what we want to be in the book.
            This involves amending any open orders and creating new ones if any have filled completely.
-           We start from the closest orders outward."""
-
-        tickLog = self.exchange.get_instrument()['tickLog']
-        to_amend = []
-        to_create = []
-        to_cancel = []
-        buys_matched = 0
-        sells_matched = 0
-        existing_orders = self.exchange.get_orders()
-
-        # Check all existing orders and match them up with what we want to place.
-        # If there's an open one, we might be able to amend it to fit what we want.
-        for order in existing_orders:
-            try:
-                if order['side'] == 'Buy':
-                    desired_order = buy_orders[buys_matched]
-                    buys_matched += 1
-                else:
-                    desired_order = sell_orders[sells_matched]
-                    sells_matched += 1
-
-                # Found an existing order. Do we need to amend it?
-                if desired_order['orderQty'] != order['leavesQty'] or (
-                        # If price has changed, and the change is more than our RELIST_INTERVAL, amend.
-                        desired_order['price'] != order['price'] and
-                        abs((desired_order['price'] / order['price']) - 1) > settings.RELIST_INTERVAL):
-                    to_amend.append({'orderID': order['orderID'], 'leavesQty': desired_order['orderQty'],
-                                     'price': desired_order['price'], 'side': order['side']})
-            except IndexError:
-                # Will throw if there isn't a desired order to match. In that case, cancel it.
-                to_cancel.append(order)
-
-        while buys_matched < len(buy_orders):
-            to_create.append(buy_orders[buys_matched])
-            buys_matched += 1
-
-        while sells_matched < len(sell_orders):
-            to_create.append(sell_orders[sells_matched])
-            sells_matched += 1
-
+           Orders are matched by side and price; see reconcile.py."""
+
+        tickLog = snapshot.instrument['tickLog']
+        existing_orders = snapshot.orders
+
+        # Match existing orders up with what we want to place. Where there's an open one close to what
+        # we want, we keep or amend it rather than cancelling and creating.
+        result = reconcile.reconcile(buy_orders, sell_orders, existing_orders, self.settings.RELIST_INTERVAL)
+        to_amend = result.to_amend
+        to_create = result.to_create
+        to_cancel = result.to_cancel
+        symbol = self.exchange.symbol
+        metrics.decided(symbol, snapshot.received, snapshot.taken, time())
+        metrics.inc('orders_amended_total', len(to_amend), symbol=symbol)
+        metrics.inc('orders_created_total', len(to_create), symbol=symbol)
+        metrics.inc('orders_cancelled_total', len(to_cancel), symbol=symbol)
+        if result.order_changes() > 0:
+            logger.info("Converging: %d amends, %d creates, %d cancels, %d unchanged. "
+                        "Saved %d order changes over cancel/replace." %
+                        (len(to_amend), len(to_create), len(to_cancel), result.unchanged,
+                         result.saved(len(buy_orders) + len(sell_orders))))
+
+        # Amends, creates and cancels don't depend on each other, so they go out at the same time
+        # over the connection pool. We then wait for all of them.
+        amend = create = cancel = None
         if len(to_amend) > 0:
             for amended_order in reversed(to_amend):
-                reference_order = [o for o in existing_orders if o['orderID'] == amended_order['orderID']][0]
+                reference_order = result.live[amended_order['orderID']]
                 logger.info("Amending %4s: %d @ %.*f to %d @ %.*f (%+.*f)" % (
                     amended_order['side'],
                     reference_order['leavesQty'], tickLog, reference_order['price'],
                     amended_order['leavesQty'], tickLog, amended_order['price'],
                     tickLog, (amended_order['price'] - reference_order['price'])
                 ))
-            # This can fail if an order has closed in the time we were processing.
-            # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
-            # made it not amendable.
-            # If that happens, we need to catch it and re-tick.
-            try:
-                self.exchange.amend_bulk_orders(to_amend)
-            except requests.exceptions.HTTPError as e:
-                errorObj = e.response.json()
-                if errorObj['error']['message'] == 'Invalid ordStatus':
-                    logger.warn("Amending failed. Waiting for order data to converge and retrying.")
-                    sleep(0.5)
-                    return self.place_orders()
-                else:
-                    logger.error("Unknown error on amend: %s. Exiting" % errorObj)
-                    sys.exit(1)
+                log.event('amend', symbol=symbol, orderID=amended_order['orderID'], side=amended_order['side'],
+                          fromQty=reference_order['leavesQty'], fromPrice=reference_order['price'],
+                          qty=amended_order['leavesQty'], price=amended_order['price'])
+            amend = self.exchange.submit(self.exchange.amend_bulk_orders, to_amend)
 
         if len(to_create) > 0:
             logger.info("Creating %d orders:" % (len(to_create)))
             for order in reversed(to_create):
                 logger.info("%4s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
-            self.exchange.create_bulk_orders(to_create)
+                log.event('create', symbol=symbol, side=order['side'], qty=order['orderQty'], price=order['price'])
+            create = self.exchange.submit(self.exchange.create_bulk_orders, to_create)
 
         # Could happen if we exceed a delta limit
         if len(to_cancel) > 0:
             logger.info("Canceling %d orders:" % (len(to_cancel)))
             for order in reversed(to_cancel):
                 logger.info("%4s %d @ %.*f" % (order['side'], order['leavesQty'], tickLog, order['price']))
-            self.exchange.cancel_bulk_orders(to_cancel)
+                log.event('cancel', symbol=symbol, orderID=order['orderID'], side=order['side'],
+                          qty=order['leavesQty'], price=order['price'])
+            cancel = self.exchange.submit(self.exchange.cancel_bulk_orders, to_cancel)
+
+        # What our creates and cancels returned. The websocket can take a while to show them.
+        sent = []
+        for request in (create, cancel):
+            if request:
+                sent.extend(request.result() or [])
+
+        if amend:
+            # This can fail if an order has closed in the time we were processing.
+            # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
+            # made it not amendable.
+            # If that happens, we need to catch it and re-tick.
+            try:
+                amend.result()
+            except requests.exceptions.HTTPError as e:
+                errorObj = e.response.json()
+                if errorObj['error']['message'] == 'Invalid ordStatus':
+                    # An order closed after our snapshot; wait for the websocket to tell us, then requote. Our
+                    # creates and cancels may not be on it yet: fold them in, or we'd place the same orders twice.
+                    logger.warning("Amending failed. Waiting for order data to converge and retrying.")
+                    self.exchange.wait_for_change(snapshot.seq, self.settings.LOOP_INTERVAL)
+                    retry = self.exchange.get_snapshot()
+                    retry.merge_orders(self.exchange, sent)
+                    return self.place_orders(retry)
+                else:
+                    logger.error("Unknown error on amend: %s. Exiting" % errorObj)
+                    sys.exit(1)
+            except errors.RetriesExhaustedError as e:
+                # Prices have moved on by now anyway. Re-tick on fresh data.
+                logger.warning("Amending failed: %s. Will retry on the next pass." % e)
+                self.quoted = None  # Even if nothing else changes
 
     ###
     # Position Limits
     ###
 
-    def short_position_limit_exceeded(self):
+    def short_position_limit_exceeded(self, snapshot):
         "Returns True if the short position limit is exceeded"
-        if not settings.CHECK_POSITION_LIMITS:
+        if not self.settings.CHECK_POSITION_LIMITS:
             return False
-        position = self.exchange.get_delta()
-        return position <= settings.MIN_POSITION
+        return snapshot.delta <= self.settings.MIN_POSITION
 
-    def long_position_limit_exceeded(self):
+    def long_position_limit_exceeded(self, snapshot):
         "Returns True if the long position limit is exceeded"
-        if not settings.CHECK_POSITION_LIMITS:
+        if not self.settings.CHECK_POSITION_LIMITS:
             return False
-        position = self.exchange.get_delta()
-        return position >= settings.MAX_POSITION
+        return snapshot.delta >= self.settings.MAX_POSITION
 
     ###
     # Liquidity
     ##
-    def enough_liquidity(self):
+    def enough_liquidity(self, snapshot):
         "Returns true if there is enough liquidity on each side of the order book"
         enough_liquidity = False
-        ticker = self.exchange.get_ticker()
-        order_book = self.exchange.market_depth()
-        highest_buy = self.exchange.get_highest_buy()
-        lowest_sell = self.exchange.get_lowest_sell()
+        order_book = snapshot.order_book
+        highest_buy = snapshot.highest_buy
+        lowest_sell = snapshot.lowest_sell
 
-        bid_depth = sum([x["bidSize"] for x in filter(lambda x: x["bidSize"]!=None, order_book)])
-        ask_depth = sum([x["askSize"] for x in filter(lambda x: x["askSize"]!=None, order_book)])
+        bid_depth = order_book.total_depth('Buy')
+        ask_depth = order_book.total_depth('Sell')
 
         bid_liquid = bid_depth - highest_buy["orderQty"]
         logger.info("Bid Liquidity: "+str(bid_liquid)+" Contracts")
         ask_liquid = ask_depth - lowest_sell["orderQty"]
         logger.info("Ask Liquidity: "+str(ask_liquid)+" Contracts")
-        enough_ask_liquidity = ask_liquid >= settings.MIN_CONTRACTS
-        enough_bid_liquidity = bid_liquid >= settings.MIN_CONTRACTS
+        enough_ask_liquidity = ask_liquid >= self.settings.MIN_CONTRACTS
+        enough_bid_liquidity = bid_liquid >= self.settings.MIN_CONTRACTS
         enough_liquidity = (enough_ask_liquidity and enough_bid_liquidity)
         if not enough_liquidity:
             if (not enough_bid_liquidity) and (not enough_ask_liquidity):
@@ -485,17 +657,17 @@ class OrderManager:
     # Sanity
     ##
 
-    def sanity_check(self):
+    def sanity_check(self, snapshot):
         """Perform checks before placing orders."""
 
         # Check if OB is empty - if so, can't quote.
-        self.exchange.check_if_orderbook_empty()
+        self.exchange.check_if_orderbook_empty(snapshot.instrument)
 
         # Ensure market is still open.
-        self.exchange.check_market_open()
+        self.exchange.check_market_open(snapshot.instrument)
 
         # Get ticker, which sets price offsets and prints some debugging info.
-        ticker = self.get_ticker()
+        ticker = self.get_ticker(snapshot)
 
         # Sanity check:
         if self.get_price_offset(-1) >= ticker["sell"] or self.get_price_offset(1) <= ticker["buy"]:
@@ -505,25 +677,61 @@ class OrderManager:
             sys.exit()
 
         # Messanging if the position limits are reached
-        if self.long_position_limit_exceeded():
+        if self.long_position_limit_exceeded(snapshot):
             logger.info("Long delta limit exceeded")
             logger.info("Current Position: %.f, Maximum Position: %.f" %
-                        (self.exchange.get_delta(), settings.MAX_POSITION))
+                        (snapshot.delta, self.settings.MAX_POSITION))
 
-        if self.short_position_limit_exceeded():
+        if self.short_position_limit_exceeded(snapshot):
             logger.info("Short delta limit exceeded")
             logger.info("Current Position: %.f, Minimum Position: %.f" %
-                        (self.exchange.get_delta(), settings.MIN_POSITION))
+                        (snapshot.delta, self.settings.MIN_POSITION))
 
     ###
     # Running
     ###
 
     def check_file_change(self):
-        """Restart if any files we're watching have changed."""
-        for f, mtime in watched_files_mtimes:
-            if getmtime(f) > mtime:
-                self.restart()
+        """Reload settings if they've changed. Restart if any other files we're watching have."""
+        mtimes = watcher.mtimes()
+        changed = set(f for f in self.watched_files if mtimes.get(f) != self.file_mtimes.get(f))
+        if not changed:
+            return
+        self.file_mtimes = mtimes
+        if changed - set(self.settings_files):
+            self.restart()
+        self.reload_settings()
+
+    def reload_settings(self):
+        """Apply changed settings in place, keeping our connections, data and orders. Settings only used at
+           startup (RESTART_SETTINGS) restart the bot instead."""
+        try:
+            new = reload_settings(self.settings_symbol)
+        except Exception:
+            logger.error("Settings changed but couldn't be read; keeping the old ones.\n%s" % traceback.format_exc())
+            return
+        changed = sorted(name for name in set(new) | set(self.settings)
+                         if name.isupper() and new.get(name) != self.settings.get(name))
+        if not changed:
+            return
+        if RESTART_SETTINGS.intersection(changed):
+            logger.info("%s changed." % ', '.join(sorted(RESTART_SETTINGS.intersection(changed))))
+            self.restart()
+        problem = self.check_settings(new)
+        if problem:
+            logger.error("Not applying the changed settings for %s: %s" % (self.exchange.symbol, problem))
+            return
+        # Update in place: everything holding these settings sees the new values.
+        self.settings.update(new)
+        for name in set(self.settings) - set(new):
+            del self.settings[name]
+        logger.info("Reloaded settings for %s: %s" % (
+            self.exchange.symbol, ', '.join('%s = %r' % (name, new.get(name)) for name in changed)))
+        logger.setLevel(self.settings.LOG_LEVEL)
+
+    def check_settings(self, new):
+        """Why settings `new` can't be applied without restarting, or None if they can."""
+        return None
 
     def check_connection(self):
         """Ensure the WS connections are still open."""
@@ -532,6 +740,8 @@ class OrderManager:
     def exit(self):
         logger.info("Shutting down. All open orders will be cancelled.")
         try:
+            if not self.exchange.dry_run:
+                logger.info("REST requests: %s" % self.exchange.bitmex.retry_stats())
             self.exchange.cancel_all_orders()
             self.exchange.bitmex.ws.exit()
         except errors.AuthenticationError as e:
@@ -541,24 +751,64 @@ class OrderManager:
 
     def run_loop(self):
         while True:
-            sys.stdout.write("-----\n")
-            sys.stdout.flush()
+            logger.info("-----")
 
             self.check_file_change()
-            sleep(settings.LOOP_INTERVAL)
+            self.wait_for_requote()
 
-            # This will restart on very short downtime, but if it's longer,
+            # The websocket reconnects by itself. Only if it gives up do we restart; if it's down for longer,
             # the MM will crash entirely as it is unable to connect to the WS on boot.
             if not self.check_connection():
                 logger.error("Realtime data connection unexpectedly closed, restarting.")
                 self.restart()
-
-            self.sanity_check()  # Ensures health of mm - several cut-out points here
-            self.print_status()  # Print skew, delta, etc
-            self.place_orders()  # Creates desired orders and converges to existing orders
+            if not self.exchange.wait_for_connection(0):
+                self.wait_for_reconnect()
+                continue
+
+            snapshot = self.exchange.get_snapshot()
+            if self.unchanged_since_quoted(snapshot):
+                logger.debug("Nothing has changed since the last pass. Skipping this one.")
+                continue
+            self.run_once(snapshot)
+
+    def unchanged_since_quoted(self, snapshot):
+        """True if nothing a pass would read has changed since our orders were last converged, so it would
+           decide the same again. The rate limit budget only matters once it's low enough to cut the ladder."""
+        quoted = self.quoted
+        if quoted is None or snapshot.seq is None or snapshot.seq != quoted.seq:
+            return False
+        low = self.settings.RATE_LIMIT_LOW_BUDGET
+        return min(snapshot.rate_limit_budget, low) == min(quoted.rate_limit_budget, low)
+
+    def run_once(self, snapshot=None):
+        """One pass of the run loop. The backtester calls this directly, on recorded time."""
+        if snapshot is None:
+            snapshot = self.exchange.get_snapshot()  # Read market & account data once for this pass
+        self.sanity_check(snapshot)  # Ensures health of mm - several cut-out points here
+        self.print_status(snapshot)  # Print skew, delta, etc
+        self.quoted = snapshot
+        self.place_orders(snapshot)  # Creates desired orders and converges to existing orders
+
+    def wait_for_reconnect(self):
+        """Pause quoting while the websocket reconnects. Our orders stay in the book; the first pass after
+           reconnecting reconciles them against the rebuilt order table."""
+        logger.warning("Realtime data connection lost. Quoting paused until it's back.")
+        paused = time()
+        while self.check_connection() and not self.exchange.wait_for_connection(1):
+            pass
+        if self.check_connection():
+            logger.info("Realtime data is back after %.3f s. Resuming quoting." % (time() - paused))
+
+    def wait_for_requote(self):
+        """Wait until it's time for the next pass. Either on a fixed timer, or as soon as data changes."""
+        if self.settings.REQUOTE_ON_UPDATE:
+            self.exchange.wait_for_update()
+        else:
+            sleep(self.settings.LOOP_INTERVAL)
 
     def restart(self):
         logger.info("Restarting the market maker...")
+        log.flush()
         os.execv(sys.executable, [sys.executable] + sys.argv)
 
 #
@@ -580,9 +830,79 @@ def margin(instrument, quantity, price):
     return cost(instrument, quantity, price) * instrument["initMargin"]
 
 
+class OrderManagerHost:
+    """Market makes several symbols from one process.
+
+    Each symbol gets its own OrderManager, with its own settings-<SYMBOL>.py overrides, running in its own
+    thread. They all share one websocket connection, one HTTP connection pool and one rate limit, so adding
+    an instrument costs a thread and its order book rather than a process and a connection.
+    """
+
+    # Subclasses can run a different OrderManager.
+    order_manager = OrderManager
+
+    def __init__(self, symbols, client=None):
+        """Connects to BitMEX for all `symbols`, unless given a `client` to share."""
+        self.symbols = symbols
+        client = client or connect(symbols)
+        self.order_managers = []
+        for symbol in symbols:
+            symbol_settings = settings_for(symbol)
+            exchange = ExchangeInterface(symbol_settings.DRY_RUN, symbol_settings, client.for_symbol(symbol))
+            self.order_managers.append(self.order_manager(symbol_settings, exchange, symbol))
+        self.failed = threading.Event()
+
+    def run(self):
+        threads = []
+        for om in self.order_managers:
+            thread = threading.Thread(target=self.run_order_manager, args=(om,), name=om.exchange.symbol)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # If one symbol's loop dies, stop them all; exiting cancels every symbol's orders.
+        while not self.failed.wait(1):
+            if not any(thread.is_alive() for thread in threads):
+                return
+        logger.error("A quoting loop stopped unexpectedly. Shutting down.")
+        sys.exit(1)
+
+    def run_order_manager(self, om):
+        try:
+            om.init()
+            om.run_loop()
+        except SystemExit:
+            # Dry runs exit after placing orders once.
+            if not om.settings.DRY_RUN:
+                self.failed.set()
+        except Exception:
+            logger.error("%s: %s" % (om.exchange.symbol, traceback.format_exc()))
+            self.failed.set()
+
+
 def run():
+    metrics.milestone('imported')
     logger.info('BitMEX Market Maker Version: %s\n' % constants.VERSION)
 
+    symbols = sys.argv[1:] or settings.SYMBOLS
+    sharded = len(symbols) > 1 and settings.QUOTING_PROCESSES > 1
+    if settings.METRICS_PORT and not sharded:  # Sharded processes serve their own
+        metrics.serve(settings.METRICS_PORT)
+    if sharded:
+        from market_maker import sharding
+        try:
+            sharding.run(symbols, settings.QUOTING_PROCESSES)
+        except (KeyboardInterrupt, SystemExit):
+            sys.exit()
+        return
+    if len(symbols) > 1:
+        host = OrderManagerHost(symbols)
+        try:
+            host.run()
+        except (KeyboardInterrupt, SystemExit):
+            sys.exit()
+        return
+
     om = OrderManager()
     # Try/except just keeps ctrl-c from printing an ugly stacktrace
     try:
@@ -0,0 +1,199 @@
+"""Portfolio delta, kept up to date as positions and prices change.
+
+Each contract in a portfolio is one entry of a few NumPy columns: position, multiplier, spot and mark
+price, and whether it is quanto or inverse. Position and instrument updates overwrite the entries of the
+contracts they touch and recompute just those contracts' delta, and the totals move by the difference, so
+reading the delta costs the same however many contracts we hold. Loads and updates touching many contracts
+compute the quanto and inverse deltas of all of them in a few NumPy operations. The totals are summed afresh
+every so often, so rounding error can't build up.
+
+Updates must come from one thread at a time (the websocket's); any thread can read.
+"""
+from __future__ import absolute_import
+import logging
+from math import isinf, isnan
+from market_maker.utils import lazy, log
+from market_maker.utils.metrics import metrics
+
+np = lazy.module('numpy', globals(), 'np')
+
+logger = logging.getLogger('root')
+
+# Sum the totals from scratch after this many updates.
+RESUM_INTERVAL = 1000
+
+# Recompute this many changed contracts or more with NumPy, fewer one at a time. Each NumPy operation has
+# a fixed cost of about a microsecond, more than the arithmetic for a contract or two.
+VECTOR_MIN = 8
+
+
+class Portfolio(object):
+
+    """The currency delta of a list of contracts: spot (at the indicative settle price), mark and basis.
+       Matches ExchangeInterface.get_portfolio() and calc_delta(), without looking anything up."""
+
+    def __init__(self, symbols):
+        self.symbols = list(symbols)
+        self.index = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        self.watches = []  # [limit, callback, over]; see watch()
+        # (spot, mark), replaced whole so readers on other threads never see half an update.
+        self.totals = (0.0, 0.0)
+        self.__clear()
+        self.error = self.__error()
+
+    def load(self, instruments, positions):
+        """Start over from these instrument and position rows, forgetting any others: after a reconnect, say.
+           The delta goes straight from the old rows' to the new ones'."""
+        self.__clear()
+        self.__set_instruments(instruments)
+        self.__set_positions(positions)
+        self.error = self.__error()
+        self.__recompute(range(len(self.symbols)), resum=True)
+
+    def update_instruments(self, rows):
+        """Take in instrument rows (whole rows, as the table holds them). Rows for other symbols are ignored."""
+        changed = self.__set_instruments(rows)
+        if changed:
+            self.__recompute(changed)
+
+    def update_positions(self, rows):
+        """Take in position rows. Rows for other symbols are ignored."""
+        changed = self.__set_positions(rows)
+        if changed:
+            self.__recompute(changed)
+
+    def delta(self):
+        """{'spot', 'mark_price', 'basis'} delta, in XBT, as of the latest update."""
+        if self.error:
+            raise self.error
+        return _delta(self.totals)
+
+    def watch(self, limit, callback=None):
+        """Log (and record an event, and call `callback(delta)`) whenever the absolute spot delta goes over
+           `limit`, and again when it comes back under. Runs on the updating thread, so keep callbacks quick."""
+        self.watches.append([limit, callback, abs(self.totals[0]) > limit])
+
+    def __clear(self):
+        n = len(self.symbols)
+        self.qty = np.zeros(n)
+        self.multiplier = np.full(n, np.nan)
+        self.prices = np.full((2, n), np.nan)  # Spot (indicative settle) and mark prices
+        self.listed = np.zeros(n, dtype=bool)  # Have an instrument row
+        self.quanto = np.zeros(n, dtype=bool)
+        self.inverse = np.zeros(n, dtype=bool)
+        self.deltas = np.zeros((2, n))  # Each contract's share of the spot and mark totals
+        self.updates = 0
+
+    def __set_instruments(self, rows):
+        """Copy in instrument rows for our contracts. Returns the indexes of those that changed."""
+        changed = {}
+        for row in rows:
+            i = self.index.get(row['symbol'])
+            if i is not None:
+                changed[i] = row
+        retyped = False
+        for i, row in changed.items():
+            self.multiplier[i] = _ratio(row.get('multiplier'), row.get('underlyingToSettleMultiplier'))
+            self.prices[0, i] = _ratio(row.get('indicativeSettlePrice'), 1)
+            self.prices[1, i] = _ratio(row.get('markPrice'), 1)
+            quanto, inverse = bool(row.get('isQuanto')), bool(row.get('isInverse'))
+            if not self.listed[i] or quanto != self.quanto[i] or inverse != self.inverse[i]:
+                self.quanto[i], self.inverse[i], self.listed[i] = quanto, inverse, True
+                retyped = True
+        if retyped:
+            self.error = self.__error()
+        return list(changed)
+
+    def __set_positions(self, rows):
+        """Copy in position rows for our contracts. Returns the indexes of those that changed."""
+        changed = {}
+        for row in rows:
+            i = self.index.get(row['symbol'])
+            if i is not None:
+                changed[i] = row
+        for i, row in changed.items():
+            self.qty[i] = row.get('currentQty') or 0
+        return list(changed)
+
+    def __recompute(self, changed, resum=False):
+        """Recompute the delta of contracts `changed` (indexes), and the totals with them: by the change in
+           those contracts' delta, or by summing every contract's if `resum`."""
+        spot, mark = self.totals
+        if len(changed) >= VECTOR_MIN:
+            i = np.array(changed, dtype=int)
+            qty, multiplier, prices = self.qty[i], self.multiplier[i], self.prices[:, i]
+            # Spot and mark at once. Contracts neither quanto nor inverse come out as inverse, but then
+            # delta() raises anyway. Missing (and zero) prices are NaN, which doesn't warn the way dividing by
+            # zero does.
+            deltas = np.where(self.quanto[i], qty * multiplier * prices, multiplier / prices * qty)
+            # Without a position, a contract adds nothing, even if its prices are missing.
+            deltas[:, qty == 0] = 0.0
+            change = (deltas.sum(axis=1) - self.deltas[:, i].sum(axis=1)).tolist()
+            self.deltas[:, i] = deltas
+            spot += change[0]
+            mark += change[1]
+        else:
+            for i in changed:
+                qty = self.qty[i]
+                if not qty:
+                    spotDelta = markDelta = 0.0
+                elif self.quanto[i]:
+                    spotDelta = float(qty * self.multiplier[i] * self.prices[0, i])
+                    markDelta = float(qty * self.multiplier[i] * self.prices[1, i])
+                else:
+                    spotDelta = float(self.multiplier[i] / self.prices[0, i] * qty)
+                    markDelta = float(self.multiplier[i] / self.prices[1, i] * qty)
+                spot += spotDelta - self.deltas[0, i]
+                mark += markDelta - self.deltas[1, i]
+                self.deltas[0, i] = spotDelta
+                self.deltas[1, i] = markDelta
+        self.updates += 1
+        totals = (float(spot), float(mark))
+        # NaN doesn't subtract back out; start over rather than carry it.
+        if resum or self.updates % RESUM_INTERVAL == 0 or not all(_finite(total) for total in totals):
+            totals = tuple(self.deltas.sum(axis=1).tolist())
+        self.totals = totals
+        if self.watches:
+            self.__check(totals)
+
+    def __check(self, totals):
+        spot = totals[0]
+        for watch in self.watches:
+            limit, callback, over = watch
+            if (abs(spot) > limit) == over:
+                continue
+            watch[2] = not over
+            if not over:
+                logger.warning("Portfolio delta is %.4f XBT, over the %.4f XBT threshold." % (spot, limit))
+            else:
+                logger.info("Portfolio delta is back to %.4f XBT, under the %.4f XBT threshold." % (spot, limit))
+            log.event('delta_threshold', spot=spot, limit=limit, over=not over)
+            metrics.inc('delta_threshold_crossings_total')
+            if callback:
+                callback(_delta(totals))
+
+    def __error(self):
+        """What delta() should raise, given the instruments we have: None if we can compute it."""
+        missing = np.flatnonzero(~self.listed)
+        if len(missing):
+            return Exception("Unable to find instrument or index with symbol: " + self.symbols[missing[0]])
+        unknown = np.flatnonzero(~(self.quanto | self.inverse))
+        if len(unknown):
+            return NotImplementedError("Unknown future type; not quanto or inverse: %s" % self.symbols[unknown[0]])
+        return None
+
+
+def _delta(totals):
+    spot, mark = totals
+    return {"spot": spot, "mark_price": mark, "basis": mark - spot}
+
+
+def _finite(value):
+    return not (isnan(value) or isinf(value))
+
+
+def _ratio(value, divisor):
+    """value / divisor, or NaN if either is missing or zero."""
+    if not value or not divisor:
+        return np.nan
+    return float(value) / float(divisor)
@@ -0,0 +1,90 @@
+"""Reconcile the orders we want in the book with the orders we have there.
+
+Orders are matched per side by price, in O(n log n), independent of the order the exchange happens to
+list them in:
+
+1. Live orders already within RELIST_INTERVAL of a desired price are kept. If only the size is off,
+   the order is amended. Shrinking an order keeps its place in the queue, so we leave its price alone
+   in that case.
+2. The remaining live orders are re-priced onto the remaining desired levels, from the outside in.
+   This way, when an inner order is taken, only a new inner order is created.
+3. Anything left over is created (desired) or cancelled (live).
+"""
+from __future__ import absolute_import
+
+
+class Reconciliation(object):
+
+    def __init__(self):
+        self.to_amend = []
+        self.to_create = []
+        self.to_cancel = []
+        self.unchanged = 0
+        # Live orders by orderID, for reporting what an amend changed.
+        self.live = {}
+
+    def order_changes(self):
+        return len(self.to_amend) + len(self.to_create) + len(self.to_cancel)
+
+    def saved(self, desired_count):
+        """Order changes avoided, compared to cancelling every live order and creating every desired one."""
+        return len(self.live) + desired_count - self.order_changes()
+
+
+def reconcile(buy_orders, sell_orders, live_orders, relist_interval):
+    """Diff desired orders against live ones. Returns a Reconciliation."""
+    result = Reconciliation()
+    for order in live_orders:
+        result.live[order['orderID']] = order
+
+    for side, desired in (('Buy', buy_orders), ('Sell', sell_orders)):
+        live = [o for o in live_orders if o['side'] == side]
+        _reconcile_side(side, desired, live, relist_interval, result)
+    return result
+
+
+def _reconcile_side(side, desired, live, relist_interval, result):
+    desired = sorted(desired, key=lambda o: o['price'])
+    live = sorted(live, key=lambda o: o['price'])
+
+    # 1. Keep live orders that are close enough to a desired price. Both lists are sorted, so one merge pass.
+    unmatched_desired = []
+    unmatched_live = []
+    i = j = 0
+    while i < len(desired) and j < len(live):
+        want, have = desired[i], live[j]
+        if abs((want['price'] / have['price']) - 1) <= relist_interval:
+            if want['orderQty'] == have['leavesQty']:
+                result.unchanged += 1
+            elif want['orderQty'] < have['leavesQty']:
+                # Size down only: keeps queue priority.
+                result.to_amend.append(_amend(have, want['orderQty'], have['price']))
+            else:
+                # Growing an order loses priority anyway, so move it to the desired price too.
+                result.to_amend.append(_amend(have, want['orderQty'], want['price']))
+            i += 1
+            j += 1
+        elif want['price'] < have['price']:
+            unmatched_desired.append(want)
+            i += 1
+        else:
+            unmatched_live.append(have)
+            j += 1
+    unmatched_desired += desired[i:]
+    unmatched_live += live[j:]
+
+    # 2. Re-price leftovers from the outside in: lowest buys first, highest sells first.
+    if side == 'Sell':
+        unmatched_desired.reverse()
+        unmatched_live.reverse()
+    for want, have in zip(unmatched_desired, unmatched_live):
+        result.to_amend.append(_amend(have, want['orderQty'], want['price']))
+
+    # 3. Whatever is left over on one side or the other.
+    matched = min(len(unmatched_desired), len(unmatched_live))
+    result.to_create += unmatched_desired[matched:]
+    result.to_cancel += unmatched_live[matched:]
+
+
+def _amend(order, leavesQty, price):
+    return {'orderID': order['orderID'], 'leavesQty': leavesQty, 'price': price, 'side': order['side']}
@@ -0,0 +1,50 @@
+"""Record raw websocket messages to disk, and read recordings back.
+
+A recording is a gzip file with one line per message: the time it was received (Unix seconds) and the
+message exactly as it came off the socket, separated by a space. Files are only ever appended to; each
+run adds a new gzip member, which gzip readers treat as one continuous stream.
+
+Messages are compressed and written by a background thread, so recording costs the websocket thread a
+queue put per message.
+"""
+from __future__ import absolute_import
+import gzip
+import logging
+import time
+import zlib
+from market_maker.utils.appender import Appender
+
+logger = logging.getLogger('root')
+
+
+class Recorder(Appender):
+
+    """Appends messages to `path`. strftime patterns in the path, in UTC, start a new file when they change."""
+
+    def __init__(self, path):
+        Appender.__init__(self, path, what='websocket messages', name='recorder')
+
+    def record(self, message):
+        self.append(time.time(), message)
+
+    def encode(self, received, message):
+        return '%.6f %s\n' % (received, message)
+
+    def open(self, filename):
+        # Each batch ends with a sync flush, so everything written so far can be decompressed.
+        return gzip.open(filename, 'ab')
+
+
+def read_recording(paths):
+    """Yield (received, message) from recordings, file by file. A file cut short (say, by a crash while
+       recording) is read up to the last complete message."""
+    for path in paths:
+        with gzip.open(path, 'rb') as f:
+            try:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    received, _, message = line.partition(b' ')
+                    yield float(received), message[:-1].decode('utf-8')
+            except (EOFError, zlib.error):
+                logger.warning("%s ends part way through a message; replaying up to there." % path)
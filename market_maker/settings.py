@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import os
 import sys
+import threading
 from market_maker.utils.dotdict import dotdict
 import market_maker._settings_base as baseSettings
 from imp import reload
@@ -19,22 +20,52 @@ def import_path(fullpath):
     del sys.path[0]
     return module
 
+
+def settings_for(symbol=None):
+    """Assemble settings for a symbol: the defaults, overridden by settings.py, overridden by
+       settings-<symbol>.py if there is one."""
+    symbolSettings = None
+    if symbol:
+        print("Importing symbol settings for %s..." % symbol)
+        try:
+            symbolSettings = import_path(os.path.join('..', 'settings-%s' % symbol))
+        except Exception as e:
+            print("Unable to find settings-%s.py." % symbol)
+    return _assemble(symbolSettings)
+
+
+def _assemble(symbolSettings=None):
+    settings = {}
+    settings.update(vars(baseSettings))
+    settings.update(vars(userSettings))
+    if symbolSettings:
+        settings.update(vars(symbolSettings))
+    return dotdict(settings)
+
+
+def reload_settings(symbol=None):
+    """Read the settings files again, and assemble them as settings_for(symbol) does. Raises whatever a
+       broken settings file does; the settings already in use are left as they are."""
+    global userSettings
+    with lock:  # import_path() changes sys.path
+        reload(baseSettings)
+        userSettings = import_path(os.path.join('..', 'settings'))
+        symbolSettings = None
+        if symbol and os.path.exists(settings_files(symbol)[-1]):
+            symbolSettings = import_path(os.path.join('..', 'settings-%s' % symbol))
+        return _assemble(symbolSettings)
+
+
+def settings_files(symbol=None):
+    """The files settings_for(symbol) reads, including a settings-<symbol>.py that doesn't exist yet."""
+    files = [module.__file__.replace('.pyc', '.py') for module in (baseSettings, userSettings)]
+    if symbol:
+        files.append(os.path.join(os.path.dirname(files[1]), 'settings-%s.py' % symbol))
+    return files
+
+lock = threading.Lock()
 userSettings = import_path(os.path.join('..', 'settings'))
-symbolSettings = None
 symbol = sys.argv[1] if len(sys.argv) > 1 else None
-if symbol:
-    print("Importing symbol settings for %s..." % symbol)
-    try:
-        symbolSettings = import_path(os.path.join('..', 'settings-%s' % symbol))
-    except Exception as e:
-        print("Unable to find settings-%s.py." % symbol)
-
-# Assemble settings.
-settings = {}
-settings.update(vars(baseSettings))
-settings.update(vars(userSettings))
-if symbolSettings:
-    settings.update(vars(symbolSettings))
 
 # Main export
-settings = dotdict(settings)
+settings = settings_for(symbol)
@@ -0,0 +1,172 @@
+"""Run the market maker as one feed-handler process and a pool of quoting processes.
+
+The feed handler owns the websocket. It publishes the market and account data the order managers read
+onto a shared-memory MarketDataBus. Each quoting process runs the OrderManagers for its share of the
+symbols, reading from the bus and sending orders over its own HTTP connections. Parsing and quoting
+many instruments then spreads over several cores instead of sharing one GIL.
+"""
+from __future__ import absolute_import
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from market_maker import market_maker
+from market_maker.bus import MarketDataBus, BusClient
+from market_maker.market_maker import OrderManager, OrderManagerHost, logger
+from market_maker.settings import settings, settings_for
+from market_maker.utils import log
+from market_maker.utils.metrics import metrics
+
+# How often the feed publishes account data and its heartbeat, and republishes quiet symbols (seconds).
+HEARTBEAT_INTERVAL = 1
+
+
+def run(symbols, processes):
+    """Start the feed handler and `processes` quoting processes, and supervise them. Exits if any of them
+       stops, cancelling its orders; restarts everything if a quoting process asks to."""
+    for symbol in symbols:
+        problem = bus_capacity_problem(settings_for(symbol))
+        if problem:
+            logger.error("%s: %s" % (symbol, problem))
+            sys.exit(1)
+    # The portfolio delta needs the CONTRACTS too, even ones we don't quote.
+    bus_symbols = symbols + [symbol for symbol in settings.CONTRACTS if symbol not in symbols]
+    bus = MarketDataBus(bus_symbols, settings.BUS_DEPTH_LEVELS, settings.BUS_MAX_ORDERS)
+    ready = multiprocessing.Event()
+    restart = multiprocessing.Event()
+
+    feed = multiprocessing.Process(target=run_feed, args=(symbols, bus_symbols, bus.name, ready), name='feed')
+    feed.start()
+    workers = []
+    try:
+        while not ready.wait(1):
+            if not feed.is_alive():
+                logger.error("Feed handler failed to start.")
+                sys.exit(1)
+
+        for i in range(processes):
+            shard = symbols[i::processes]
+            if shard:
+                worker = multiprocessing.Process(target=run_worker, args=(shard, bus_symbols, bus.name, restart, i),
+                                                 name='quoting-%d' % i)
+                worker.start()
+                workers.append(worker)
+        logger.info("Quoting %d symbols in %d processes." % (len(symbols), len(workers)))
+
+        while not restart.is_set():
+            stopped = [p for p in [feed] + workers if p.exitcode not in (None, 0)]
+            if stopped:
+                logger.error("%s stopped unexpectedly. Shutting down." % stopped[0].name)
+                sys.exit(1)
+            if not any(worker.is_alive() for worker in workers):
+                return  # Dry run done
+            time.sleep(1)
+    finally:
+        # Quoting processes cancel their orders on SIGTERM.
+        for process in workers + [feed]:
+            if process.is_alive():
+                process.terminate()
+        for process in workers + [feed]:
+            process.join()
+        bus.close()
+
+    logger.info("Restarting the market maker...")
+    log.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def run_feed(symbols, bus_symbols, bus_name, ready):
+    """Feed handler process. Owns the websocket; publishes every change for a symbol onto the bus."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    bus = MarketDataBus(bus_symbols, settings.BUS_DEPTH_LEVELS, settings.BUS_MAX_ORDERS, name=bus_name)
+    if settings.METRICS_PORT:
+        metrics.serve(settings.METRICS_PORT)
+    ws = market_maker.connect(symbols).ws
+
+    def publish(symbol):
+        bus.publish(symbol, instrument=ws.get_instrument(symbol), book=ws.market_depth(symbol),
+                    orders=ws.open_orders(settings.ORDERID_PREFIX, symbol), position=ws.position(symbol),
+                    received=ws.last_update(symbol))
+
+    def publish_on_update(symbol):
+        # One thread per symbol: a burst of updates on one symbol doesn't hold up the others.
+        while not ws.exited:
+            ws.wait_for_update(symbol, HEARTBEAT_INTERVAL)
+            publish(symbol)
+
+    for symbol in bus_symbols:
+        publish(symbol)
+    bus.publish_account(ws.funds(), connected=True)
+    ready.set()
+
+    for symbol in symbols:
+        thread = threading.Thread(target=publish_on_update, args=(symbol,), name='publish-%s' % symbol)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while not ws.exited:
+            if ws.wait_for_connection(0):
+                time.sleep(HEARTBEAT_INTERVAL)
+            else:
+                # Reconnecting: say so as soon as we're back, so quoting resumes straight away.
+                ws.wait_for_connection(HEARTBEAT_INTERVAL)
+            for symbol in bus_symbols[len(symbols):]:
+                publish(symbol)
+            bus.publish_account(ws.funds(), connected=ws.wait_for_connection(0))
+    finally:
+        bus.publish_account(exited=True)
+    logger.error("Realtime data connection closed.")
+    sys.exit(1)
+
+
+def bus_capacity_problem(symbol_settings):
+    """Why the bus can't hold every open order a symbol with these settings quotes, or None if it can. Orders
+       that don't fit are invisible to their quoting process, which would create them again every pass."""
+    if 2 * symbol_settings.ORDER_PAIRS > settings.BUS_MAX_ORDERS:
+        return "ORDER_PAIRS = %d needs BUS_MAX_ORDERS of at least %d, but it is %d." % (
+            symbol_settings.ORDER_PAIRS, 2 * symbol_settings.ORDER_PAIRS, settings.BUS_MAX_ORDERS)
+    return None
+
+
+class WorkerOrderManager(OrderManager):
+
+    # Set in each quoting process; tells the supervisor to restart everything.
+    restart_requested = None
+
+    def check_settings(self, new):
+        return bus_capacity_problem(new)
+
+    def restart(self):
+        """Our process was started by the supervisor, which restarts the lot; ask it to."""
+        logger.info("Restarting the market maker...")
+        self.restart_requested.set()
+        sys.exit()
+
+
+class WorkerHost(OrderManagerHost):
+    order_manager = WorkerOrderManager
+
+
+def run_worker(symbols, bus_symbols, bus_name, restart, index):
+    """Quoting process number `index`. Runs OrderManagers for `symbols` on market data from the bus."""
+    bus = MarketDataBus(bus_symbols, settings.BUS_DEPTH_LEVELS, settings.BUS_MAX_ORDERS, name=bus_name)
+    if settings.METRICS_PORT:
+        metrics.serve(settings.METRICS_PORT + 1 + index)
+    rest = market_maker.connect(symbols, connectWS=False)
+    WorkerOrderManager.restart_requested = restart
+    host = WorkerHost(symbols, BusClient(bus, rest, symbols[0]))
+    # Exit (cancelling our orders) when the supervisor stops us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        host.run()
+    except KeyboardInterrupt:
+        sys.exit()
+    finally:
+        # multiprocessing ends its processes with os._exit(), so the atexit hooks that cancel orders elsewhere
+        # never run here.
+        for om in host.order_managers:
+            om.exit()
@@ -0,0 +1,72 @@
+"""Run the exchange simulator: python -m market_maker.simulator --help"""
+from __future__ import absolute_import
+import argparse
+import logging
+import random
+import time
+
+from market_maker.simulator.flow import run_flows
+from market_maker.simulator.server import Simulator
+
+# Contract specs for the instruments the simulator knows. lastPrice is where each market starts.
+INSTRUMENTS = {
+    'XBTUSD': {'rootSymbol': 'XBT', 'typ': 'FFWCSX', 'tickSize': 0.5, 'lotSize': 1, 'multiplier': -100000000,
+               'underlyingToSettleMultiplier': -100000000, 'isQuanto': False, 'isInverse': True,
+               'initMargin': 0.01, 'maintMargin': 0.005, 'lastPrice': 10000.0},
+    'ETHUSD': {'rootSymbol': 'ETH', 'typ': 'FFWCSX', 'tickSize': 0.05, 'lotSize': 1, 'multiplier': 100,
+               'underlyingToSettleMultiplier': None, 'isQuanto': True, 'isInverse': False,
+               'initMargin': 0.02, 'maintMargin': 0.01, 'lastPrice': 300.0},
+    'XBTZ26': {'rootSymbol': 'XBT', 'typ': 'FFCCSX', 'tickSize': 0.5, 'lotSize': 1, 'multiplier': -100000000,
+               'underlyingToSettleMultiplier': -100000000, 'isQuanto': False, 'isInverse': True,
+               'initMargin': 0.01, 'maintMargin': 0.005, 'lastPrice': 10100.0},
+}
+
+parser = argparse.ArgumentParser(description='Local BitMEX exchange simulator, for load and latency testing.')
+parser.add_argument('symbols', nargs='*', default=['XBTUSD'],
+                    help='instruments to list, of %s (default: XBTUSD)' % ', '.join(sorted(INSTRUMENTS)))
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--latency', type=float, default=0, help='seconds added to every request and message')
+parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds, at random')
+parser.add_argument('--rate-limit', type=int, default=300, help='requests allowed per account per period')
+parser.add_argument('--rate-period', type=float, default=300, help='rate limit period, in seconds')
+parser.add_argument('--flow-rate', type=float, default=20,
+                    help='background orders per second per symbol; 0 for a market that only we trade in')
+parser.add_argument('--taker-ratio', type=float, default=0.2, help='share of background orders that are market orders')
+parser.add_argument('--volatility', type=float, default=0.0001,
+                    help='standard deviation of the fair price\'s log change per background order')
+parser.add_argument('--seed', type=int, default=None, help='random seed for the background flow')
+parser.add_argument('--disconnect-interval', type=float, default=0,
+                    help='drop every websocket connection this often (seconds, on average), to test reconnecting')
+
+
+def main():
+    args = parser.parse_args()
+    unknown = [symbol for symbol in args.symbols if symbol not in INSTRUMENTS]
+    if unknown:
+        parser.error('unknown instrument: %s' % ', '.join(unknown))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    simulator = Simulator({symbol: INSTRUMENTS[symbol] for symbol in args.symbols}, args.host, args.port,
+                          latency=args.latency, jitter=args.jitter, rateLimit=args.rate_limit,
+                          ratePeriod=args.rate_period)
+    flows = run_flows(simulator.engine, args.symbols, rate=args.flow_rate or 1, takerRatio=args.taker_ratio,
+                      volatility=args.volatility, seed=args.seed)
+    if not args.flow_rate:
+        for flow in flows:
+            flow.stop()
+    simulator.start()
+    logging.getLogger('simulator').info('Listening on %s. Set BASE_URL to that, with any API key.' % simulator.url)
+    try:
+        if args.disconnect_interval:
+            rng = random.Random(args.seed)
+            while True:
+                time.sleep(rng.expovariate(1.0 / args.disconnect_interval))
+                simulator.drop_connections()
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
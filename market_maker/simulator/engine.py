@@ -0,0 +1,583 @@
+"""Price-time priority matching engine for the simulator.
+
+Orders rest on integer tick prices, in FIFO queues per level. An order that crosses the book trades
+against the best opposite levels, oldest order first, at the resting order's price. Every change is
+reported to a listener as the table deltas BitMEX's realtime API would send (instrument, quote, trade,
+orderBookL2, orderBook25, order, execution, position, margin).
+"""
+from __future__ import absolute_import
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from datetime import datetime
+import itertools
+import threading
+import uuid
+
+XBt_TO_XBT = 100000000
+BOOK25_LEVELS = 25
+
+
+class SimulatorError(Exception):
+
+    """A request the exchange would reject, with the HTTP status BitMEX answers it with."""
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def timestamp():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def contract_value(instrument, qty, price):
+    """Value of `qty` contracts at `price`, in XBt. Inverse contracts have a negative multiplier."""
+    multiplier = instrument['multiplier']
+    return qty * multiplier / float(price) if multiplier < 0 else qty * multiplier * price
+
+
+class Order(object):
+
+    __slots__ = ('orderID', 'clOrdID', 'account', 'symbol', 'side', 'tick', 'price', 'orderQty', 'leavesQty',
+                 'cumQty', 'avgPx', 'ordStatus', 'ordType', 'execInst', 'text', 'timestamp')
+
+    def row(self):
+        return {
+            'orderID': self.orderID, 'clOrdID': self.clOrdID, 'account': self.account, 'symbol': self.symbol,
+            'side': self.side, 'price': self.price, 'orderQty': self.orderQty, 'leavesQty': self.leavesQty,
+            'cumQty': self.cumQty, 'avgPx': self.avgPx, 'ordStatus': self.ordStatus, 'ordType': self.ordType,
+            'execInst': self.execInst, 'text': self.text, 'timestamp': self.timestamp,
+            'transactTime': self.timestamp, 'currency': 'USD', 'settlCurrency': 'XBt', 'workingIndicator': True,
+        }
+
+
+class BookSide(object):
+
+    """One side of a book: a FIFO queue of orders per tick, with ticks kept sorted best first."""
+
+    def __init__(self, descending):
+        self.sign = -1 if descending else 1
+        self.keys = []  # sign * tick, ascending, so index 0 is the best level
+        self.levels = {}  # tick -> deque of resting orders
+        self.sizes = {}  # tick -> total leavesQty
+
+    def best(self):
+        return self.sign * self.keys[0] if self.keys else None
+
+    def add(self, order):
+        if order.tick not in self.levels:
+            key = self.sign * order.tick
+            self.keys.insert(bisect_left(self.keys, key), key)
+            self.levels[order.tick] = deque()
+            self.sizes[order.tick] = 0
+        self.levels[order.tick].append(order)
+        self.sizes[order.tick] += order.leavesQty
+
+    def remove(self, order):
+        level = self.levels[order.tick]
+        level.remove(order)
+        self.sizes[order.tick] -= order.leavesQty
+        if not level:
+            self.drop_level(order.tick)
+
+    def drop_level(self, tick):
+        del self.levels[tick]
+        del self.sizes[tick]
+        key = self.sign * tick
+        del self.keys[bisect_left(self.keys, key)]
+
+    def top(self, n):
+        return [(self.sign * key, self.sizes[self.sign * key]) for key in self.keys[:n]]
+
+
+class Book(object):
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+
+    def side(self, side):
+        return self.bids if side == 'Buy' else self.asks
+
+    def opposite(self, side):
+        return self.asks if side == 'Buy' else self.bids
+
+    def top_of_book(self):
+        bid, ask = self.bids.best(), self.asks.best()
+        return (bid, self.bids.sizes.get(bid, 0), ask, self.asks.sizes.get(ask, 0))
+
+
+class MatchingEngine(object):
+
+    """All instruments, books and accounts of the simulated exchange.
+
+    `instruments` maps symbols to instrument rows (at least tickSize, multiplier and a starting
+    lastPrice). `listener(table, action, rows, symbol=None, account=None)` is called with every table
+    delta, while holding `lock`; take the lock to read a consistent image for a partial.
+    """
+
+    def __init__(self, instruments, listener=None, startingBalance=10 * XBt_TO_XBT):
+        self.lock = threading.RLock()
+        self.listener = listener or (lambda *args, **kwargs: None)
+        self.startingBalance = startingBalance
+        self.instruments = OrderedDict()
+        self.books = {}
+        for symbol, instrument in instruments.items():
+            self.instruments[symbol] = dict(instrument, symbol=symbol, state='Open', timestamp=timestamp())
+            self.books[symbol] = Book(symbol)
+        self.orders = {}  # orderID -> open Order
+        self.clOrdIDs = {}  # clOrdID -> Order, open or not, so clients can look orders up after the fact
+        self.positions = {}  # (account, symbol) -> position row
+        self.margins = {}  # account -> margin row
+        self.trades = deque(maxlen=100)
+        self.tradeIDs = itertools.count(1)
+        self.changes = None
+
+    #
+    # Accounts
+    #
+    def open_account(self, account):
+        """Create an account's margin and positions, if it has none yet."""
+        with self.lock:
+            if account in self.margins:
+                return
+            self.margins[account] = {'account': account, 'currency': 'XBt', 'walletBalance': self.startingBalance,
+                                     'marginBalance': self.startingBalance, 'availableFunds': self.startingBalance,
+                                     'realisedPnl': 0, 'timestamp': timestamp()}
+            for symbol in self.instruments:
+                self.positions[(account, symbol)] = {
+                    'account': account, 'symbol': symbol, 'currency': 'XBt', 'currentQty': 0, 'avgCostPrice': None,
+                    'avgEntryPrice': None, 'realisedPnl': 0, 'isOpen': False, 'timestamp': timestamp()}
+
+    #
+    # Order entry. Each returns order rows like the REST API.
+    #
+    def place(self, account, symbol, side, orderQty, price=None, clOrdID=None, execInst='', ordType=None):
+        with self.lock, self.batch():
+            return self._place(account, symbol, side, orderQty, price, clOrdID, execInst, ordType).row()
+
+    def place_bulk(self, account, orders):
+        with self.lock, self.batch():
+            return [self._place(account, o.get('symbol'), o.get('side'), o.get('orderQty'), o.get('price'),
+                                o.get('clOrdID'), o.get('execInst', ''), o.get('ordType')).row() for o in orders]
+
+    def amend_bulk(self, account, amends):
+        """Amend orders. All or nothing: if one can't be amended, none are."""
+        with self.lock, self.batch():
+            orders = [self._find(account, amend) for amend in amends]
+            for order in orders:
+                if order.ordStatus not in ('New', 'PartiallyFilled'):
+                    raise SimulatorError('Invalid ordStatus')
+            return [self._amend(order, amend).row() for order, amend in zip(orders, amends)]
+
+    def cancel(self, account, orderIDs=None, clOrdIDs=None, symbol=None):
+        """Cancel orders by orderID or clOrdID, or all of an account's orders (on one symbol) if neither is
+           given. Unknown orders come back with an error, as BitMEX does."""
+        with self.lock, self.batch():
+            if orderIDs is None and clOrdIDs is None:
+                targets = [o for o in self.orders.values()
+                           if o.account == account and (symbol is None or o.symbol == symbol)]
+                return [self._cancel(o, 'Canceled: Cancel from www.bitmex.com').row() for o in targets]
+            results = []
+            for key, value in [('orderID', v) for v in orderIDs or []] + [('clOrdID', v) for v in clOrdIDs or []]:
+                order = next((o for o in self.orders.values() if getattr(o, key) == value and o.account == account),
+                             None)
+                if order is None:
+                    results.append({key: value, 'error': 'Not Found'})
+                else:
+                    results.append(self._cancel(order, 'Canceled: Canceled via API.').row())
+            return results
+
+    def open_orders(self, account, symbol=None):
+        with self.lock:
+            return [o.row() for o in self.orders.values()
+                    if o.account == account and (symbol is None or o.symbol == symbol)]
+
+    def find_orders(self, account, filter):
+        """Orders matching a REST `filter`: by clOrdID (open or not), otherwise open orders by symbol."""
+        with self.lock:
+            if filter.get('clOrdID'):
+                order = self.clOrdIDs.get(filter['clOrdID'])
+                return [order.row()] if order is not None and order.account == account else []
+            if filter.get('ordStatus.isTerminated') is True:
+                return []
+            return self.open_orders(account, filter.get('symbol'))
+
+    #
+    # Images for partials
+    #
+    def instrument_rows(self):
+        return [dict(i) for i in self.instruments.values()]
+
+    def book_rows(self, symbol):
+        book = self.books[symbol]
+        tickSize = self.instruments[symbol]['tickSize']
+        rows = []
+        for side, bookSide in (('Sell', book.asks), ('Buy', book.bids)):
+            for tick, size in bookSide.top(len(bookSide.keys)):
+                rows.append(self._level_row(symbol, side, tick, tickSize, size))
+        return rows
+
+    def book25_row(self, symbol):
+        book = self.books[symbol]
+        tickSize = self.instruments[symbol]['tickSize']
+        return {'symbol': symbol, 'timestamp': timestamp(),
+                'bids': [[self._price(t, tickSize), s] for t, s in book.bids.top(BOOK25_LEVELS)],
+                'asks': [[self._price(t, tickSize), s] for t, s in book.asks.top(BOOK25_LEVELS)]}
+
+    def quote_row(self, symbol):
+        bid, bidSize, ask, askSize = self.books[symbol].top_of_book()
+        tickSize = self.instruments[symbol]['tickSize']
+        return {'timestamp': timestamp(), 'symbol': symbol,
+                'bidPrice': self._price(bid, tickSize), 'bidSize': bidSize or None,
+                'askPrice': self._price(ask, tickSize), 'askSize': askSize or None}
+
+    def trade_rows(self, symbol):
+        return [t for t in self.trades if t['symbol'] == symbol]
+
+    def position_rows(self, account):
+        return [dict(p) for (a, _), p in self.positions.items() if a == account]
+
+    def margin_rows(self, account):
+        return [dict(self.margins[account])] if account in self.margins else []
+
+    #
+    # Internals
+    #
+    def batch(self):
+        """Collect the changes of one request, and report them when it's done."""
+        return _Batch(self)
+
+    def _find(self, account, amend):
+        order = self.orders.get(amend.get('orderID'))
+        if order is None and amend.get('origClOrdID'):
+            order = next((o for o in self.orders.values() if o.clOrdID == amend['origClOrdID']), None)
+        if order is None or order.account != account:
+            # Filled and canceled orders leave self.orders, so this is what amending one looks like.
+            raise SimulatorError('Invalid ordStatus')
+        return order
+
+    def _place(self, account, symbol, side, orderQty, price, clOrdID, execInst, ordType):
+        if symbol not in self.instruments:
+            raise SimulatorError('Invalid symbol')
+        if side not in ('Buy', 'Sell'):
+            if not orderQty:
+                raise SimulatorError('Invalid side')
+            side = 'Buy' if orderQty > 0 else 'Sell'
+        orderQty = abs(int(orderQty or 0))
+        if orderQty <= 0:
+            raise SimulatorError('Invalid orderQty')
+        if clOrdID:
+            if clOrdID in self.clOrdIDs:
+                raise SimulatorError('Duplicate clOrdID')
+        ordType = ordType or ('Market' if price is None else 'Limit')
+        tickSize = self.instruments[symbol]['tickSize']
+
+        order = Order()
+        order.orderID = str(uuid.uuid4())
+        order.clOrdID = clOrdID or ''
+        order.account = account
+        order.symbol = symbol
+        order.side = side
+        order.ordType = ordType
+        order.execInst = execInst or ''
+        order.orderQty = order.leavesQty = orderQty
+        order.cumQty = 0
+        order.avgPx = None
+        order.text = 'Submitted via API.'
+        order.timestamp = timestamp()
+        if ordType == 'Market':
+            order.tick = None
+            order.price = None
+        else:
+            order.tick = self._tick(price, tickSize)
+            order.price = self._price(order.tick, tickSize)
+        order.ordStatus = 'New'
+        if clOrdID:
+            self.clOrdIDs[clOrdID] = order
+        self.changes.order(order, 'insert')
+        self.changes.execution(order, 'New')
+
+        if order.tick is not None and 'ParticipateDoNotInitiate' in order.execInst and self._crosses(order):
+            return self._cancel(order, 'Canceled: Order had execInst of ParticipateDoNotInitiate', resting=False)
+        self._match(order)
+        if order.leavesQty > 0:
+            if order.tick is None:
+                return self._cancel(order, 'Canceled: Market order not fully filled', resting=False)
+            self.orders[order.orderID] = order
+            self._rest(order)
+        return order
+
+    def _amend(self, order, amend):
+        book = self.books[order.symbol]
+        tickSize = self.instruments[order.symbol]['tickSize']
+        leavesQty = order.leavesQty
+        if amend.get('orderQty') is not None:
+            leavesQty = int(amend['orderQty']) - order.cumQty
+        if amend.get('leavesQty') is not None:
+            leavesQty = int(amend['leavesQty'])
+        tick = order.tick if amend.get('price') is None else self._tick(amend['price'], tickSize)
+        if leavesQty <= 0:
+            return self._cancel(order, 'Canceled: Amended to zero quantity.')
+
+        # Moving the price or adding size sends the order to the back of the queue. Shrinking keeps its place.
+        lose_priority = tick != order.tick or leavesQty > order.leavesQty
+        if lose_priority:
+            self._unrest(order)
+        else:
+            self.changes.level(book, order.side, order.tick)
+            book.side(order.side).sizes[order.tick] -= order.leavesQty - leavesQty
+        order.tick = tick
+        order.price = self._price(tick, tickSize)
+        order.leavesQty = leavesQty
+        order.orderQty = order.cumQty + leavesQty
+        order.text = 'Amended via API.'
+        order.timestamp = timestamp()
+        self.changes.order(order, 'update')
+        self.changes.execution(order, 'Replaced')
+        if lose_priority:
+            if 'ParticipateDoNotInitiate' in order.execInst and self._crosses(order):
+                del self.orders[order.orderID]
+                return self._cancel(order, 'Canceled: Order had execInst of ParticipateDoNotInitiate',
+                                    resting=False)
+            self._match(order)
+            if order.leavesQty > 0:
+                self._rest(order)
+            else:
+                del self.orders[order.orderID]
+        return order
+
+    def _cancel(self, order, text, resting=True):
+        if resting:
+            self._unrest(order)
+            del self.orders[order.orderID]
+        order.leavesQty = 0
+        order.ordStatus = 'Canceled'
+        order.text = text
+        order.timestamp = timestamp()
+        self.changes.order(order, 'update')
+        self.changes.execution(order, 'Canceled')
+        return order
+
+    def _rest(self, order):
+        book = self.books[order.symbol]
+        self.changes.level(book, order.side, order.tick)
+        book.side(order.side).add(order)
+
+    def _unrest(self, order):
+        book = self.books[order.symbol]
+        self.changes.level(book, order.side, order.tick)
+        book.side(order.side).remove(order)
+
+    def _crosses(self, order):
+        best = self.books[order.symbol].opposite(order.side).best()
+        if best is None:
+            return False
+        return order.tick is None or (best <= order.tick if order.side == 'Buy' else best >= order.tick)
+
+    def _match(self, order):
+        book = self.books[order.symbol]
+        opposite = book.opposite(order.side)
+        while order.leavesQty > 0 and self._crosses(order):
+            tick = opposite.best()
+            level = opposite.levels[tick]
+            resting = level[0]
+            qty = min(order.leavesQty, resting.leavesQty)
+            self.changes.level(book, resting.side, tick)
+            opposite.sizes[tick] -= qty
+            self._fill(resting, qty, tick)
+            self._fill(order, qty, tick)
+            self._trade(order, qty, tick)
+            if resting.leavesQty == 0:
+                level.popleft()
+                del self.orders[resting.orderID]
+                if not level:
+                    opposite.drop_level(tick)
+
+    def _fill(self, order, qty, tick):
+        instrument = self.instruments[order.symbol]
+        price = self._price(tick, instrument['tickSize'])
+        order.avgPx = price if not order.cumQty else \
+            (order.avgPx * order.cumQty + price * qty) / float(order.cumQty + qty)
+        order.cumQty += qty
+        order.leavesQty -= qty
+        order.ordStatus = 'Filled' if order.leavesQty == 0 else 'PartiallyFilled'
+        order.timestamp = timestamp()
+        self.changes.order(order, 'update')
+        self.changes.execution(order, 'Trade', qty, price)
+        self._update_position(order.account, order.symbol, qty if order.side == 'Buy' else -qty, price)
+
+    def _trade(self, taker, qty, tick):
+        instrument = self.instruments[taker.symbol]
+        price = self._price(tick, instrument['tickSize'])
+        last = instrument.get('lastPrice')
+        tickDirection = 'ZeroPlusTick' if last is None or price == last else \
+            ('PlusTick' if price > last else 'MinusTick')
+        trade = {'timestamp': timestamp(), 'symbol': taker.symbol, 'side': taker.side, 'size': qty, 'price': price,
+                 'tickDirection': tickDirection, 'trdMatchID': str(uuid.UUID(int=next(self.tradeIDs))),
+                 'grossValue': int(abs(contract_value(instrument, qty, price))),
+                 'homeNotional': abs(contract_value(instrument, qty, price)) / XBt_TO_XBT, 'foreignNotional': qty}
+        self.trades.append(trade)
+        self.changes.add('trade', 'insert', [trade], symbol=taker.symbol)
+        instrument['lastPrice'] = price
+        self.changes.instrument(taker.symbol)
+
+    def _update_position(self, account, symbol, qty, price):
+        if account not in self.margins:
+            self.open_account(account)
+        instrument = self.instruments[symbol]
+        position = self.positions[(account, symbol)]
+        margin = self.margins[account]
+        current = position['currentQty']
+        entry = position['avgEntryPrice']
+        if current == 0 or (current > 0) == (qty > 0):
+            # Opening or adding: average the entry price.
+            position['avgEntryPrice'] = price if current == 0 else \
+                (entry * abs(current) + price * abs(qty)) / float(abs(current) + abs(qty))
+        else:
+            # Reducing: realise PnL on the closed part.
+            closed = min(abs(qty), abs(current)) * (1 if current > 0 else -1)
+            pnl = int(contract_value(instrument, closed, price) - contract_value(instrument, closed, entry))
+            position['realisedPnl'] += pnl
+            margin['realisedPnl'] += pnl
+            margin['walletBalance'] += pnl
+            margin['marginBalance'] += pnl
+            margin['availableFunds'] += pnl
+            if abs(qty) > abs(current):
+                position['avgEntryPrice'] = price
+        position['currentQty'] = current + qty
+        if position['currentQty'] == 0:
+            position['avgEntryPrice'] = None
+        position['avgCostPrice'] = position['avgEntryPrice']
+        position['isOpen'] = position['currentQty'] != 0
+        position['timestamp'] = margin['timestamp'] = timestamp()
+        self.changes.position(position)
+        self.changes.margin(margin)
+
+    @staticmethod
+    def _tick(price, tickSize):
+        tick = int(round(float(price) / tickSize))
+        if abs(tick * tickSize - float(price)) > tickSize * 1e-6:
+            raise SimulatorError('Invalid price tickSize')
+        if tick <= 0:
+            raise SimulatorError('Invalid price')
+        return tick
+
+    @staticmethod
+    def _price(tick, tickSize):
+        if tick is None:
+            return None
+        decimals = max(0, -int(('%e' % tickSize).split('e')[1]))
+        return round(tick * tickSize, decimals + 2)
+
+    def _level_row(self, symbol, side, tick, tickSize, size=None):
+        row = {'symbol': symbol, 'id': tick, 'side': side, 'price': self._price(tick, tickSize)}
+        if size is not None:
+            row['size'] = size
+        return row
+
+
+class _Batch(object):
+
+    """The changes made by one engine operation, turned into table deltas when it completes.
+
+    Book levels are compared against their size before the operation, so a level that is emptied and
+    refilled in one request is reported once, as an update.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        if self.engine.changes is not None:
+            self.nested = True
+            return self.engine.changes
+        self.nested = False
+        self.messages = []
+        self.levels = OrderedDict()  # (symbol, side, tick) -> size before
+        self.tops = {}  # symbol -> top of book before
+        self.instruments = set()
+        self.engine.changes = self
+        return self
+
+    def __exit__(self, *exc):
+        if self.nested:
+            return False
+        self.engine.changes = None
+        # Even if the request failed part way (a bulk order with a bad entry), what it did change goes out.
+        self.flush()
+        return False
+
+    def add(self, table, action, rows, symbol=None, account=None):
+        last = self.messages[-1] if self.messages else None
+        if last and last[:2] == (table, action) and last[3:] == (symbol, account):
+            last[2].extend(rows)
+        else:
+            self.messages.append((table, action, list(rows), symbol, account))
+
+    def level(self, book, side, tick):
+        if book.symbol not in self.tops:
+            self.tops[book.symbol] = book.top_of_book()
+        key = (book.symbol, side, tick)
+        if key not in self.levels:
+            self.levels[key] = book.side(side).sizes.get(tick, 0)
+
+    def order(self, order, action):
+        self.add('order', action, [order.row()], order.symbol, order.account)
+
+    def execution(self, order, execType, lastQty=0, lastPx=None):
+        row = dict(order.row(), execID=str(uuid.uuid4()), execType=execType, lastQty=lastQty, lastPx=lastPx)
+        self.add('execution', 'insert', [row], order.symbol, order.account)
+
+    def position(self, position):
+        self.add('position', 'update', [dict(position)], position['symbol'], position['account'])
+
+    def margin(self, margin):
+        self.add('margin', 'update', [dict(margin)], None, margin['account'])
+
+    def instrument(self, symbol):
+        self.instruments.add(symbol)
+
+    def flush(self):
+        engine = self.engine
+        symbols = OrderedDict()
+        for (symbol, side, tick), before in self.levels.items():
+            after = engine.books[symbol].side(side).sizes.get(tick, 0)
+            if before == after:
+                continue
+            tickSize = engine.instruments[symbol]['tickSize']
+            if before == 0:
+                action, row = 'insert', engine._level_row(symbol, side, tick, tickSize, after)
+            elif after == 0:
+                action, row = 'delete', {'symbol': symbol, 'id': tick, 'side': side}
+            else:
+                action, row = 'update', {'symbol': symbol, 'id': tick, 'side': side, 'size': after}
+            symbols.setdefault(symbol, OrderedDict()).setdefault(action, []).append(row)
+
+        # Book changes go out first: by the time a client hears about a fill, the book reflects it.
+        for symbol, actions in symbols.items():
+            for action in ('delete', 'update', 'insert'):
+                if action in actions:
+                    engine.listener('orderBookL2', action, actions[action], symbol=symbol)
+            engine.listener('orderBook25', 'update', [engine.book25_row(symbol)], symbol=symbol)
+            if engine.books[symbol].top_of_book() != self.tops[symbol]:
+                engine.listener('quote', 'insert', [engine.quote_row(symbol)], symbol=symbol)
+                self.instruments.add(symbol)
+
+        for table, action, rows, symbol, account in self.messages:
+            engine.listener(table, action, rows, symbol=symbol, account=account)
+
+        for symbol in self.instruments:
+            instrument = engine.instruments[symbol]
+            quote = engine.quote_row(symbol)
+            instrument['bidPrice'] = quote['bidPrice']
+            instrument['askPrice'] = quote['askPrice']
+            if quote['bidPrice'] and quote['askPrice']:
+                instrument['midPrice'] = (quote['bidPrice'] + quote['askPrice']) / 2.0
+                instrument['markPrice'] = instrument['indicativeSettlePrice'] = instrument['midPrice']
+            instrument['timestamp'] = timestamp()
+            engine.listener('instrument', 'update', [{
+                k: instrument.get(k) for k in ('symbol', 'bidPrice', 'askPrice', 'midPrice', 'lastPrice', 'markPrice',
+                                               'indicativeSettlePrice', 'timestamp')}], symbol=symbol)
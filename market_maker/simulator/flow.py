@@ -0,0 +1,104 @@
+"""Background order flow, so the simulated market moves and fills our quotes.
+
+A random walk drives each symbol's fair price. Other participants post limit orders around it, cancel
+them as it drifts away, and send market orders that sweep the top of the book.
+"""
+from __future__ import absolute_import
+import math
+import random
+import threading
+
+from market_maker.simulator.engine import SimulatorError
+
+FLOW_ACCOUNT = 0  # Account number of the simulated other participants.
+
+
+class MarketFlow(threading.Thread):
+
+    """Generates order flow on one symbol.
+
+    rate:        events per second, on average (Poisson arrivals).
+    takerRatio:  share of events that are market orders.
+    volatility:  standard deviation of the fair price's log change per event.
+    depth:       levels either side of the fair price that limit orders are placed on.
+    spacing:     ticks between those levels.
+    size:        (min, max) order size.
+    """
+
+    def __init__(self, engine, symbol, rate=20, takerRatio=0.2, volatility=0.0001, depth=25, spacing=2,
+                 size=(100, 2000), seed=None):
+        threading.Thread.__init__(self, name='flow-%s' % symbol)
+        self.daemon = True
+        self.engine = engine
+        self.symbol = symbol
+        self.rate = rate
+        self.takerRatio = takerRatio
+        self.volatility = volatility
+        self.depth = depth
+        self.spacing = spacing
+        self.size = size
+        self.random = random.Random(seed)
+        self.stopped = threading.Event()
+        instrument = engine.instruments[symbol]
+        self.tickSize = instrument['tickSize']
+        self.fair = float(instrument['lastPrice'])
+        engine.open_account(FLOW_ACCOUNT)
+
+    def seed_book(self):
+        """Fill `depth` levels on both sides of the fair price."""
+        for i in range(1, self.depth + 1):
+            for side, sign in (('Buy', -1), ('Sell', 1)):
+                self.limit(side, self.fair_tick() + sign * i * self.spacing)
+
+    def run(self):
+        while not self.stopped.wait(self.random.expovariate(self.rate)):
+            self.step()
+
+    def stop(self):
+        self.stopped.set()
+
+    def step(self):
+        self.fair *= math.exp(self.random.gauss(0, self.volatility))
+        side = self.random.choice(('Buy', 'Sell'))
+        if self.random.random() < self.takerRatio:
+            self.engine.place(FLOW_ACCOUNT, self.symbol, side, self.order_size(), ordType='Market')
+        else:
+            offset = self.random.randint(1, self.depth) * self.spacing
+            self.limit(side, self.fair_tick() + (-offset if side == 'Buy' else offset))
+        self.cancel_stale()
+
+    def limit(self, side, tick):
+        if tick <= 0:
+            return
+        try:
+            self.engine.place(FLOW_ACCOUNT, self.symbol, side, self.order_size(), price=tick * self.tickSize,
+                              execInst='ParticipateDoNotInitiate')
+        except SimulatorError:
+            pass
+
+    def cancel_stale(self):
+        """Cancel our orders that the fair price has moved through, or left more than `depth` levels behind."""
+        fair = self.fair_tick()
+        limit = (self.depth + 1) * self.spacing
+        stale = []
+        for order in self.engine.open_orders(FLOW_ACCOUNT, self.symbol):
+            distance = (fair - int(round(order['price'] / self.tickSize))) * (1 if order['side'] == 'Buy' else -1)
+            if distance < 0 or distance > limit:
+                stale.append(order['orderID'])
+        if stale:
+            self.engine.cancel(FLOW_ACCOUNT, stale)
+
+    def fair_tick(self):
+        return int(round(self.fair / self.tickSize))
+
+    def order_size(self):
+        return self.random.randint(*self.size)
+
+
+def run_flows(engine, symbols, **kwargs):
+    """Seed each symbol's book and start its flow. Returns the started MarketFlow threads."""
+    flows = [MarketFlow(engine, symbol, **kwargs) for symbol in symbols]
+    for flow in flows:
+        flow.seed_book()
+        flow.start()
+    return flows
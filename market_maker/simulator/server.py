@@ -0,0 +1,485 @@
+"""A local BitMEX: the REST order API and the realtime websocket on one port, backed by a MatchingEngine.
+
+Point BASE_URL at it (http://127.0.0.1:<port>/api/v1/) to run the market maker against a market that
+never sleeps, never costs anything and can be made as slow or as busy as you like. Any API key is
+accepted; each distinct key gets its own account.
+
+REST: GET/POST/PUT/DELETE order, POST/PUT order/bulk, DELETE order/all, GET instrument, GET position,
+      GET user/margin.
+Websocket: /realtime, subscribing in the query string or with {"op": "subscribe"}, to instrument, quote,
+      trade, orderBookL2, orderBook25, order, execution, position and margin.
+
+Requests are rate limited per account like BitMEX does (x-ratelimit-* headers, 429 with Retry-After once
+the budget is spent; cancels always go through), and `latency` seconds (plus up to `jitter`) are added
+to every request and to every websocket message. drop_connections() cuts every websocket off without a
+close frame, as a network failure would.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import math
+import random
+import socket
+import threading
+import time
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from queue import Queue
+
+from market_maker.simulator import websocket
+from market_maker.simulator.engine import MatchingEngine, SimulatorError, timestamp
+
+logger = logging.getLogger('simulator')
+
+API_PREFIX = '/api/v1/'
+
+TABLE_KEYS = {
+    'instrument': ['symbol'],
+    'quote': [],
+    'trade': [],
+    'orderBookL2': ['symbol', 'id', 'side'],
+    'orderBook25': ['symbol'],
+    'order': ['orderID'],
+    'execution': ['execID'],
+    'position': ['account', 'symbol', 'currency'],
+    'margin': ['account', 'currency'],
+}
+PRIVATE_TABLES = {'order', 'execution', 'position', 'margin'}
+
+
+class RateLimit(object):
+
+    """Each account may make `limit` requests per `period` seconds, refilled continuously."""
+
+    def __init__(self, limit=300, period=300):
+        self.limit = limit
+        self.period = period
+        self.buckets = {}  # account -> (tokens, updated)
+        self.lock = threading.Lock()
+
+    def take(self, account, cost=1, force=False):
+        """Spend `cost` requests. Returns (allowed, remaining, reset, retryAfter); `force` always allows,
+           as BitMEX does for cancels."""
+        now = time.time()
+        rate = float(self.limit) / self.period
+        with self.lock:
+            tokens, updated = self.buckets.get(account, (float(self.limit), now))
+            tokens = min(self.limit, tokens + (now - updated) * rate)
+            allowed = force or tokens >= cost
+            if allowed:
+                tokens = max(0.0, tokens - cost)
+            self.buckets[account] = (tokens, now)
+        wait = max(0.0, (min(cost, self.limit) - tokens) / rate)
+        return allowed, int(tokens), int(math.ceil(now + wait)), int(math.ceil(wait)) or 1
+
+
+class Connection(object):
+
+    """One websocket client. Messages are queued and written by a sender thread after the configured
+       latency, so a slow client never holds up the engine."""
+
+    def __init__(self, simulator, wfile, account, sock=None):
+        self.simulator = simulator
+        self.wfile = wfile
+        self.sock = sock
+        self.account = account
+        self.subscriptions = set()  # (table, symbol or None)
+        self.queue = Queue()
+        self.closed = threading.Event()
+        self.sender = threading.Thread(target=self.send_loop, name='ws-sender')
+        self.sender.daemon = True
+        self.sender.start()
+
+    def wants(self, table, symbol, account):
+        if table in PRIVATE_TABLES and account != self.account:
+            return False
+        return (table, None) in self.subscriptions or (table, symbol) in self.subscriptions
+
+    def send(self, message, opcode=websocket.TEXT):
+        self.queue.put((time.time() + self.simulator.delay(), websocket.encode_frame(message, opcode)))
+
+    def send_json(self, obj):
+        self.send(json.dumps(obj, separators=(',', ':')))
+
+    def send_loop(self):
+        while not self.closed.is_set():
+            due, frame = self.queue.get()
+            if frame is None:
+                break
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.wfile.write(frame)
+                self.wfile.flush()
+            except (IOError, OSError):
+                self.close()
+
+    def close(self):
+        if not self.closed.is_set():
+            self.closed.set()
+            self.queue.put((0, None))
+            self.simulator.hub.remove(self)
+
+    def drop(self):
+        """Cut the connection off, without a close frame."""
+        self.close()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError, socket.error):
+                pass
+
+
+class Hub(object):
+
+    """Fans the engine's table deltas out to the websocket connections subscribed to them."""
+
+    def __init__(self):
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def add(self, connection):
+        with self.lock:
+            self.connections = self.connections + [connection]
+
+    def remove(self, connection):
+        with self.lock:
+            self.connections = [c for c in self.connections if c is not connection]
+
+    def publish(self, table, action, rows, symbol=None, account=None):
+        message = None
+        for connection in self.connections:
+            if connection.wants(table, symbol, account):
+                # Serialize once, however many clients want it.
+                if message is None:
+                    message = json.dumps({'table': table, 'action': action, 'data': rows}, separators=(',', ':'))
+                connection.send(message)
+
+    def close_all(self):
+        for connection in self.connections:
+            connection.close()
+
+    def drop_all(self):
+        connections = self.connections
+        for connection in connections:
+            connection.drop()
+        return len(connections)
+
+
+class Simulator(object):
+
+    def __init__(self, instruments, host='127.0.0.1', port=0, latency=0, jitter=0, rateLimit=300, ratePeriod=300,
+                 startingBalance=None):
+        self.hub = Hub()
+        kwargs = {} if startingBalance is None else {'startingBalance': startingBalance}
+        self.engine = MatchingEngine(instruments, self.hub.publish, **kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.rateLimit = RateLimit(rateLimit, ratePeriod)
+        self.accounts = {}  # API key -> account number
+        self.accountsLock = threading.Lock()
+        self.server = Server((host, port), Handler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, API_PREFIX)
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, name='simulator')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.hub.close_all()
+
+    def drop_connections(self):
+        """Drop every websocket connection, as a network failure would. Clients have to reconnect."""
+        dropped = self.hub.drop_all()
+        if dropped:
+            logger.info('Dropped %d websocket connection%s.' % (dropped, '' if dropped == 1 else 's'))
+        return dropped
+
+    def account(self, apiKey):
+        with self.accountsLock:
+            if apiKey not in self.accounts:
+                self.accounts[apiKey] = len(self.accounts) + 1  # 0 is the background flow
+                self.engine.open_account(self.accounts[apiKey])
+            return self.accounts[apiKey]
+
+    def delay(self):
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    #
+    # Websocket
+    #
+    def subscribe(self, connection, args):
+        """Subscribe a connection to topics like 'quote:XBTUSD' or 'margin', sending each one's image."""
+        for topic in args:
+            table, _, symbol = topic.partition(':')
+            symbol = symbol or None
+            if table not in TABLE_KEYS or (symbol is not None and symbol not in self.engine.instruments):
+                connection.send_json({'success': False, 'subscribe': topic, 'error': 'Unknown table: %s' % topic,
+                                      'request': {'op': 'subscribe', 'args': [topic]}})
+                continue
+            if table in PRIVATE_TABLES and connection.account is None:
+                connection.send_json({'success': False, 'subscribe': topic,
+                                      'error': 'Not authenticated. Send an API key to subscribe to %s.' % table,
+                                      'request': {'op': 'subscribe', 'args': [topic]}})
+                continue
+            # Under the engine lock, so no delta lands between the image and the subscription.
+            with self.engine.lock:
+                connection.subscriptions.add((table, symbol))
+                connection.send_json({'success': True, 'subscribe': topic,
+                                      'request': {'op': 'subscribe', 'args': [topic]}})
+                partial = {'table': table, 'action': 'partial', 'keys': TABLE_KEYS[table], 'types': {},
+                           'foreignKeys': {}, 'attributes': {}, 'data': self.image(table, symbol, connection.account)}
+                if symbol is not None:
+                    partial['filter'] = {'symbol': symbol}
+                connection.send_json(partial)
+
+    def image(self, table, symbol, account):
+        engine = self.engine
+        symbols = [symbol] if symbol is not None else list(engine.instruments)
+        if table == 'instrument':
+            rows = engine.instrument_rows()
+        elif table == 'quote':
+            rows = [engine.quote_row(s) for s in symbols]
+        elif table == 'trade':
+            rows = [t for s in symbols for t in engine.trade_rows(s)]
+        elif table == 'orderBookL2':
+            rows = [r for s in symbols for r in engine.book_rows(s)]
+        elif table == 'orderBook25':
+            rows = [engine.book25_row(s) for s in symbols]
+        elif table == 'order':
+            rows = engine.open_orders(account, symbol)
+        elif table == 'position':
+            rows = engine.position_rows(account)
+        elif table == 'margin':
+            rows = engine.margin_rows(account)
+        else:
+            rows = []
+        return [row for row in rows if symbol is None or row.get('symbol', symbol) == symbol]
+
+
+#
+# REST routes. Each takes (simulator, account, params) and returns the response body.
+#
+def _orderIDs(params, key):
+    value = params.get(key)
+    if value is None:
+        return None
+    return value if isinstance(value, list) else [value]
+
+
+def get_order(sim, account, params):
+    return sim.engine.find_orders(account, params.get('filter') or {})
+
+
+def post_order(sim, account, params):
+    return sim.engine.place(account, params.get('symbol'), params.get('side'), params.get('orderQty'),
+                            params.get('price'), params.get('clOrdID'), params.get('execInst', ''),
+                            params.get('ordType'))
+
+
+def put_order(sim, account, params):
+    return sim.engine.amend_bulk(account, [params])[0]
+
+
+def delete_order(sim, account, params):
+    orderIDs, clOrdIDs = _orderIDs(params, 'orderID'), _orderIDs(params, 'clOrdID')
+    if orderIDs is None and clOrdIDs is None:
+        raise SimulatorError('orderID or clOrdID must be sent.')
+    return sim.engine.cancel(account, orderIDs, clOrdIDs)
+
+
+def delete_order_all(sim, account, params):
+    return sim.engine.cancel(account, symbol=params.get('symbol'))
+
+
+def post_order_bulk(sim, account, params):
+    return sim.engine.place_bulk(account, params.get('orders') or [])
+
+
+def put_order_bulk(sim, account, params):
+    return sim.engine.amend_bulk(account, params.get('orders') or [])
+
+
+def get_instrument(sim, account, params):
+    with sim.engine.lock:
+        return sim.image('instrument', params.get('symbol'), account)
+
+
+def get_position(sim, account, params):
+    with sim.engine.lock:
+        return sim.engine.position_rows(account)
+
+
+def get_margin(sim, account, params):
+    with sim.engine.lock:
+        return sim.engine.margin_rows(account)[0]
+
+
+ROUTES = {
+    ('GET', 'order'): get_order,
+    ('POST', 'order'): post_order,
+    ('PUT', 'order'): put_order,
+    ('DELETE', 'order'): delete_order,
+    ('DELETE', 'order/all'): delete_order_all,
+    ('POST', 'order/bulk'): post_order_bulk,
+    ('PUT', 'order/bulk'): put_order_bulk,
+    ('GET', 'instrument'): get_instrument,
+    ('GET', 'position'): get_position,
+    ('GET', 'user/margin'): get_margin,
+}
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    # Keep-alive, so pooled client connections are reused as they would be against BitMEX. Without
+    # TCP_NODELAY, Nagle's algorithm holds small responses back waiting for the client's delayed ACK.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/realtime':
+            self.realtime()
+        else:
+            self.rest('GET')
+
+    def do_POST(self):
+        self.rest('POST')
+
+    def do_PUT(self):
+        self.rest('PUT')
+
+    def do_DELETE(self):
+        self.rest('DELETE')
+
+    def rest(self, verb):
+        sim = self.server.simulator
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        time.sleep(sim.delay())
+
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+            for key, values in parse_qs(url.query).items():
+                params[key] = json.loads(values[0]) if key == 'filter' else values[0]
+        except ValueError:
+            return self.respond(400, error('Invalid JSON body.'))
+
+        if not url.path.startswith(API_PREFIX):
+            return self.respond(404, error('Not Found'))
+        route = ROUTES.get((verb, url.path[len(API_PREFIX):].rstrip('/')))
+        if route is None:
+            return self.respond(404, error('Not Found'))
+        apiKey = self.headers.get('api-key')
+        if not apiKey:
+            return self.respond(401, error('Missing API key.'))
+        account = sim.account(apiKey)
+
+        cost = max(1, (len(params['orders']) + 1) // 2) if isinstance(params.get('orders'), list) else 1
+        allowed, remaining, reset, retryAfter = sim.rateLimit.take(account, cost, force=verb == 'DELETE')
+        headers = {'x-ratelimit-limit': sim.rateLimit.limit, 'x-ratelimit-remaining': remaining,
+                   'x-ratelimit-reset': reset}
+        if not allowed:
+            headers['Retry-After'] = retryAfter
+            return self.respond(429, error('Rate limit exceeded, retry in %d seconds.' % retryAfter), headers)
+
+        try:
+            self.respond(200, route(sim, account, params), headers)
+        except SimulatorError as e:
+            self.respond(e.status, error(e.message), headers)
+        except (KeyError, TypeError, ValueError) as e:
+            self.respond(400, error('Invalid request: %s' % e), headers)
+
+    def respond(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def realtime(self):
+        sim = self.server.simulator
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key or self.headers.get('Upgrade', '').lower() != 'websocket':
+            return self.respond(400, error('Expected a websocket upgrade.'))
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', websocket.accept_key(key))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        apiKey = self.headers.get('api-key')
+        connection = Connection(sim, self.wfile, sim.account(apiKey.strip()) if apiKey else None, self.connection)
+        sim.hub.add(connection)
+        connection.send_json({'info': 'Welcome to the BitMEX Realtime API.', 'version': 'simulator',
+                              'timestamp': timestamp(), 'docs': 'https://www.bitmex.com/app/wsAPI',
+                              'limit': {'remaining': 39}})
+        query = parse_qs(urlparse(self.path).query)
+        if 'subscribe' in query:
+            sim.subscribe(connection, query['subscribe'][0].split(','))
+
+        try:
+            while not connection.closed.is_set():
+                opcode, payload = websocket.read_frame(self.rfile)
+                if opcode == websocket.CLOSE:
+                    connection.send(payload, websocket.CLOSE)
+                    break
+                elif opcode == websocket.PING:
+                    connection.send(payload, websocket.PONG)
+                elif opcode == websocket.TEXT:
+                    self.command(connection, payload.decode('utf-8'))
+        except (IOError, OSError, socket.error):
+            pass
+        finally:
+            # Let the sender flush what's queued (the close frame) before the socket goes.
+            connection.queue.put((0, None))
+            connection.sender.join(1 + sim.delay())
+            connection.close()
+
+    def command(self, connection, text):
+        if text == 'ping':
+            return connection.send('pong')
+        try:
+            command = json.loads(text)
+        except ValueError:
+            return connection.send_json({'status': 400, 'error': 'Unable to parse request.'})
+        if command.get('op') == 'subscribe':
+            self.server.simulator.subscribe(connection, command.get('args') or [])
+        else:
+            connection.send_json({'status': 400, 'error': 'Unknown or unsupported op: %s' % command.get('op'),
+                                  'request': command})
+
+
+def error(message):
+    return {'error': {'message': message, 'name': 'HTTPError'}}
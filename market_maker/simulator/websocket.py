@@ -0,0 +1,49 @@
+"""Just enough of RFC 6455 to serve the realtime API: the handshake, and unfragmented text frames."""
+from __future__ import absolute_import
+import base64
+import hashlib
+import struct
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+
+def accept_key(key):
+    """The Sec-WebSocket-Accept value answering a client's Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1(key.encode('ascii') + GUID).digest()).decode('ascii')
+
+
+def encode_frame(payload, opcode=TEXT):
+    """A single, final, unmasked frame, as servers send them."""
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def read_frame(rfile):
+    """Read one frame from a client. Returns (opcode, payload), or (CLOSE, b'') if the connection closed."""
+    header = rfile.read(2)
+    if len(header) < 2:
+        return CLOSE, b''
+    first, second = struct.unpack('!BB', header)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', rfile.read(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', rfile.read(8))
+    mask = rfile.read(4) if second & 0x80 else None
+    payload = rfile.read(length)
+    if mask:
+        payload = bytes(bytearray(b ^ mask[i % 4] for i, b in enumerate(bytearray(payload))))
+    return first & 0x0F, payload
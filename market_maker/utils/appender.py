@@ -0,0 +1,109 @@
+"""Append lines to a file from a background thread.
+
+The thread doing the work only pays for a queue put per item. A background thread encodes items into lines
+and appends them in batches, every FLUSH_INTERVAL, so a crash loses at most that much. strftime patterns in
+the path, in UTC as of each item's time, start a new file when they change; missing directories are made.
+Subclasses say how an item becomes a line, and may open files differently.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import threading
+import time
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from queue import Queue, Full, Empty
+
+logger = logging.getLogger('root')
+
+# Buffered lines are written to disk this often (seconds).
+FLUSH_INTERVAL = 1
+
+
+class Appender(object):
+
+    """Appends items to `path`, as encode() turns them into lines. Up to `capacity` items wait to be
+       written; more are refused. `what` names the items in the log."""
+
+    def __init__(self, path, capacity=None, what='lines', name='appender'):
+        self.path = path
+        self.capacity = capacity
+        self.what = what
+        self.name = name
+        self.file = None
+        self.filename = None
+        self.__start()
+
+    def append(self, at, *item):
+        """Queue `item`, from Unix time `at`, to be written. Returns False if there's no room for it."""
+        try:
+            self.queue.put_nowait((at, item))
+            return True
+        except Full:
+            return False
+
+    def close(self):
+        """Write out everything appended so far and close the file."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def restart(self):
+        """Start over with a fresh queue and thread, in a forked process that has neither."""
+        self.file = self.filename = None
+        self.__start()
+
+    def encode(self, at, *item):
+        """The line, with its newline, to write for `item`."""
+        raise NotImplementedError
+
+    def open(self, filename):
+        # Unbuffered, so each batch of whole lines is one append: processes can share a file.
+        return open(filename, 'ab', 0)
+
+    def __start(self):
+        self.queue = Queue(self.capacity or 0)
+        self.thread = threading.Thread(target=self.__run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        lines = []
+        filename = None
+        flushed = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=FLUSH_INTERVAL)
+            except Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                at, fields = item
+                name = time.strftime(self.path, time.gmtime(at))
+                if name != filename and lines:
+                    self.__write(filename, lines)
+                    lines = []
+                filename = name
+                lines.append(self.encode(at, *fields))
+            if lines and time.time() - flushed >= FLUSH_INTERVAL:
+                self.__write(filename, lines)
+                lines = []
+                flushed = time.time()
+        if lines:
+            self.__write(filename, lines)
+        if self.file:
+            self.file.close()
+
+    def __write(self, filename, lines):
+        if filename != self.filename:
+            if self.file:
+                self.file.close()
+            directory = os.path.dirname(filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            logger.info("Writing %s to %s" % (self.what, filename))
+            self.file = self.open(filename)
+            self.filename = filename
+        self.file.write(''.join(lines).encode('utf-8'))
+        self.file.flush()
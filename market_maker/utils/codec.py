@@ -0,0 +1,18 @@
+import importlib
+
+# JSON backends, fastest first. orjson and ujson are optional; the standard library is always there.
+DECODERS = ['orjson', 'ujson', 'json']
+
+
+def get_decoder(name=None):
+    """Return (backend name, loads function) for the named JSON backend.
+       If name is None, use the fastest one that is installed."""
+    candidates = [name] if name else DECODERS
+    for candidate in candidates:
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        return candidate, module.loads
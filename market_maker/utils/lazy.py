@@ -0,0 +1,28 @@
+"""Import heavy modules on first use, so starting up doesn't wait on them.
+
+    np = lazy.module('numpy', globals(), 'np')
+
+binds `np` to a stand-in. The first attribute looked up on it imports numpy and rebinds `np`, in the
+module that asked, to numpy itself; from then on it costs nothing extra. Don't copy the stand-in
+anywhere else (default arguments, other names): those copies would stay stand-ins.
+"""
+from __future__ import absolute_import
+import importlib
+
+
+class LazyModule(object):
+
+    def __init__(self, name, namespace, alias):
+        self._name = name
+        self._namespace = namespace
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        self._namespace[self._alias] = module
+        return getattr(module, attr)
+
+
+def module(name, namespace, alias=None):
+    """A stand-in for module `name`, bound as `alias` (or `name`) in `namespace`: see above."""
+    return LazyModule(name, namespace, alias or name)
@@ -1,14 +1,166 @@
+"""Logging that never blocks the threads doing the work.
+
+Log records go into a bounded queue, and a background thread writes them to the console. When the console
+can't keep up (a slow pipe, a paused terminal), records that don't fit are dropped and counted rather than
+making the websocket or quoting threads wait; the count is logged once the console catches up, and served
+as log_records_dropped_total with the other metrics.
+
+High-rate events (executions, order changes) can also go to an event log: one JSON object per line, with
+the time, the kind of event and its fields. Set EVENT_LOG_FILE to write one. It is written the same way.
+"""
+from __future__ import absolute_import
+import atexit
+import json
 import logging
+import os
+import time
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from queue import Queue, Full, Empty
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2: log synchronously
+    QueueHandler = QueueListener = None
 from market_maker.settings import settings
+from market_maker.utils.appender import Appender
+from market_maker.utils.metrics import metrics
+
+FORMAT = '%(asctime)s - %(levelname)s - %(module)s - %(message)s'
+
+# How long stopping the console writer waits for room in a full queue (seconds) before dropping the oldest
+# record to make some.
+STOP_TIMEOUT = 1
+
+_listener = None
+_events = None
 
 
 def setup_custom_logger(name):
-    formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
+    formatter = logging.Formatter(fmt=FORMAT)
 
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
 
     logger = logging.getLogger(name)
     logger.setLevel(settings.LOG_LEVEL)
+    if QueueHandler and settings.LOG_QUEUE_SIZE:
+        global _listener
+        if _listener is None:
+            _listener = _Listener(DroppingQueueHandler(Queue(settings.LOG_QUEUE_SIZE)), handler)
+            _listener.start()
+            atexit.register(flush)
+        handler = _listener.source
     logger.addHandler(handler)
+
+    if settings.EVENT_LOG_FILE:
+        global _events
+        if _events is None:
+            _events = EventLog(settings.EVENT_LOG_FILE, settings.LOG_QUEUE_SIZE or None)
+            atexit.register(_events.close)
     return logger
+
+
+def event(kind, **fields):
+    """Record an event, if there's an event log. Cheap enough to call from hot paths."""
+    if _events:
+        _events.record(kind, fields)
+
+
+def flush():
+    """Write out everything logged so far. Call before exec() or any other exit that skips atexit."""
+    if _listener:
+        _listener.stop()
+    if _events:
+        _events.close()
+
+
+if QueueHandler:
+    class DroppingQueueHandler(QueueHandler):
+
+        """Puts records on a bounded queue, dropping (and counting) those that don't fit."""
+
+        def __init__(self, queue):
+            QueueHandler.__init__(self, queue)
+            self.dropped = 0
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+                metrics.inc('log_records_dropped_total', level=record.levelname)
+
+    class _Listener(QueueListener):
+
+        """Writes queued records out, and says how many were dropped once it's caught up."""
+
+        def __init__(self, source, handler):
+            QueueListener.__init__(self, source.queue, handler, respect_handler_level=True)
+            self.source = source
+            self.reported = 0
+
+        def handle(self, record):
+            QueueListener.handle(self, record)
+            dropped = self.source.dropped
+            if dropped > self.reported and self.queue.empty():
+                QueueListener.handle(self, logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'module': 'log',
+                    'msg': "Dropped %d log records: the console couldn't keep up." % (dropped - self.reported)}))
+                self.reported = dropped
+
+        def stop(self):
+            if self._thread:
+                QueueListener.stop(self)
+
+        def enqueue_sentinel(self):
+            # The stock version uses put_nowait(), which raises Full when the console has fallen behind.
+            while True:
+                try:
+                    self.queue.put(self._sentinel, timeout=STOP_TIMEOUT)
+                    return
+                except Full:
+                    pass
+                try:
+                    record = self.queue.get_nowait()
+                except Empty:
+                    continue
+                self.queue.task_done()
+                self.source.dropped += 1
+                metrics.inc('log_records_dropped_total', level=record.levelname)
+
+        def restart(self):
+            """Start over with a fresh queue and thread, in a forked process that has neither."""
+            self.queue = self.source.queue = Queue(self.queue.maxsize)
+            self._thread = None
+            self.start()
+
+
+class EventLog(Appender):
+
+    """Appends events to `path` as JSON lines. strftime patterns in the path, in UTC, start a new file when
+       they change. Up to `capacity` events are buffered; more are dropped and counted."""
+
+    def __init__(self, path, capacity=None):
+        self.dropped = metrics.counter('events_dropped_total')
+        Appender.__init__(self, path, capacity, what='events', name='events')
+
+    def record(self, kind, fields):
+        if not self.append(time.time(), kind, fields):
+            self.dropped.inc()
+
+    def encode(self, at, kind, fields):
+        event = {'time': round(at, 6), 'event': kind}
+        event.update(fields)
+        return json.dumps(event, separators=(',', ':'), default=str) + '\n'
+
+
+def _after_fork():
+    if _listener:
+        _listener.restart()
+    if _events:
+        _events.restart()
+
+
+if hasattr(os, 'register_at_fork'):
+    # Threads don't survive a fork; without this, forked quoting processes would queue records forever.
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,338 @@
+"""Latency histograms and counters for the quoting pipeline, served in the Prometheus text format.
+
+A quote's trip through the bot is timed at each stage, in wall-clock seconds:
+
+    frame receive -> parse -> table apply -> strategy decision -> REST send -> REST response
+                                                                          \\-> websocket order ack
+
+Stages are recorded where they happen (ws_thread, OrderManager.converge_orders, BitMEX._curl_bitmex) into
+the module's `metrics` registry. Set METRICS_PORT to serve it at http://127.0.0.1:<port>/metrics.
+
+Histograms are HDR-style: values are counted in microseconds, in buckets that double in width every
+power of two but are split into SUB_BUCKETS linear steps, so every recorded value is kept to within 1/64
+(about 1.5%) of itself from a microsecond up to an hour, in a fixed ~1700 counters. Recording is O(1) and
+percentiles are exact to that precision, where fixed Prometheus buckets would have to be chosen up front.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from market_maker.utils import lazy
+
+np = lazy.module('numpy', globals(), 'np')
+
+logger = logging.getLogger('root')
+
+PREFIX = 'marketmaker_'
+
+# What each metric means. Everything recorded should be listed here.
+HELP = {
+    'ws_messages_total': 'Websocket messages applied, by table and action.',
+    'ws_parse_seconds': 'Frame received to message decoded.',
+    'ws_apply_seconds': 'Message decoded to tables and order books updated, by table.',
+    'ws_reconnects_total': 'Websocket connections lost and recovered.',
+    'ws_reconnect_seconds': 'Websocket connection lost to our data rebuilt from a new one.',
+    'decision_seconds': 'Start of a quoting pass to the orders it wants decided, by symbol.',
+    'tick_to_decision_seconds': 'Newest market data in a pass received to its orders decided, by symbol.',
+    'rest_send_seconds': 'Orders decided to the request carrying them sent, rate limiting included, by symbol.',
+    'rest_response_seconds': 'REST request sent to response received, by verb and endpoint.',
+    'rest_responses_total': 'REST responses, by verb, endpoint and HTTP status.',
+    'rest_retries_total': 'REST requests retried, by reason.',
+    'ws_ack_seconds': 'Order request sent to the order showing up changed on the websocket, by symbol.',
+    'tick_to_trade_seconds': 'Market data received to the orders it caused showing up on the websocket, by symbol.',
+    'orders_amended_total': 'Orders amended, by symbol.',
+    'orders_created_total': 'Orders created, by symbol.',
+    'orders_cancelled_total': 'Orders cancelled, by symbol.',
+    'log_records_dropped_total': 'Log records dropped because the console could not keep up, by level.',
+    'events_dropped_total': 'Events dropped because the event log could not keep up.',
+    'delta_threshold_crossings_total': 'Times the portfolio delta went over DELTA_ALERT_THRESHOLD, or back under.',
+    'startup_seconds': 'Process start to each stage of starting up: imported, websocket_open, data_images, '
+                       'orders_cancelled and first_quote (by symbol).',
+}
+
+# Quantiles reported for each histogram. 1 is the maximum.
+QUANTILES = [0.5, 0.9, 0.99, 0.999, 1]
+
+# Orders we're waiting to see acknowledged are forgotten after this long (seconds).
+ACK_TIMEOUT = 60
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+MAX_MICROS = 3600 * 10 ** 6  # Longer values are counted as an hour
+# Index of MAX_MICROS (see _indexes), plus one
+BUCKETS = ((MAX_MICROS.bit_length() - SUB_BUCKET_BITS) * HALF_BUCKETS +
+           (MAX_MICROS >> (MAX_MICROS.bit_length() - SUB_BUCKET_BITS)) + 1)
+
+
+def _indexes(micros):
+    """Bucket index of each value in an int64 array of microseconds."""
+    micros = np.clip(micros, 0, MAX_MICROS)
+    # bit_length(v) - SUB_BUCKET_BITS, for values past the first SUB_BUCKETS
+    shift = np.maximum(np.frexp(micros.astype(np.float64))[1] - SUB_BUCKET_BITS, 0)
+    return np.where(shift > 0, shift * HALF_BUCKETS + (micros >> shift), micros)
+
+
+def _highest(index):
+    """The largest value, in microseconds, counted in a bucket."""
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // HALF_BUCKETS - 1
+    return ((index - shift * HALF_BUCKETS + 1) << shift) - 1
+
+
+class _Buffered(object):
+
+    """Something values are recorded into, from any thread, on a hot path.
+
+    Recording appends to a deque, which is thread-safe and costs a fraction of taking a lock. Values are
+    folded in, all at once, when read or after FOLD_AT of them have piled up.
+    """
+
+    FOLD_AT = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer = deque()
+
+    def fold(self):
+        with self.lock:
+            buffer = self.buffer
+            # Other threads may keep appending; take what's there now.
+            values = [buffer.popleft() for _ in range(len(buffer))]
+            if values:
+                self._fold(values)
+
+
+class Counter(_Buffered):
+
+    def __init__(self):
+        _Buffered.__init__(self)
+        self._value = 0
+
+    def inc(self, n=1):
+        self.buffer.append(n)
+        if len(self.buffer) >= self.FOLD_AT:
+            self.fold()
+
+    def _fold(self, values):
+        self._value += sum(values)
+
+    def value(self):
+        self.fold()
+        return self._value
+
+
+class Histogram(_Buffered):
+
+    """Counts of durations, in HDR-style buckets."""
+
+    def __init__(self):
+        _Buffered.__init__(self)
+        self.counts = None  # Allocated when first needed, so creating one doesn't need NumPy yet
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buffer.append(seconds)
+        if len(self.buffer) >= self.FOLD_AT:
+            self.fold()
+
+    def _fold(self, values):
+        if self.counts is None:
+            self.counts = np.zeros(BUCKETS, np.int64)
+        values = np.array(values)
+        self.counts += np.bincount(_indexes((values * 1e6).astype(np.int64)), minlength=len(self.counts))
+        self.sum += float(values.sum())
+        self.max = max(self.max, float(values.max()))
+
+    def summary(self, qs=QUANTILES):
+        """(values, count, sum): the seconds at or below which each fraction in `qs` of the recorded values
+           lie, how many there are and what they add up to."""
+        self.fold()
+        with self.lock:
+            if self.counts is None:
+                return [float('nan')] * len(qs), 0, 0.0
+            cumulative = np.cumsum(self.counts)
+            total, maximum = self.sum, self.max
+        count = int(cumulative[-1])
+        if count == 0:
+            return [float('nan')] * len(qs), 0, 0.0
+        wanted = np.maximum(1, (np.array(qs) * count + 0.5).astype(np.int64))
+        indexes = np.searchsorted(cumulative, wanted)
+        return [min(_highest(int(i)) / 1e6, maximum) for i in indexes], count, total
+
+
+class Registry(object):
+
+    """Named counters and histograms, each optionally split by labels, plus order ack tracking.
+
+    Hot paths should hold on to the Counter or Histogram that counter() or histogram() returns, rather than
+    look it up by name and labels through inc() or observe() every time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> Counter
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.decisions = {}  # symbol -> (market data received, orders decided)
+        self.pending = OrderedDict()  # orderID or clOrdID -> (symbol, request sent, market data received)
+        self.started = _process_started()
+        self.milestones = OrderedDict()  # (stage, labels) -> seconds since started
+
+    def counter(self, name, **labels):
+        return self.__get(self.counters, Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self.__get(self.histograms, Histogram, name, labels)
+
+    def inc(self, name, n=1, **labels):
+        self.counter(name, **labels).inc(n)
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).record(seconds)
+
+    def __get(self, metrics, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = metrics.setdefault(key, kind())
+        return metric
+
+    #
+    # Stages spanning threads
+    #
+    def decided(self, symbol, received, started, decided):
+        """A quoting pass for `symbol` started at `started`, on market data received at `received` (None if
+           unknown), and decided which orders it wants at `decided`."""
+        self.observe('decision_seconds', decided - started, symbol=symbol)
+        if received:
+            self.observe('tick_to_decision_seconds', decided - received, symbol=symbol)
+        self.decisions[symbol] = (received, decided)
+
+    def order_sent(self, symbol, keys, sent, first=True):
+        """An order request for `symbol` went out at `sent`, changing the orders with these orderIDs (or
+           clOrdIDs, for new orders). Each symbol's requests wait for its previous pass to finish, so they
+           belong to its latest decision. `first` is False for retries."""
+        received, decided = self.decisions.get(symbol, (None, None))
+        if first and decided:
+            self.observe('rest_send_seconds', sent - decided, symbol=symbol)
+        with self.lock:
+            for key in keys:
+                self.pending[key] = (symbol, sent, received)
+            while self.pending:
+                key, (_, oldest, _) = next(iter(self.pending.items()))
+                if sent - oldest < ACK_TIMEOUT:
+                    break
+                del self.pending[key]
+
+    def order_acked(self, row, received):
+        """An order table row, received at `received`. Completes the stages of a request waiting on it."""
+        with self.lock:
+            entry = self.pending.pop(row.get('orderID'), None) or self.pending.pop(row.get('clOrdID'), None)
+        if entry is None:
+            return
+        symbol, sent, tick = entry
+        self.observe('ws_ack_seconds', received - sent, symbol=symbol)
+        if tick:
+            self.observe('tick_to_trade_seconds', received - tick, symbol=symbol)
+
+    def milestone(self, stage, **labels):
+        """Starting up reached `stage`. Only the first time counts. Returns seconds since the process started."""
+        key = (stage, tuple(sorted(labels.items())))
+        if key not in self.milestones:
+            self.milestones[key] = time.time() - self.started
+            self.observe('startup_seconds', self.milestones[key], stage=stage, **labels)
+        return self.milestones[key]
+
+    #
+    # Exposition
+    #
+    def render(self):
+        """Everything recorded, in the Prometheus text format."""
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: item[0])
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        lines = []
+        typed = set()
+        for (name, labels), counter in counters:
+            if name not in typed:
+                lines.extend(_header(name, 'counter'))
+                typed.add(name)
+            lines.append('%s%s%s %d' % (PREFIX, name, _labels(labels), counter.value()))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.extend(_header(name, 'summary'))
+                typed.add(name)
+            values, count, total = histogram.summary()
+            for q, value in zip(QUANTILES, values):
+                lines.append('%s%s%s %.6g' % (PREFIX, name, _labels(labels + (('quantile', str(q)),)), value))
+            lines.append('%s%s_sum%s %.6f' % (PREFIX, name, _labels(labels), total))
+            lines.append('%s%s_count%s %d' % (PREFIX, name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve these metrics at http://host:port/metrics from a background thread. Returns the server;
+           call shutdown() on it to stop."""
+        server = _Server((host, port), _Handler)
+        server.registry = self
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving metrics at http://%s:%d/metrics" % (host, server.server_address[1]))
+        return server
+
+
+def _process_started():
+    """When this process started (Unix time): from /proc where there is one, so imports are counted too."""
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = float(f.read().rpartition(')')[2].split()[19])  # Field 22, starttime
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+def _header(name, kind):
+    return ['# HELP %s%s %s' % (PREFIX, name, HELP.get(name, name)), '# TYPE %s%s %s' % (PREFIX, name, kind)]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# The process's metrics. Everything records here.
+metrics = Registry()
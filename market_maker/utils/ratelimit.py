@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import threading
+import time
+
+# Request priorities, lowest first. When the budget is short, cancels go before amends before creates.
+CANCEL = 0
+AMEND = 1
+DEFAULT = 1
+CREATE = 2
+
+
+class RateLimiter(object):
+
+    """Token bucket for the REST API, kept in step with the rate limit headers BitMEX sends back.
+
+    Every request takes tokens before it is sent. When there aren't enough, requests wait their turn in
+    priority order instead of being sent and rejected with a 429. Each response corrects our idea of the
+    budget from `x-ratelimit-limit`, `x-ratelimit-remaining` and `x-ratelimit-reset`; `retry-after`
+    on a 429 holds everything back for as long as the server asks.
+    """
+
+    def __init__(self, limit=300, period=300):
+        """By default BitMEX allows 300 requests per 5 minutes, refilled continuously."""
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.cond = threading.Condition()
+        self.waiting = []  # Heap of (priority, ticket)
+        self.tickets = itertools.count()
+
+    def acquire(self, priority=DEFAULT, cost=1, timeout=None):
+        """Block until `cost` tokens are available and no higher priority request is waiting, then take them.
+           Cancels are never held back: BitMEX always accepts them, even over the limit.
+           Returns False, without taking anything, if that takes longer than `timeout` seconds."""
+        give_up_at = None if timeout is None else time.time() + timeout
+        with self.cond:
+            if priority == CANCEL:
+                self._refill(time.time())
+                self.tokens -= cost
+                return True
+
+            entry = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    wait = None  # Not our turn; wait to be notified.
+                    if self.waiting[0] == entry:
+                        wait = self.blocked_until - now
+                        if wait <= 0:
+                            needed = min(cost, self.limit) - self.tokens
+                            if needed <= 0:
+                                self.tokens -= cost
+                                return True
+                            wait = needed * self.period / self.limit
+                    if give_up_at is not None:
+                        if now >= give_up_at:
+                            return False
+                        wait = give_up_at - now if wait is None else min(wait, give_up_at - now)
+                    self.cond.wait(wait)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+
+    def update(self, response):
+        """Sync the bucket with the rate limit headers on a response."""
+        headers = response.headers
+        now = time.time()
+        with self.cond:
+            self._refill(now)
+            if 'x-ratelimit-limit' in headers:
+                self.limit = int(headers['x-ratelimit-limit'])
+            if 'x-ratelimit-remaining' in headers:
+                self.tokens = float(headers['x-ratelimit-remaining'])
+                if self.tokens <= 0 and 'x-ratelimit-reset' in headers:
+                    self.blocked_until = max(self.blocked_until, float(headers['x-ratelimit-reset']))
+            if response.status_code == 429:
+                self.tokens = min(self.tokens, 0)
+                self.blocked_until = max(self.blocked_until, now + float(headers.get('retry-after', 1)))
+            self.cond.notify_all()
+
+    def remaining(self):
+        """Tokens currently available."""
+        with self.cond:
+            self._refill(time.time())
+            return max(self.tokens, 0)
+
+    def budget(self):
+        """Fraction of the rate limit currently available, from 0 to 1."""
+        return self.remaining() / self.limit
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
@@ -0,0 +1,85 @@
+import random
+import threading
+
+# Why a request was retried, for RetryStats.
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+RATELIMITED = 'ratelimited'
+UNAVAILABLE = 'unavailable'
+
+
+class RetryPolicy(object):
+
+    """When and how long to wait before retrying a REST call.
+
+    Retries back off exponentially with full jitter: before retry n we sleep a random time between 0 and
+    min(max_delay, base_delay * 2 ** n), so many clients recovering from the same outage don't retry in
+    lockstep. Every call also has a deadline; once it has passed we stop retrying and give up.
+    `deadlines` overrides it per endpoint, as {(verb, api): seconds}.
+    """
+
+    def __init__(self, max_attempts=10, base_delay=0.25, max_delay=5, deadline=30, deadlines=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+
+    def deadline_for(self, verb, api):
+        """Seconds we may spend on one call to this endpoint, retries included."""
+        return self.deadlines.get((verb, api.lstrip('/')), self.deadline)
+
+    def backoff(self, attempt):
+        """Seconds to sleep before retry number `attempt` (starting at 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def is_idempotent(verb, api, postdict=None):
+    """True if sending this request twice has the same effect as sending it once.
+
+    GET, PUT and DELETE are. A POST creating orders is too, as long as every order carries a clOrdID:
+    BitMEX rejects the second copy as a duplicate instead of placing it again. Any other POST may have
+    taken effect even if we never saw the response, so we don't resend it after a timeout.
+    """
+    if verb != 'POST':
+        return True
+    if api.lstrip('/') in ('order', 'order/bulk') and postdict:
+        orders = postdict.get('orders', [postdict])
+        return all(order.get('clOrdID') for order in orders)
+    return False
+
+
+class RetryStats(object):
+
+    """Counters describing how much retrying the REST client has had to do."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = {}
+        self.gave_up = 0
+        self.deadline_exceeded = 0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_retry(self, reason):
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def record_give_up(self, deadline_exceeded=False):
+        with self.lock:
+            self.gave_up += 1
+            if deadline_exceeded:
+                self.deadline_exceeded += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'retries': sum(self.retries.values()),
+                'retries_by_reason': dict(self.retries),
+                'gave_up': self.gave_up,
+                'deadline_exceeded': self.deadline_exceeded,
+            }
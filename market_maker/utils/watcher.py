@@ -0,0 +1,151 @@
+"""Watch files for changes without statting them on every pass.
+
+On Linux, the directories holding the files are watched with inotify, so checking is a non-blocking read
+that almost always finds nothing, and files are only statted after the kernel says something happened to
+them. Elsewhere (or if inotify can't be set up), every check stats every file.
+
+Editors often save by writing a new file and renaming it over the old one, which inotify reports on the
+directory rather than the file; watching directories catches both, and files that don't exist yet.
+"""
+from __future__ import absolute_import
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+
+logger = logging.getLogger('root')
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then len bytes of name
+
+
+class FileWatcher(object):
+
+    """The modification times of a set of files, kept up to date as cheaply as the platform allows.
+
+    Callers keep the last mtimes() they saw and compare; that way any number of them, in any threads, can
+    each notice a change once.
+    """
+
+    def __init__(self, paths=()):
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.times = {}  # path -> mtime, or None if it doesn't exist
+        self.inotify = None
+        self.pid = os.getpid()
+        if sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                logger.warning("Can't watch files with inotify (%s); polling them instead." % e)
+        self.watch(paths)
+
+    def watch(self, paths):
+        """Start watching `paths` too."""
+        with self.lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                if path in self.paths:
+                    continue
+                self.paths.add(path)
+                self.times[path] = _mtime(path)
+                if self.inotify:
+                    try:
+                        self.inotify.watch(path)
+                    except OSError as e:
+                        logger.warning("Can't watch %s with inotify (%s); polling instead." % (path, e))
+                        self.inotify.close()
+                        self.inotify = None
+
+    def mtimes(self):
+        """{path: modification time, or None if missing} for every watched file, as of now."""
+        with self.lock:
+            if self.inotify and self.pid != os.getpid():
+                # A forked child shares the parent's inotify descriptor; the parent would take its events.
+                self.inotify = self.inotify.reopen(self.paths)
+                self.pid = os.getpid()
+            if self.inotify:
+                touched = self.inotify.read()
+            else:
+                touched = self.paths
+            for path in touched:
+                self.times[path] = _mtime(path)
+            return dict(self.times)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class _Inotify(object):
+
+    """A non-blocking inotify descriptor watching the directories of some files."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise _error()
+        self.directories = {}  # wd -> directory
+        self.files = {}  # (directory, name) -> path
+
+    def watch(self, path):
+        directory, name = os.path.split(path)
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), MASK)
+        if wd < 0:
+            raise _error()
+        self.directories[wd] = directory
+        self.files[directory, name] = path
+
+    def read(self):
+        """Paths that something has happened to since the last read."""
+        touched = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return touched
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+                offset += length
+                path = self.files.get((self.directories.get(wd), name))
+                if path:
+                    touched.add(path)
+
+    def reopen(self, paths):
+        """A new descriptor, watching the same files."""
+        os.close(self.fd)
+        inotify = _Inotify()
+        for path in paths:
+            inotify.watch(path)
+        return inotify
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _error():
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code))
@@ -0,0 +1,197 @@
+from bisect import bisect_left
+import time
+
+
+# Full-depth order book, maintained incrementally from `orderBookL2` deltas.
+#
+# Each side keeps its price levels in a sorted array, best price first, with a parallel array of sizes.
+# That makes the top of book an O(1) lookup and lets us walk the depth from the inside out without
+# sorting anything per tick. The running total of each side is kept up to date on every delta.
+class BookSide(object):
+
+    def __init__(self, descending=False):
+        # Bids are best-first when sorted high to low. Store negated prices so both sides share one
+        # ascending sort order and index 0 is always the best level.
+        self.sign = -1 if descending else 1
+        self.keys = []
+        self.sizes = []
+        self.total = 0
+
+    def set(self, price, size):
+        '''Set the size resting at a price, adding the level if it is new.'''
+        key = self.sign * price
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            self.total += size - self.sizes[i]
+            self.sizes[i] = size
+        else:
+            self.keys.insert(i, key)
+            self.sizes.insert(i, size)
+            self.total += size
+
+    def remove(self, price):
+        '''Remove a price level.'''
+        key = self.sign * price
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            self.total -= self.sizes[i]
+            del self.keys[i]
+            del self.sizes[i]
+
+    def clear(self):
+        del self.keys[:]
+        del self.sizes[:]
+        self.total = 0
+
+    def copy(self):
+        side = BookSide()
+        side.sign = self.sign
+        side.keys = self.keys[:]
+        side.sizes = self.sizes[:]
+        side.total = self.total
+        return side
+
+    def best(self):
+        '''Best price on this side, or None if the side is empty.'''
+        return self.sign * self.keys[0] if self.keys else None
+
+    def price(self, level):
+        return self.sign * self.keys[level]
+
+    def size_at(self, price):
+        '''Size resting at a price; 0 if there is no such level.'''
+        key = self.sign * price
+        i = bisect_left(self.keys, key)
+        return self.sizes[i] if i < len(self.keys) and self.keys[i] == key else 0
+
+    def depth(self, levels=None):
+        '''Return ([prices], [sizes]) from the best level outwards.'''
+        keys = self.keys if levels is None else self.keys[:levels]
+        return [self.sign * k for k in keys], self.sizes[:len(keys)]
+
+    def cumulative_depth(self, levels=None):
+        '''Total size resting in the best `levels` levels (all of them if None).'''
+        if levels is None or levels >= len(self.sizes):
+            return self.total
+        return sum(self.sizes[:levels])
+
+    def price_at_depth(self, qty):
+        '''Return the first price, from the best level outwards, with more than `qty` contracts resting
+           at or in front of it. None if the whole side holds less than that.'''
+        if self.total <= qty:
+            return None
+        cumulative = 0
+        for i, size in enumerate(self.sizes):
+            cumulative += size
+            if cumulative > qty:
+                return self.sign * self.keys[i]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# One thread applies deltas to a book; others read it through snapshot(). Copying the whole book on every
+# delta would cost far more than the delta, so instead `seq` works as a seqlock, as on the MarketDataBus: it is
+# odd while a delta is being applied, and readers copy the book and retry if it changed meanwhile.
+class OrderBook(object):
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide()
+        # Updates and deletes only carry the level's id, not its price. Remember where each id lives.
+        self.prices = {}
+        self.seq = 0
+
+    @classmethod
+    def from_depth(cls, symbol, bids, asks, bidTotal=None, askTotal=None):
+        '''Build a book from ([prices], [sizes]) per side, best level first, as depth() returns them.
+           The totals default to the sum of the given levels; pass them if the depth is truncated.'''
+        book = cls(symbol)
+        for bookSide, (prices, sizes), total in ((book.bids, bids, bidTotal), (book.asks, asks, askTotal)):
+            bookSide.keys = [bookSide.sign * p for p in prices]
+            bookSide.sizes = list(sizes)
+            bookSide.total = sum(bookSide.sizes) if total is None else total
+        return book
+
+    def side(self, side):
+        return self.bids if side == 'Buy' else self.asks
+
+    #
+    # Deltas
+    #
+    def apply(self, action, rows):
+        '''Apply an orderBookL2 partial, insert, update or delete.'''
+        if action not in ('partial', 'insert', 'update', 'delete'):
+            raise Exception("Unknown action: %s" % action)
+        self.seq += 1  # Odd: changing
+        try:
+            getattr(self, action)(rows)
+        finally:
+            self.seq += 1
+
+    def partial(self, rows):
+        self.bids.clear()
+        self.asks.clear()
+        self.prices.clear()
+        self.insert(rows)
+
+    def insert(self, rows):
+        for row in rows:
+            self.prices[row['id']] = row['price']
+            self.side(row['side']).set(row['price'], row['size'])
+
+    def update(self, rows):
+        for row in rows:
+            price = self.prices.get(row['id'])
+            if price is None:
+                continue  # Level not seen yet. Could happen before the partial.
+            self.side(row['side']).set(price, row['size'])
+
+    def delete(self, rows):
+        for row in rows:
+            price = self.prices.pop(row['id'], None)
+            if price is not None:
+                self.side(row['side']).remove(price)
+
+    #
+    # Reads
+    #
+    def snapshot(self):
+        '''A copy of the book to read from, consistent even while another thread applies deltas to this one.
+           It can't take deltas itself.'''
+        while True:
+            seq = self.seq
+            if seq & 1:
+                time.sleep(0)
+                continue
+            book = OrderBook(self.symbol)
+            book.bids = self.bids.copy()
+            book.asks = self.asks.copy()
+            book.seq = seq
+            if self.seq == seq:
+                return book
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def depth(self, side, levels=None):
+        '''Return ([prices], [sizes]) for 'Buy' or 'Sell', from the best level outwards.'''
+        return self.side(side).depth(levels)
+
+    def cumulative_depth(self, side, levels=None):
+        '''Contracts resting in the best `levels` levels of a side, or the whole side if levels is None.'''
+        return self.side(side).cumulative_depth(levels)
+
+    def total_depth(self, side):
+        return self.side(side).total
+
+    def size_at(self, side, price):
+        return self.side(side).size_at(price)
+
+    def price_at_depth(self, side, qty):
+        '''First price on a side with more than `qty` contracts at or in front of it.'''
+        return self.side(side).price_at_depth(qty)
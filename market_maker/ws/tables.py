@@ -0,0 +1,297 @@
+from collections import OrderedDict
+from itertools import islice
+from operator import itemgetter
+from market_maker.utils import lazy
+
+np = lazy.module('numpy', globals(), 'np')
+
+
+# Column layouts (NumPy dtypes) for the tables we keep in ring buffers. Columns not listed here are dropped.
+RING_SCHEMAS = {
+    'trade': [
+        ('timestamp', 'M8[ms]'), ('symbol', 'U16'), ('side', 'U4'), ('size', 'i8'), ('price', 'f8'),
+        ('tickDirection', 'U14'), ('trdMatchID', 'U36'), ('grossValue', 'i8'), ('homeNotional', 'f8'),
+        ('foreignNotional', 'f8')
+    ],
+    'quote': [
+        ('timestamp', 'M8[ms]'), ('symbol', 'U16'), ('bidSize', 'i8'), ('bidPrice', 'f8'), ('askPrice', 'f8'),
+        ('askSize', 'i8')
+    ],
+}
+
+
+# Storage for the tables streamed over the websocket.
+#
+# BitMEX tells us on each partial which columns uniquely identify a row (the `keys`). Indexing rows by those
+# columns makes updates and deletes O(1), instead of a scan over the whole table per row. Rows are still kept
+# in insertion order, so readers can keep treating a table like the plain list it used to be.
+#
+# Only the websocket thread writes to a table. Other threads read its `view`: an immutable snapshot the writer
+# publishes after each message (see publish()). Rows are copied on write - an update replaces the row rather
+# than changing it - so a row read from a view, or with get(), never changes under the reader either.
+class KeyedTable(object):
+
+    def __init__(self, keys=None):
+        self.rows = OrderedDict()
+        self.set_keys(keys or [])
+        # Tables without keys (e.g. `trade`) are insert-only; give each row a running number instead.
+        self._seq = 0
+        self.view = TableView(0, (), self._getkey)
+
+    def set_keys(self, keys):
+        '''Set the identifying columns. Sent to us on the partial.'''
+        self.keys = list(keys)
+        self._getkey = itemgetter(*self.keys) if self.keys else None
+
+    def key(self, row):
+        '''Return the index key for a row (or for an update/delete message carrying the key columns).'''
+        if self._getkey is None:
+            self._seq += 1
+            return self._seq
+        return self._getkey(row)
+
+    #
+    # Writes
+    #
+    def insert(self, rows):
+        '''Insert new rows. A row that is already present is replaced.'''
+        for row in rows:
+            self.rows[self.key(row)] = row
+
+    def get(self, *key):
+        '''Return the row with the given key column values, or None.'''
+        return self.rows.get(key[0] if len(key) == 1 else key)
+
+    def find(self, matchData):
+        '''Return the row matching the key columns in `matchData`, or None.'''
+        if self._getkey is None:
+            return None
+        return self.rows.get(self._getkey(matchData))
+
+    def remove(self, matchData):
+        '''Remove and return the row matching the key columns in `matchData`, or None.'''
+        if self._getkey is None:
+            return None
+        return self.rows.pop(self._getkey(matchData), None)
+
+    def trim(self, length):
+        '''Drop the oldest rows until at most `length` remain.'''
+        while len(self.rows) > length:
+            self.rows.popitem(last=False)
+
+    def clear(self):
+        self.rows.clear()
+
+    def publish(self):
+        '''Publish the rows as they are now as the next version of `view`.'''
+        self.view = TableView(self.view.seq + 1, tuple(self.rows.values()), self._getkey)
+
+    #
+    # List-like reads
+    #
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+    __nonzero__ = __bool__  # Python 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.rows.values())[index]
+        if index < 0:
+            index += len(self.rows)
+        if index < 0 or index >= len(self.rows):
+            raise IndexError('table index out of range')
+        return next(islice(iter(self.rows.values()), index, None))
+
+    def __repr__(self):
+        return 'KeyedTable(keys=%r, rows=%r)' % (self.keys, list(self.rows.values()))
+
+
+# A KeyedTable as of one version, numbered by `seq`. Never changes, so any thread may read it without a lock.
+class TableView(object):
+
+    def __init__(self, seq, rows, getkey):
+        self.seq = seq
+        self.rows = rows  # A tuple, in insertion order
+        self._getkey = getkey
+        self._index = None  # Built on the first get()
+
+    def get(self, *key):
+        '''Return the row with the given key column values, or None.'''
+        if self._index is None:
+            self._index = dict((self._getkey(row), row) for row in self.rows) if self._getkey else {}
+        return self._index.get(key[0] if len(key) == 1 else key)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+    __nonzero__ = __bool__  # Python 2
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def __repr__(self):
+        return 'TableView(seq=%d, rows=%r)' % (self.seq, list(self.rows))
+
+
+# A fixed-capacity table of the most recent rows of an insert-only stream (trades, quotes), stored in a
+# preallocated NumPy structured array.
+#
+# Unlike a list that is grown and then sliced in half, memory use is constant and the oldest rows fall off
+# one at a time. Every row is written twice, `capacity` apart, so the latest N rows are always one contiguous
+# slice of the buffer and last() can return a view without copying.
+class RingTable(object):
+
+    def __init__(self, dtype, capacity):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.buffer = np.zeros(2 * capacity, dtype=self.dtype)
+        self.count = 0  # Rows ever inserted
+        self.keys = []
+        self._converters = [(name, _converter(self.dtype.fields[name][0])) for name in self.dtype.names]
+
+    def set_keys(self, keys):
+        '''Stream tables have no identifying columns; nothing to index.'''
+        self.keys = list(keys)
+
+    def insert(self, rows):
+        if not rows:
+            return
+        # Only the last `capacity` rows of a large batch would survive anyway.
+        rows = rows[-self.capacity:]
+        values = np.array([tuple(convert(row.get(name)) for name, convert in self._converters) for row in rows],
+                          dtype=self.dtype)
+        positions = (self.count + np.arange(len(values))) % self.capacity
+        self.buffer[positions] = values
+        self.buffer[positions + self.capacity] = values
+        self.count += len(values)
+
+    def trim(self, length):
+        '''Capacity is fixed; old rows are overwritten in place.'''
+        pass
+
+    def clear(self):
+        self.count = 0
+
+    def last(self, n=None):
+        '''Return the latest `n` rows (all of them if None), oldest first, as a view into the buffer.'''
+        size = len(self)
+        n = size if n is None else max(0, min(n, size))
+        end = self.count % self.capacity + self.capacity
+        return self.buffer[end - n:end]
+
+    #
+    # List-like reads
+    #
+    def __iter__(self):
+        '''Iterate rows as dicts, like the list this table replaced.'''
+        for row in self.last().tolist():
+            yield dict(zip(self.dtype.names, row))
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __bool__(self):
+        return self.count > 0
+    __nonzero__ = __bool__  # Python 2
+
+    def __getitem__(self, index):
+        return self.last()[index]
+
+    def __repr__(self):
+        return 'RingTable(capacity=%d, rows=%r)' % (self.capacity, self.last())
+
+
+# One table per symbol for a stream shared by several instruments, so a busy symbol doesn't push a quiet
+# one's rows out of a fixed-size buffer, and reads for one symbol don't have to filter everyone else's.
+class SymbolTable(object):
+
+    def __init__(self, factory):
+        self.factory = factory  # Creates the table for a newly seen symbol
+        self.tables = {}
+        self.keys = []
+
+    def set_keys(self, keys):
+        self.keys = list(keys)
+        for table in self.tables.values():
+            table.set_keys(keys)
+
+    def table(self, symbol):
+        '''Return the table for one symbol, creating it if needed.'''
+        if symbol not in self.tables:
+            table = self.factory()
+            table.set_keys(self.keys)
+            self.tables[symbol] = table
+        return self.tables[symbol]
+
+    def insert(self, rows):
+        bySymbol = {}
+        for row in rows:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, symbolRows in bySymbol.items():
+            self.table(symbol).insert(symbolRows)
+
+    def find(self, matchData):
+        return self.table(matchData['symbol']).find(matchData)
+
+    def remove(self, matchData):
+        return self.table(matchData['symbol']).remove(matchData)
+
+    def trim(self, length):
+        for table in self.tables.values():
+            table.trim(length)
+
+    def clear(self):
+        for table in self.tables.values():
+            table.clear()
+
+    def last(self, n=None, symbol=None):
+        '''Return the latest `n` rows for `symbol`. With symbol=None, merge all symbols (a copy, not a view).'''
+        if symbol is not None:
+            return self.table(symbol).last(n)
+        if len(self.tables) == 1:
+            return next(iter(self.tables.values())).last(n)
+        rows = [table.last(n) for table in self.tables.values()]
+        rows = np.concatenate(rows) if rows else self.factory().last()
+        rows = rows[np.argsort(rows['timestamp'], kind='mergesort')]
+        return rows if n is None else rows[len(rows) - min(n, len(rows)):]
+
+    #
+    # List-like reads
+    #
+    def __iter__(self):
+        for table in self.tables.values():
+            for row in table:
+                yield row
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def __bool__(self):
+        return any(self.tables.values())
+    __nonzero__ = __bool__  # Python 2
+
+    def __repr__(self):
+        return 'SymbolTable(%r)' % self.tables
+
+
+def _converter(dtype):
+    '''Return a function that maps a JSON value (possibly None) to something `dtype` accepts.'''
+    if dtype.kind == 'M':
+        # Timestamps arrive as ISO 8601 strings in UTC ("2016-01-28T17:29:31.054Z").
+        return lambda v: v.rstrip('Z') if v else 'NaT'
+    if dtype.kind == 'f':
+        return lambda v: np.nan if v is None else v
+    if dtype.kind in 'iu':
+        return lambda v: v or 0
+    return lambda v: v or ''
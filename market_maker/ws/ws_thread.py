@@ -2,12 +2,19 @@ import sys
 import websocket
 import threading
 import traceback
-from time import sleep
+from time import sleep, time
 import json
 import decimal
+import importlib
 import logging
 from market_maker.settings import settings
+from market_maker.utils import codec, log, retry
+from market_maker.utils.metrics import metrics
 from market_maker.auth.APIKeyAuth import generate_nonce, generate_signature
+from market_maker.portfolio import Portfolio
+from market_maker.recorder import Recorder
+from market_maker.ws.orderbook import OrderBook
+from market_maker.ws.tables import KeyedTable, RingTable, SymbolTable, RING_SCHEMAS
 from future.utils import iteritems
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
@@ -22,104 +29,193 @@ with hooks():  # Python 2/3 compat
 # On connect, it synchronously asks for a push of all this data then returns.
 # Right after, the MM can start using its data. It will be updated in realtime, so the MM can
 # poll as often as it wants.
+#
+# If the connection drops, it reconnects in the background (see __run) and rebuilds its tables from the
+# new connection's data images, swapping them in once they're all there. Until then, `connected` is clear
+# and the old tables stay as they were.
+#
+# Only the websocket thread writes to the tables and books. The data methods below read them from other
+# threads through immutable views (KeyedTable.view, OrderBook.snapshot()), so they never lock the writer
+# and never see a half-applied message. seq() says whether anything changed between two reads.
 class BitMEXWebsocket():
 
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
+    # Changes to these tables wake up anyone blocked in wait_for_update().
+    NOTIFY_TABLES = {'quote', 'orderBookL2', 'order', 'position'}
+
+    # Tables other threads read whole, through their views. Publishing a view copies the table's list of
+    # rows, so it's only done for these; the rest are only looked up by key (get_instrument), if at all.
+    VIEW_TABLES = {'order', 'position', 'margin'}
+
+    # Changes to these tables are passed on to our portfolios; see portfolio().
+    PORTFOLIO_TABLES = {'instrument', 'position'}
+
+    # Give up connecting after this long (seconds). Reconnections get this long to send every data image, too.
+    CONNECT_TIMEOUT = 5
+
+    # Ping the server this often (seconds), and treat the connection as dropped if it doesn't answer within
+    # PING_TIMEOUT. Catches connections that died without closing.
+    PING_INTERVAL = 5
+    PING_TIMEOUT = 3
+
     def __init__(self):
         self.logger = logging.getLogger('root')
+        # Decoding is the bulk of our per-message cost; use a fast JSON library if one is installed.
+        self.decoder, self.decode = codec.get_decoder(settings.JSON_DECODER)
+        # Tees raw messages to disk, if RECORD_FILE is set. Only live connections record.
+        self.recorder = None
+        # Metrics recorded for every message; looked up once.
+        self.parseTime = metrics.histogram('ws_parse_seconds')
+        self.messageMetrics = {}  # (table, action) -> (apply time histogram, message counter)
+        self.reconnectPolicy = retry.RetryPolicy(base_delay=settings.WS_RECONNECT_BASE_DELAY,
+                                                 max_delay=settings.WS_RECONNECT_MAX_DELAY,
+                                                 deadline=settings.WS_RECONNECT_DEADLINE)
         self.__reset()
 
     def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True):
-        '''Connect to the websocket and initialize data stores.'''
+        '''Connect to the websocket and initialize data stores.
+           `symbol` can be a list, to stream several instruments over this one connection.'''
 
         self.logger.debug("Connecting WebSocket.")
-        self.symbol = symbol
+        self.symbols = symbol if isinstance(symbol, list) else [symbol]
+        self.symbol = self.symbols[0]
         self.shouldAuth = shouldAuth
+        for symbol in self.symbols:
+            self.updated[symbol] = threading.Event()
+        # The data images (partials) we need before we can start: set as each arrives.
+        images = ['instrument', 'trade', 'quote'] + [('orderBookL2', symbol) for symbol in self.symbols]
+        if self.shouldAuth:
+            images += ['margin', 'position', 'order']
+        self.images = dict((image, threading.Event()) for image in images)
+        if settings.RECORD_FILE and self.recorder is None:
+            self.recorder = Recorder(settings.RECORD_FILE)
 
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade", "orderBook25"]]
+        subscriptions = [sub + ':' + symbol for symbol in self.symbols for sub in ["quote", "trade", "orderBookL2"]]
         subscriptions += ["instrument"]  # We want all of them
         if self.shouldAuth:
-            subscriptions += [sub + ':' + symbol for sub in ["order", "execution"]]
+            subscriptions += [sub + ':' + symbol for symbol in self.symbols for sub in ["order", "execution"]]
             subscriptions += ["margin", "position"]
 
         # Get WS URL and connect.
         urlParts = list(urlparse(endpoint))
         urlParts[0] = urlParts[0].replace('http', 'ws')
         urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
-        wsURL = urlunparse(urlParts)
-        self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL)
+        self.wsURL = urlunparse(urlParts)
+        self.logger.info("Connecting to %s" % self.wsURL)
+        # The first data images need NumPy; import it while we wait on the network.
+        warmup = threading.Thread(target=importlib.import_module, args=('numpy',), name='warmup')
+        warmup.daemon = True
+        warmup.start()
+        self.__connect()
+        metrics.milestone('websocket_open')
         self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
 
         # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
-        if self.shouldAuth:
-            self.__wait_for_account()
+        self.__wait_for_images()
+        self.connected.set()
+        metrics.milestone('data_images')
         self.logger.info('Got all market data. Starting.')
 
     #
     # Data methods
     #
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
+        # The instrument table is indexed by symbol, and derived fields like 'tickLog' are filled in
+        # as rows arrive (see __derive_instrument_fields), so this is a plain lookup. Rows are replaced,
+        # never changed, so one lookup in the live table returns a whole row without copying the table.
+        instrument = self.data['instrument'].get(symbol)
+        if instrument is None:
             raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
         return instrument
 
     def get_ticker(self, symbol):
         '''Return a ticker object. Generated from instrument.'''
 
-        instrument = self.get_instrument(symbol)
-
-        # If this is an index, we have to get the data from the last trade.
-        if instrument['symbol'][0] == '.':
-            ticker = {}
-            ticker['mid'] = ticker['buy'] = ticker['sell'] = ticker['last'] = instrument['markPrice']
-        # Normal instrument
-        else:
-            bid = instrument['bidPrice'] or instrument['lastPrice']
-            ask = instrument['askPrice'] or instrument['lastPrice']
-            ticker = {
-                "last": instrument['lastPrice'],
-                "buy": bid,
-                "sell": ask,
-                "mid": (bid + ask) / 2
-            }
-
-        # The instrument has a tickSize. Use it to round values.
-        return {k: round(float(v or 0), instrument['tickLog']) for k, v in iteritems(ticker)}
+        return ticker_from_instrument(self.get_instrument(symbol))
 
     def funds(self):
-        return self.data['margin'][0]
+        return self.data['margin'].view[0]
 
     def market_depth(self, symbol):
-        # raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
-        return self.data['orderBook25']
-
-    def open_orders(self, clOrdIDPrefix):
-        orders = self.data['order']
+        '''Return a snapshot of the full-depth OrderBook for a symbol.'''
+        book = self.books.get(symbol)
+        if book is None:
+            return OrderBook(symbol)
+        return book.snapshot()
+
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        orders = self.data['order'].view
         # Filter to only open orders (leavesQty > 0) and those that we actually placed
-        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0]
+        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0 and
+                (symbol is None or o['symbol'] == symbol)]
 
     def position(self, symbol):
-        positions = self.data['position']
+        positions = self.data['position'].view if 'position' in self.data else ()
         pos = [p for p in positions if p['symbol'] == symbol]
         if len(pos) == 0:
             # No position found; stub it
             return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
         return pos[0]
 
-    def recent_trades(self):
-        return self.data['trade']
+    def recent_trades(self, count=None, symbol=None):
+        '''Return the latest `count` trades for a symbol as a view into its trade ring buffer.'''
+        return self.data['trade'].last(count, symbol)
+
+    def wait_for_update(self, symbol, timeout=None, debounce=0):
+        '''Block until one of the NOTIFY_TABLES changes for `symbol`, or until `timeout` seconds pass.
+           Once woken, wait another `debounce` seconds so a burst of messages is handled at once.
+           Returns True if woken by an update.'''
+        event = self.updated[symbol]
+        updated = event.wait(timeout)
+        if updated and debounce:
+            sleep(debounce)
+        event.clear()
+        return updated
+
+    def last_update(self, symbol):
+        '''When (Unix time) the latest change to one of the NOTIFY_TABLES for `symbol` was received; None
+           if there hasn't been one.'''
+        return self.received.get(symbol)
+
+    def seq(self, symbol):
+        '''A number that goes up whenever any of our data for `symbol` changes: its rows in any table, its
+           order book, or account-wide rows like margin. Read it before the data: if it's the same next time,
+           nothing has changed since.'''
+        return self.seqs.get(symbol, 0)
+
+    def portfolio(self, symbols):
+        '''The Portfolio of contracts `symbols`, kept up to date as their instrument and position rows change.
+           The first call for a list of contracts builds it from the tables; later ones return the same one.'''
+        symbols = tuple(symbols)
+        portfolio = self.portfolios.get(symbols)
+        if portfolio is None:
+            with self.portfolioLock:
+                portfolio = self.portfolios.get(symbols)
+                if portfolio is None:
+                    portfolio = Portfolio(symbols)
+                    if settings.DELTA_ALERT_THRESHOLD:
+                        portfolio.watch(settings.DELTA_ALERT_THRESHOLD)
+                    self.__load_portfolio(portfolio)
+                    self.portfolios[symbols] = portfolio
+        return portfolio
+
+    def update_portfolios(self, table, rows):
+        '''Pass whole, changed 'instrument' or 'position' rows on to every portfolio.'''
+        with self.portfolioLock:
+            for portfolio in self.portfolios.values():
+                if table == 'instrument':
+                    portfolio.update_instruments(rows)
+                else:
+                    portfolio.update_positions(rows)
+
+    def wait_for_connection(self, timeout=None):
+        '''Block until our data is live: connected, with every data image in. Returns False if it still
+           isn't after `timeout` seconds, say while reconnecting, or if we've given up.'''
+        return self.connected.wait(timeout) and not self.exited
 
     #
     # Lifecycle methods
@@ -131,40 +227,107 @@ class BitMEXWebsocket():
 
     def exit(self):
         self.exited = True
+        self.stopped.set()
+        # Wake up connect(), if it's waiting; it checks why.
+        self.opened.set()
+        for event in self.images.values():
+            event.set()
         self.ws.close()
+        if self.recorder:
+            self.recorder.close()
 
     #
     # Private methods
     #
 
-    def __connect(self, wsURL):
+    def __connect(self):
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         # We can login using email/pass or API key
-                                         header=self.__get_auth())
-
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever())
+        self.ws = self.__new_app()
+        self.wst = threading.Thread(target=self.__run, name='websocket')
         self.wst.daemon = True
         self.wst.start()
         self.logger.info("Started thread")
 
         # Wait for connect before continuing
-        conn_timeout = 5
-        while (not self.ws.sock or not self.ws.sock.connected) and conn_timeout and not self._error:
-            sleep(1)
-            conn_timeout -= 1
-
-        if not conn_timeout or self._error:
+        if not self.opened.wait(BitMEXWebsocket.CONNECT_TIMEOUT) or self.exited:
             self.logger.error("Couldn't connect to WS! Exiting.")
             self.exit()
             sys.exit(1)
 
+    def __new_app(self):
+        return websocket.WebSocketApp(self.wsURL,
+                                      on_message=self.__on_message,
+                                      on_close=self.__on_close,
+                                      on_open=self.__on_open,
+                                      on_error=self.__on_error,
+                                      # We can login using email/pass or API key. Signed afresh for each
+                                      # connection: the nonce must go up.
+                                      header=self.__get_auth())
+
+    def __run(self):
+        '''Run the connection. If it drops once we're up, reconnect with backoff (reconnectPolicy), until
+           the data is live again or its deadline passes. Subscriptions are in the URL, so each new
+           connection resubscribes and sends fresh data images; see __rebuild().'''
+        attempt = 0
+        while True:
+            self.ws.run_forever(ping_interval=BitMEXWebsocket.PING_INTERVAL,
+                                ping_timeout=BitMEXWebsocket.PING_TIMEOUT)
+            if self.exited:
+                return
+            if self.downSince is None and not self.connected.is_set():
+                # We never got going; connect() says so and exits.
+                self.exit()
+                return
+            if self.connected.is_set():
+                self.connected.clear()
+                self.downSince = time()
+                attempt = 0
+                self.logger.warning("Websocket connection lost. Reconnecting; data is stale until then.")
+            elif time() - self.downSince > self.reconnectPolicy.deadline:
+                self.error("Couldn't reconnect to the websocket in %d seconds. Giving up." %
+                           self.reconnectPolicy.deadline)
+                return
+            attempt += 1
+            if self.stopped.wait(self.reconnectPolicy.backoff(attempt)):
+                return
+            self.logger.info("Reconnecting to the websocket (attempt %d)." % attempt)
+            self.__rebuild()
+            self.ws = self.__new_app()
+            # A connection that opens but never sends all its images is as good as dropped.
+            timer = threading.Timer(BitMEXWebsocket.CONNECT_TIMEOUT, self.__abandon, (self.ws,))
+            timer.daemon = True
+            timer.start()
+
+    def __rebuild(self):
+        '''Build tables from scratch out of the next connection's data images, off to the side. Readers
+           keep the old ones until the new ones are complete; see __resync().'''
+        self.building = ({}, {})
+        self.images = dict((image, threading.Event()) for image in self.images)
+
+    def __resync(self):
+        '''Every data image is in: swap the rebuilt tables in, in one go, and wake everyone up so they
+           reconcile against them. Orders that filled or were cancelled meanwhile are simply not in the new
+           order table.'''
+        self.data, self.books = self.building
+        self.building = None
+        down = time() - self.downSince
+        self.downSince = None
+        metrics.inc('ws_reconnects_total')
+        metrics.observe('ws_reconnect_seconds', down)
+        self.__reload_portfolios()
+        self.__changed([None])
+        self.connected.set()
+        self.logger.info("Reconnected to the websocket and rebuilt our data, %.3f s after losing it." % down)
+        self.__notify([None], time())
+
+    def __abandon(self, ws):
+        if ws is self.ws and not self.connected.is_set() and not self.exited:
+            self.logger.warning("No data images within %d seconds of reconnecting. Trying again." %
+                                BitMEXWebsocket.CONNECT_TIMEOUT)
+            ws.close()
+
     def __get_auth(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
 
@@ -188,16 +351,13 @@ class BitMEXWebsocket():
                 "api-key:" + settings.API_KEY
             ]
 
-    def __wait_for_account(self):
+    def __wait_for_images(self):
         '''On subscribe, this data will come down. Wait for it.'''
-        # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order'} <= set(self.data):
-            sleep(0.1)
-
-    def __wait_for_symbol(self, symbol):
-        '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
-            sleep(0.1)
+        for event in self.images.values():
+            event.wait()
+        if self.exited:
+            self.logger.error("Websocket closed before sending all data images! Exiting.")
+            sys.exit(1)
 
     def __send_command(self, command, args=[]):
         '''Send a raw command.'''
@@ -205,15 +365,35 @@ class BitMEXWebsocket():
 
     def __on_message(self, ws, message):
         '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        received = time()
+        if self.recorder:
+            self.recorder.record(message)
+        self.feed(message, received)
+
+    def feed(self, message, received=None):
+        '''Apply one raw message, exactly as it came off the socket at `received` (now, if None). Replays of
+           recordings call this directly. Returns the decoded message.'''
+        if received is None:
+            received = time()
+        # Log the raw frame rather than re-serializing the decoded one. Debug logging below passes
+        # its arguments through so nothing is formatted unless DEBUG is actually enabled.
+        self.logger.debug(message)
+        message = self.decode(message)
+        parsed = time()
+        self.parseTime.record(parsed - received)
 
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
+        # While reconnecting, messages go into the tables being rebuilt.
+        data, books = self.building or (self.data, self.books)
+        if table == 'order' and metrics.pending and action in ('insert', 'update'):
+            # Our orders showing up new or changed complete the requests that changed them.
+            for row in message['data']:
+                metrics.order_acked(row, received)
         try:
             if 'subscribe' in message:
                 if message['success']:
-                    self.logger.debug("Subscribed to %s." % message['subscribe'])
+                    self.logger.debug("Subscribed to %s.", message['subscribe'])
                 else:
                     self.error("Unable to subscribe to %s. Error: \"%s\" Please check and restart." %
                                (message['request']['args'][0], message['error']))
@@ -222,13 +402,21 @@ class BitMEXWebsocket():
                     self.error(message['error'])
                 if message['status'] == 401:
                     self.error("API Key incorrect, please check and restart.")
+            elif table == 'orderBookL2':
+                # The L2 book is too large to keep as rows; apply deltas straight into sorted books.
+                updated = self.__apply_book_delta(books, action, message['data'])
+                self.__changed(updated)
+                self.__notify(updated, received)
+                if action == 'partial':
+                    # A symbol with an empty book has no rows; the filter still says which it was.
+                    for symbol in list(updated) + [message.get('filter', {}).get('symbol')]:
+                        self.__got_image(('orderBookL2', symbol))
             elif action:
+                updated = set()  # Symbols whose rows changed
+                rows = message['data']  # Whole rows inserted or updated
 
-                if table not in self.data:
-                    self.data[table] = []
-
-                if table not in self.keys:
-                    self.keys[table] = []
+                if table not in data:
+                    data[table] = self.__new_table(table)
 
                 # There are four possible actions from the WS:
                 # 'partial' - full table image
@@ -236,70 +424,218 @@ class BitMEXWebsocket():
                 # 'update'  - update row
                 # 'delete'  - delete row
                 if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
+                    self.logger.debug("%s: partial", table)
                     # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
-                    self.keys[table] = message['keys']
+                    # an item. We index the table by them for updates.
+                    data[table].set_keys(message['keys'])
+                    if table == 'instrument':
+                        self.__derive_instrument_fields(message['data'])
+                    data[table].insert(message['data'])
                 elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
+                    self.logger.debug('%s: inserting %s', table, message['data'])
+                    if table == 'instrument':
+                        self.__derive_instrument_fields(message['data'])
+                    data[table].insert(message['data'])
 
                     # Limit the max length of the table to avoid excessive memory usage.
                     # Don't trim orders because we'll lose valuable state if we do.
-                    if table != 'order' and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                    # Ring tables (trade, quote) have a fixed capacity and ignore this.
+                    if table != 'order' and len(data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
+                        data[table].trim(BitMEXWebsocket.MAX_TABLE_LEN // 2)
 
                 elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
+                    self.logger.debug('%s: updating %s', table, message['data'])
                     # Locate the item in the collection and update it.
+                    rows = []
                     for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
+                        item = data[table].find(updateData)
                         if not item:
-                            return  # No item found to update. Could happen before push
+                            continue  # No item found to update. Could happen before push
+                        updated.add(item.get('symbol'))
 
                         # Log executions
                         is_canceled = 'ordStatus' in updateData and updateData['ordStatus'] == 'Canceled'
                         if table == 'order' and 'leavesQty' in updateData and not is_canceled:
-                            instrument = self.get_instrument(item['symbol'])
+                            instrument = data['instrument'].get(item['symbol'])
                             contExecuted = abs(item['leavesQty'] - updateData['leavesQty'])
                             self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
                                              (item['side'], contExecuted, item['symbol'],
                                               instrument['tickLog'], item['price']))
-
-                        item.update(updateData)
+                            log.event('execution', symbol=item['symbol'], orderID=item['orderID'],
+                                      side=item['side'], qty=contExecuted, price=item['price'])
+
+                        # Copy on write: other threads may be holding `item`.
+                        row = dict(item)
+                        row.update(updateData)
+                        if table == 'instrument' and 'tickSize' in updateData:
+                            self.__derive_instrument_fields([row])
                         # Remove cancelled / filled orders
-                        if table == 'order' and item['leavesQty'] <= 0:
-                            self.data[table].remove(item)
+                        if table == 'order' and row['leavesQty'] <= 0:
+                            data[table].remove(row)
+                        else:
+                            data[table].insert([row])
+                        rows.append(row)
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    self.logger.debug('%s: deleting %s', table, message['data'])
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                        data[table].remove(deleteData)
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                if action != 'update':
+                    updated = set(row.get('symbol') for row in message['data'])
+                if table in BitMEXWebsocket.VIEW_TABLES:
+                    data[table].publish()
+                # Always, even with no portfolios yet: one being built under the lock sees this change in
+                # the tables or gets it passed on once it's registered.
+                if table in BitMEXWebsocket.PORTFOLIO_TABLES and not self.building:
+                    if action in ('partial', 'delete'):
+                        self.__reload_portfolios()
+                    else:
+                        self.update_portfolios(table, rows)
+                self.__changed(updated)
+                if action == 'partial':
+                    self.__got_image(table)
+                if table in BitMEXWebsocket.NOTIFY_TABLES:
+                    self.__notify(updated, received)
         except:
             self.logger.error(traceback.format_exc())
+        if action:
+            if (table, action) not in self.messageMetrics:
+                self.messageMetrics[table, action] = (metrics.histogram('ws_apply_seconds', table=table),
+                                                      metrics.counter('ws_messages_total', table=table, action=action))
+            applyTime, messages = self.messageMetrics[table, action]
+            applyTime.record(time() - parsed)
+            messages.inc()
+        return message
+
+    def __derive_instrument_fields(self, instruments):
+        '''Compute fields we derive from an instrument's static data. Done when the row arrives or its
+           tickSize changes, rather than on every lookup.'''
+        for instrument in instruments:
+            if instrument.get('tickSize') is None:
+                continue
+            # Turn the 'tickSize' into 'tickLog' for use in rounding
+            # http://stackoverflow.com/a/6190291/832202
+            instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+
+    def __new_table(self, table):
+        '''Create storage for a table. Streams with a known layout go into fixed-size ring buffers, one per
+           symbol.'''
+        if table in RING_SCHEMAS:
+            capacity = (settings.TABLE_CAPACITY or {}).get(table, BitMEXWebsocket.MAX_TABLE_LEN)
+            return SymbolTable(lambda: RingTable(RING_SCHEMAS[table], capacity))
+        return KeyedTable()
+
+    def __load_portfolio(self, portfolio):
+        '''Fill a portfolio in from the tables.'''
+        instruments = self.data.get('instrument')
+        rows = [instruments.get(symbol) for symbol in portfolio.symbols] if instruments is not None else []
+        portfolio.load([row for row in rows if row is not None],
+                       [self.position(symbol) for symbol in portfolio.symbols])
+
+    def __reload_portfolios(self):
+        '''Rebuild every portfolio from the tables, after a partial or delete replaced rows wholesale.'''
+        with self.portfolioLock:
+            for portfolio in self.portfolios.values():
+                self.__load_portfolio(portfolio)
+
+    def __got_image(self, image):
+        event = self.images.get(image)
+        if event:
+            event.set()
+            if self.building and all(event.is_set() for event in self.images.values()):
+                self.__resync()
+
+    def __changed(self, symbols):
+        '''Bump seq() for these symbols. A row without a symbol (None) changes everyone's.'''
+        if None in symbols:
+            symbols = self.updated
+        for symbol in symbols:
+            self.seqs[symbol] = self.seqs.get(symbol, 0) + 1
+
+    def __notify(self, symbols, received):
+        '''Wake up anyone waiting on updates to these symbols, which came in at `received`. A row without a
+           symbol (None) wakes everyone.'''
+        if None in symbols:
+            symbols = self.updated
+        for symbol in symbols:
+            if symbol in self.updated:
+                self.received[symbol] = received
+                self.updated[symbol].set()
+
+    def __apply_book_delta(self, books, action, rows):
+        '''Apply an orderBookL2 partial/insert/update/delete to the per-symbol `books`.
+           Returns the symbols whose books changed.'''
+        self.logger.debug('orderBookL2: %s %d levels', action, len(rows))
+        bySymbol = {}
+        for row in rows:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, symbolRows in iteritems(bySymbol):
+            if symbol not in books:
+                books[symbol] = OrderBook(symbol)
+            books[symbol].apply(action, symbolRows)
+        return bySymbol
 
     def __on_open(self, ws):
         self.logger.debug("Websocket Opened.")
+        self.opened.set()
 
-    def __on_close(self, ws):
+    def __on_close(self, ws, *args):
+        # websocket-client 0.x passes just the socket; later versions add the close status and reason.
         self.logger.info('Websocket Closed')
-        self.exit()
 
     def __on_error(self, ws, error):
+        # Connection errors close the connection, and __run() reconnects. Errors the server sends us are
+        # handled (as fatal) in feed().
         if not self.exited:
-            self.error(error)
+            self.logger.warning("Websocket error: %s" % error)
 
     def __reset(self):
         self.data = {}
-        self.keys = {}
+        self.books = {}
         self.exited = False
         self._error = None
-
-
+        self.stopped = threading.Event()  # Set by exit(); ends __run()
+        self.opened = threading.Event()
+        self.images = {}  # table, or ('orderBookL2', symbol) -> set once its partial has arrived
+        # Set while our data is live: connected, with all the data images in. Cleared while reconnecting.
+        self.connected = threading.Event()
+        self.downSince = None  # When we lost the connection, while reconnecting
+        self.building = None  # (data, books) being rebuilt from a new connection's data images
+        # One event per symbol, so each quoting loop only wakes for its own instrument.
+        self.updated = {}
+        # When the latest change to each symbol's data was received. See last_update().
+        self.received = {}
+        self.seqs = {}  # symbol -> seq(); see __changed()
+        self.portfolios = {}  # tuple of contracts -> Portfolio; see portfolio()
+        self.portfolioLock = threading.Lock()  # Held while building or updating portfolios
+
+
+def ticker_from_instrument(instrument):
+    '''Return a ticker object generated from an instrument row.'''
+    # If this is an index, we have to get the data from the last trade.
+    if instrument['symbol'][0] == '.':
+        ticker = {}
+        ticker['mid'] = ticker['buy'] = ticker['sell'] = ticker['last'] = instrument['markPrice']
+    # Normal instrument
+    else:
+        bid = instrument['bidPrice'] or instrument['lastPrice']
+        ask = instrument['askPrice'] or instrument['lastPrice']
+        ticker = {
+            "last": instrument['lastPrice'],
+            "buy": bid,
+            "sell": ask,
+            "mid": (bid + ask) / 2
+        }
+
+    # The instrument has a tickSize. Use it to round values.
+    return {k: round(float(v or 0), instrument['tickLog']) for k, v in iteritems(ticker)}
+
+
+# Linear scan for the row matching `keys`. Tables are indexed now (see KeyedTable.find); kept for callers
+# holding plain lists.
 def findItemByKeys(keys, table, matchData):
     for item in table:
         matched = True
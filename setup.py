@@ -15,7 +15,9 @@ setup(name='bitmex-market-maker',
       install_requires=[
           'requests',
           'websocket-client',
-          'future'
+          'future',
+          'futures; python_version < "3"',
+          'numpy'
       ]
       )
 
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import sys
+import time
+
+###
+# bus-benchmark.py
+#
+# Measures the shared-memory market data bus with one writer publishing as fast as it can and a growing
+# number of reader processes, each building the order book and reading the orders of its symbols the
+# way a quoting process does. Reads should scale with the number of processes (up to the number of cores),
+# and the writer's rate shouldn't drop as readers are added.
+#
+# Every published book has all its sizes set to the same value, so a torn read (half old, half new data)
+# is easy to spot; there should be none.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/bus-benchmark.py
+###
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker.bus import MarketDataBus, BusClient  # noqa: E402
+from market_maker.ws.orderbook import OrderBook  # noqa: E402
+
+SYMBOLS = ['SYM%d' % i for i in range(16)]
+LEVELS = 25
+DURATION = 2
+READERS = [1, 2, 4, 8]
+
+
+def make_book(symbol, size):
+    prices = [100.0 - 0.5 * i for i in range(LEVELS)], [100.5 + 0.5 * i for i in range(LEVELS)]
+    return OrderBook.from_depth(symbol, (prices[0], [size] * LEVELS), (prices[1], [size] * LEVELS))
+
+
+def write(bus_name, stop, counter):
+    bus = MarketDataBus(SYMBOLS, LEVELS, name=bus_name)
+    orders = [{'orderID': '%036d' % i, 'side': 'Buy', 'price': 99.0 - i, 'orderQty': 100, 'leavesQty': 100}
+              for i in range(12)]
+    n = 0
+    while not stop.is_set():
+        symbol = SYMBOLS[n % len(SYMBOLS)]
+        n += 1
+        bus.publish(symbol, book=make_book(symbol, n), orders=orders)
+    counter.value = n
+
+
+def read(bus_name, symbols, stop, reads, torn):
+    client = BusClient(MarketDataBus(SYMBOLS, LEVELS, name=bus_name), None, symbols[0])
+    n = bad = 0
+    while not stop.is_set():
+        for symbol in symbols:
+            book = client.market_depth(symbol)
+            if len(set(book.bids.sizes + book.asks.sizes)) > 1:
+                bad += 1
+            n += 1
+    reads.value = n
+    torn.value = bad
+
+
+def run(readers):
+    bus = MarketDataBus(SYMBOLS, LEVELS)
+    for symbol in SYMBOLS:
+        bus.publish(symbol, book=make_book(symbol, 0), orders=[])
+    stop = multiprocessing.Event()
+    written = multiprocessing.Value('q', 0)
+    counters = [(multiprocessing.Value('q', 0), multiprocessing.Value('q', 0)) for _ in range(readers)]
+    processes = [multiprocessing.Process(target=write, args=(bus.name, stop, written))]
+    for i, (reads, torn) in enumerate(counters):
+        processes.append(multiprocessing.Process(target=read, args=(bus.name, SYMBOLS[i::readers], stop, reads, torn)))
+    for p in processes:
+        p.start()
+    time.sleep(DURATION)
+    stop.set()
+    for p in processes:
+        p.join()
+    bus.close()
+    return (written.value / DURATION, sum(r.value for r, _ in counters) / DURATION,
+            sum(t.value for _, t in counters))
+
+
+def main():
+    print("%8s %16s %16s %10s" % ("readers", "writes/s", "reads/s", "torn"))
+    for readers in READERS:
+        writes, reads, torn = run(readers)
+        print("%8d %16.0f %16.0f %10d" % (readers, writes, reads, torn))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+###
+# hot-path-benchmark.py
+#
+# Benchmarks for the quoting hot path, on synthetic fixtures that don't depend on settings.py or the network:
+#
+#   ws.feed          - the websocket message handler, per table and action, raw JSON in
+#   findItemByKeys   - the old linear row lookup, against KeyedTable.find, at growing table sizes
+#   get_snapshot, get_ticker
+#   market_depth snapshot - the consistent copy of the order book a live websocket hands other threads
+#   place_orders     - ladder plus reconcile for 6-200 order pairs, with the book where we left it
+#                      (nothing to do) and after the market moved (amends, creates and cancels)
+#   converge_orders  - reconcile only, after the market moved
+#   calc_delta       - over 1-200 contracts
+#   ws.feed instrument update, portfolio - instrument updates for contracts we hold, which move the delta
+#
+# Each result is the best of several timed runs, in microseconds per operation. Orders go nowhere: the
+# exchange is in dry run, so only our own code is timed. Logging is turned down to WARNING.
+#
+# Save a baseline, make a change, then compare against it. Benchmarks more than --threshold slower than the
+# baseline are flagged, and the script exits with status 1:
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/hot-path-benchmark.py --save baseline.json
+#   python test/hot-path-benchmark.py --compare baseline.json [--filter place_orders]
+###
+
+parser = argparse.ArgumentParser(description='Benchmark the quoting hot path.')
+parser.add_argument('--save', metavar='PATH', help='write the results to PATH as a JSON baseline')
+parser.add_argument('--compare', metavar='PATH', help='compare the results with a baseline saved earlier')
+parser.add_argument('--threshold', type=float, default=0.1,
+                    help='flag benchmarks slower than the baseline by more than this fraction (default: 0.1)')
+parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark; the best one counts')
+args = parser.parse_args()
+del sys.argv[1:]  # market_maker.settings reads a symbol from argv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker import ladder  # noqa: E402
+from market_maker.backtest import ReplayClient, ReplayWebsocket, SimulatedAccount  # noqa: E402
+from market_maker.market_maker import ExchangeInterface, OrderManager, logger  # noqa: E402
+from market_maker.settings import settings_for  # noqa: E402
+from market_maker.ws.tables import KeyedTable  # noqa: E402
+from market_maker.ws.ws_thread import BitMEXWebsocket, findItemByKeys  # noqa: E402
+
+SYMBOL = 'XBTUSD'
+TICK = 0.5
+MID = 10000.0
+BOOK_LEVELS = 500  # Per side
+PAIRS = [6, 25, 50, 100, 200]
+TABLE_SIZES = [10, 100, 1000, 10000]
+CONTRACTS = [1, 10, 50, 200]
+BATCH = 100  # Websocket messages per timed call
+
+# Every setting the benchmarked code reads, so results don't move with settings.py.
+SETTINGS = dict(DRY_RUN=True, DRY_BTC=50, ORDER_PAIRS=6, ORDER_START_SIZE=100, ORDER_STEP_SIZE=100,
+                INTERVAL=0.005, MIN_SPREAD=0.01, MAINTAIN_SPREADS=True, RELIST_INTERVAL=0.01,
+                RANDOM_ORDER_SIZE=False, CHECK_POSITION_LIMITS=False, MIN_CONTRACTS=5000,
+                RATE_LIMIT_LOW_BUDGET=0.2, CONTRACTS=[SYMBOL], API_REST_INTERVAL=0)
+
+# Seconds a timed run must last, at least, to be trusted.
+MIN_TIME = 0.05
+
+
+#
+# Fixtures
+#
+def instrument_row(symbol, quanto=False, price=MID):
+    return {'symbol': symbol, 'state': 'Open', 'tickSize': TICK, 'lotSize': 1,
+            'multiplier': 100 if quanto else -100000000, 'underlyingToSettleMultiplier': -100000000,
+            'isQuanto': quanto, 'isInverse': not quanto, 'lastPrice': price, 'markPrice': price + 0.1,
+            'indicativeSettlePrice': price, 'bidPrice': price - TICK, 'askPrice': price + TICK,
+            'midPrice': price, 'timestamp': '2026-01-01T00:00:00.000Z'}
+
+
+def contract_symbols(count):
+    return ['C%03d' % i for i in range(count)]
+
+
+def level(side, i, size=1000):
+    """The i'th orderBookL2 level from the top of a side. BitMEX derives ids from prices, and so do we."""
+    price = MID - TICK * (i + 1) if side == 'Buy' else MID + TICK * (i + 1)
+    return {'symbol': SYMBOL, 'id': int(1e8 - price / TICK), 'side': side, 'size': size, 'price': price}
+
+
+def order_row(n, side='Buy', leavesQty=100):
+    return {'orderID': '%036d' % n, 'clOrdID': 'mm_bitmex_%d' % n, 'symbol': SYMBOL, 'side': side,
+            'price': MID - 100 - n * TICK if side == 'Buy' else MID + 100 + n * TICK, 'orderQty': 100,
+            'leavesQty': leavesQty, 'cumQty': 100 - leavesQty, 'ordStatus': 'New',
+            'timestamp': '2026-01-01T00:00:00.000Z'}
+
+
+def message(table, action, data, keys=None):
+    m = {'table': table, 'action': action, 'data': data}
+    if keys is not None:
+        m['keys'] = keys
+    return json.dumps(m)
+
+
+def make_websocket():
+    """A websocket holding an image of every table we subscribe to: one quoted instrument with BOOK_LEVELS
+       levels a side, plus max(CONTRACTS) others to compute delta over."""
+    ws = ReplayWebsocket([SYMBOL])
+    instruments = [instrument_row(SYMBOL)] + [instrument_row(symbol, quanto=i % 2 == 1, price=MID + i)
+                                              for i, symbol in enumerate(contract_symbols(max(CONTRACTS)))]
+    for raw in [
+        message('instrument', 'partial', instruments, ['symbol']),
+        message('orderBookL2', 'partial', [level(side, i) for side in ('Buy', 'Sell') for i in range(BOOK_LEVELS)],
+                ['symbol', 'id', 'side']),
+        message('order', 'partial', [order_row(n) for n in range(12)], ['orderID']),
+        message('position', 'partial', [{'account': 1, 'symbol': SYMBOL, 'currency': 'XBt', 'currentQty': 0,
+                                         'avgCostPrice': None, 'avgEntryPrice': None}],
+                ['account', 'symbol', 'currency']),
+        message('margin', 'partial', [{'account': 1, 'currency': 'XBt', 'marginBalance': 5000000000,
+                                       'availableFunds': 5000000000}], ['account', 'currency']),
+        message('execution', 'partial', [], ['execID']),
+        message('trade', 'partial', [], []),
+        message('quote', 'partial', [], []),
+    ]:
+        ws.feed(raw)
+    return ws
+
+
+def ws_messages(rnd):
+    """(name, messages) for each websocket benchmark. Each batch leaves the tables as it found them, so it can
+       be fed again and again."""
+    book_updates = [message('orderBookL2', 'update',
+                            [dict(level(rnd.choice(('Buy', 'Sell')), rnd.randrange(BOOK_LEVELS)),
+                                  size=rnd.randrange(1, 10000)) for _ in range(rnd.randrange(1, 4))])
+                    for _ in range(BATCH)]
+    book_inserts = []  # A new level inside the spread, then gone again
+    for i in range(BATCH // 2):
+        row = dict(level('Buy', -1), size=rnd.randrange(1, 10000))
+        book_inserts.append(message('orderBookL2', 'insert', [row]))
+        book_inserts.append(message('orderBookL2', 'delete', [{k: row[k] for k in ('symbol', 'id', 'side')}]))
+    order_fills = []  # A new order, then filled
+    for i in range(BATCH // 2):
+        order = order_row(100 + i)
+        order_fills.append(message('order', 'insert', [order]))
+        order_fills.append(message('order', 'update', [{'orderID': order['orderID'], 'symbol': SYMBOL,
+                                                        'leavesQty': 0, 'cumQty': 100, 'ordStatus': 'Filled'}]))
+    return [
+        ('orderBookL2 update', book_updates),
+        ('orderBookL2 insert/delete', book_inserts),
+        ('quote insert', [message('quote', 'insert', [
+            {'timestamp': '2026-01-01T00:00:00.000Z', 'symbol': SYMBOL, 'bidSize': rnd.randrange(1, 10000),
+             'bidPrice': MID - TICK, 'askPrice': MID + TICK, 'askSize': rnd.randrange(1, 10000)}])
+            for _ in range(BATCH)]),
+        ('trade insert', [message('trade', 'insert', [
+            {'timestamp': '2026-01-01T00:00:00.000Z', 'symbol': SYMBOL, 'side': rnd.choice(('Buy', 'Sell')),
+             'size': rnd.randrange(1, 5000), 'price': MID, 'tickDirection': 'ZeroPlusTick',
+             'trdMatchID': '00000000-0000-0000-0000-%012d' % n, 'grossValue': 1000000, 'homeNotional': 0.01,
+             'foreignNotional': 100}]) for n in range(BATCH)]),
+        ('instrument update', [message('instrument', 'update', [
+            {'symbol': SYMBOL, 'lastPrice': MID + rnd.randrange(-10, 10) * TICK, 'markPrice': MID + 0.1,
+             'timestamp': '2026-01-01T00:00:00.000Z'}]) for _ in range(BATCH)]),
+        ('order insert/fill', order_fills),
+        ('position update', [message('position', 'update', [
+            {'account': 1, 'symbol': SYMBOL, 'currency': 'XBt', 'currentQty': rnd.randrange(-1000, 1000),
+             'markPrice': MID}]) for _ in range(BATCH)]),
+        ('margin update', [message('margin', 'update', [
+            {'account': 1, 'currency': 'XBt', 'marginBalance': 5000000000 + rnd.randrange(100000)}])
+            for _ in range(BATCH)]),
+        ('execution insert', [message('execution', 'insert', [
+            {'execID': '%036d' % n, 'orderID': '%036d' % n, 'symbol': SYMBOL, 'side': 'Buy', 'lastQty': 100,
+             'lastPx': MID, 'execType': 'Trade', 'ordStatus': 'Filled', 'leavesQty': 0}]) for n in range(BATCH)]),
+    ]
+
+
+def make_order_manager(ws):
+    order_settings = settings_for()
+    order_settings.update(SETTINGS)
+    client = ReplayClient(ws, SimulatedAccount(ws, 5000000000), SYMBOL, 'mm_bitmex_')
+    return OrderManager(order_settings, ExchangeInterface(True, order_settings, client))
+
+
+def live_orders(om, pairs, moved):
+    """Orders we have in the book: the ladder we'd quote now, or the one we quoted before the market moved
+       by twice RELIST_INTERVAL."""
+    shift = 1 + 2 * om.settings.RELIST_INTERVAL if moved else 1
+    buys, sells = ladder.build_ladder(om.start_position_buy * shift, om.start_position_sell * shift, pairs,
+                                      om.settings.INTERVAL, TICK, 1, start_size=om.settings.ORDER_START_SIZE,
+                                      step_size=om.settings.ORDER_STEP_SIZE)
+    orders = []
+    for n, order in enumerate(buys + sells):
+        orders.append(dict(order, orderID='%036d' % n, clOrdID='mm_bitmex_%d' % n, symbol=SYMBOL,
+                           leavesQty=order['orderQty'], cumQty=0))
+    return orders
+
+
+def with_orders(om, snapshot, orders):
+    snapshot.orders = orders
+    snapshot.highest_buy = om.exchange.get_highest_buy(orders)
+    snapshot.lowest_sell = om.exchange.get_lowest_sell(orders)
+    return snapshot
+
+
+#
+# Benchmarks
+#
+def benchmarks():
+    """Yield (name, function, operations per call)."""
+    rnd = random.Random(42)
+    ws = make_websocket()
+
+    for name, messages in ws_messages(rnd):
+        yield 'ws.feed %s' % name, lambda messages=messages: [ws.feed(m) for m in messages], len(messages)
+
+    for size in TABLE_SIZES:
+        rows = [order_row(n) for n in range(size)]
+        table = KeyedTable(['orderID'])
+        table.insert(rows)
+        wanted = rows[size // 2]  # The average linear search
+        yield ('findItemByKeys %d rows' % size,
+               lambda rows=rows, wanted=wanted: findItemByKeys(['orderID'], rows, wanted), 1)
+        yield 'KeyedTable.find %d rows' % size, lambda table=table, wanted=wanted: table.find(wanted), 1
+
+    om = make_order_manager(ws)
+    snapshot = om.exchange.get_snapshot()
+    yield 'get_snapshot', om.exchange.get_snapshot, 1
+    yield 'get_ticker', lambda: om.get_ticker(snapshot), 1
+    # The replay websocket skips the copy; time the live one's.
+    yield 'market_depth snapshot', lambda: BitMEXWebsocket.market_depth(ws, SYMBOL), 1
+
+    for pairs in PAIRS:
+        om.settings.ORDER_PAIRS = pairs
+        om.get_ticker(snapshot)
+        steady = with_orders(om, om.exchange.get_snapshot(), live_orders(om, pairs, moved=False))
+        moved = with_orders(om, om.exchange.get_snapshot(), live_orders(om, pairs, moved=True))
+        buys, sells = ladder.build_ladder(om.start_position_buy, om.start_position_sell, pairs, om.settings.INTERVAL,
+                                          TICK, 1, start_size=om.settings.ORDER_START_SIZE,
+                                          step_size=om.settings.ORDER_STEP_SIZE)
+
+        def place(snapshot, pairs=pairs):
+            om.settings.ORDER_PAIRS = pairs
+            om.place_orders(snapshot)
+        yield 'place_orders %d pairs, unchanged' % pairs, lambda place=place, steady=steady: place(steady), 1
+        yield 'place_orders %d pairs, market moved' % pairs, lambda place=place, moved=moved: place(moved), 1
+        yield ('converge_orders %d pairs, market moved' % pairs,
+               lambda buys=buys, sells=sells, moved=moved: om.converge_orders(buys, sells, moved), 1)
+
+    # A websocket of their own: the portfolios calc_delta keeps up to date would slow the ws.feed benchmarks.
+    ws = make_websocket()
+    om = make_order_manager(ws)
+    for count in CONTRACTS:
+        symbols = contract_symbols(count)
+        for i, symbol in enumerate(symbols):
+            om.exchange.bitmex.account.positions[symbol] = {'symbol': symbol, 'currentQty': (i + 1) * 100}
+
+        def calc_delta(symbols=symbols):
+            om.settings.CONTRACTS = symbols
+            return om.exchange.calc_delta()
+        yield 'calc_delta %d contracts' % count, calc_delta, 1
+
+    ws = make_websocket()
+    symbols = contract_symbols(max(CONTRACTS))
+    account = make_order_manager(ws).exchange.bitmex.account
+    for i, symbol in enumerate(symbols):
+        account.positions[symbol] = {'symbol': symbol, 'currentQty': (i + 1) * 100}
+    ws.portfolio(symbols)
+    updates = [message('instrument', 'update', [
+        {'symbol': rnd.choice(symbols), 'markPrice': MID + rnd.randrange(-10, 10) * TICK,
+         'indicativeSettlePrice': MID + rnd.randrange(-10, 10) * TICK}]) for _ in range(BATCH)]
+    yield ('ws.feed instrument update, portfolio of %d' % len(symbols),
+           lambda: [ws.feed(m) for m in updates], len(updates))
+
+
+def measure(selected):
+    """Microseconds per operation for each (name, function, operations per call): the best of args.repeat
+       runs, each at least MIN_TIME long. Runs take turns across benchmarks, so a burst of noise from the
+       rest of the machine doesn't land on every run of one benchmark."""
+    timed = []
+    for name, fn, ops in selected:
+        timer = timeit.Timer(fn)
+        number = 1
+        while True:
+            elapsed = timer.timeit(number)
+            if elapsed >= MIN_TIME:
+                break
+            number = max(number * 2, int(number * MIN_TIME * 1.2 / max(elapsed, 1e-9)))
+        timed.append((name, timer, number, ops))
+    best = {}
+    for _ in range(args.repeat):
+        for name, timer, number, ops in timed:
+            us = timer.timeit(number) / number / ops * 1e6
+            best[name] = min(best.get(name, us), us)
+    return [(name, best[name]) for name, _, _, _ in timed]
+
+
+def compare(results, baseline):
+    """Print results next to the baseline. Returns the names of benchmarks that got slower."""
+    regressions = []
+    print("%-42s %12s %12s %12s %9s" % ("benchmark", "us/op", "ops/s", "baseline us", "change"))
+    for name, us in results:
+        before = baseline.get(name)
+        if before is None:
+            print("%-42s %12.2f %12.0f %12s %9s" % (name, us, 1e6 / us, '-', 'new'))
+            continue
+        change = us / before - 1
+        flag = ''
+        if change > args.threshold:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif change < -args.threshold:
+            flag = '  faster'
+        print("%-42s %12.2f %12.0f %12.2f %+8.1f%%%s" % (name, us, 1e6 / us, before, change * 100, flag))
+    return regressions
+
+
+def main():
+    logger.setLevel(logging.WARNING)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        print("Baseline: %s, saved %s on %s (Python %s, %s decoder)\n" % (
+            args.compare, saved['meta']['date'], saved['meta']['machine'], saved['meta']['python'],
+            saved['meta']['decoder']))
+
+    results = measure([b for b in benchmarks() if args.filter in b[0]])
+    regressions = compare(results, baseline)
+
+    if args.save:
+        meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime()), 'python': platform.python_version(),
+                'machine': '%s %s' % (platform.node(), platform.machine()),
+                'decoder': ReplayWebsocket([SYMBOL]).decoder}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': dict(results)}, f, indent=2, sort_keys=True)
+        print("\nSaved %d results to %s." % (len(results), args.save))
+
+    if regressions:
+        print("\n%d benchmarks are more than %.0f%% slower than the baseline." %
+              (len(regressions), args.threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import timeit
+
+###
+# ladder-benchmark.py
+#
+# Compares building the order ladder one level at a time (OrderManager.prepare_order, the way
+# place_orders used to) with the vectorized ladder.build_ladder, for growing numbers of order pairs.
+# Also checks that both produce the same orders.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/ladder-benchmark.py
+###
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker import ladder  # noqa: E402
+from market_maker.market_maker import OrderManager  # noqa: E402
+from market_maker.settings import settings  # noqa: E402
+
+PAIRS = [6, 25, 50, 100, 200]
+
+
+def make_order_manager():
+    """An OrderManager with just enough state to price orders. Doesn't connect anywhere."""
+    om = OrderManager.__new__(OrderManager)
+    om.settings = settings
+    om.instrument = {'symbol': 'XBTUSD', 'tickSize': 0.5, 'tickLog': 1}
+    om.start_position_buy = 8000.0
+    om.start_position_sell = 8010.0
+    return om
+
+
+def per_level(om, pairs):
+    buy_orders = []
+    sell_orders = []
+    for i in reversed(range(1, pairs + 1)):
+        buy_orders.append(om.prepare_order(-i))
+        sell_orders.append(om.prepare_order(i))
+    return buy_orders, sell_orders
+
+
+def vectorized(om, pairs):
+    return ladder.build_ladder(om.start_position_buy, om.start_position_sell, pairs, settings.INTERVAL,
+                               om.instrument['tickSize'], om.instrument['tickLog'],
+                               maintain_spreads=settings.MAINTAIN_SPREADS,
+                               start_size=settings.ORDER_START_SIZE, step_size=settings.ORDER_STEP_SIZE)
+
+
+def main():
+    settings.RANDOM_ORDER_SIZE = False
+    om = make_order_manager()
+    print("%6s %16s %16s %9s" % ("pairs", "per-level (us)", "vectorized (us)", "speedup"))
+    for pairs in PAIRS:
+        if per_level(om, pairs) != vectorized(om, pairs):
+            print("Mismatch between per-level and vectorized ladders at %d pairs!" % pairs)
+            sys.exit(1)
+        number = max(10, 20000 // pairs)
+        slow = min(timeit.repeat(lambda: per_level(om, pairs), number=number, repeat=3)) / number * 1e6
+        fast = min(timeit.repeat(lambda: vectorized(om, pairs), number=number, repeat=3)) / number * 1e6
+        print("%6d %16.1f %16.1f %8.1fx" % (pairs, slow, fast, slow / fast))
+
+
+if __name__ == "__main__":
+    main()
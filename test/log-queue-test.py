@@ -0,0 +1,86 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+###
+# log-queue-test.py
+#
+# Checks the console writer in utils/log.py can always be stopped, even when a slow console has filled its
+# bounded queue: flush() must write out what it can, drop (and count) what it must, and return instead of
+# raising queue.Full. OrderManager.restart(), sharding's restart and the atexit flush all depend on it.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/log-queue-test.py
+###
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker.utils import log  # noqa: E402
+
+QUEUE_SIZE = 5
+
+
+class SlowHandler(logging.Handler):
+
+    """Stands in for a console that has stopped reading: holds every record until released."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.released = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.records.append(record.getMessage())
+
+
+def check(name, ok, detail):
+    print("%-48s %s  %s" % (name, "ok  " if ok else "FAIL", detail))
+    return ok
+
+
+def main():
+    if not log.QueueHandler:
+        print("No QueueListener on this Python; records are logged synchronously.")
+        return
+    handler = SlowHandler()
+    log._listener = log._Listener(log.DroppingQueueHandler(log.Queue(QUEUE_SIZE)), handler)
+    log._listener.start()
+    logger = logging.getLogger('log-queue-test')
+    logger.propagate = False
+    logger.addHandler(log._listener.source)
+    # The first record gets the console writer stuck; the rest fill the queue behind it.
+    logger.warning("record 0")
+    time.sleep(0.1)
+    for i in range(1, QUEUE_SIZE * 3):
+        logger.warning("record %d", i)
+    results = []
+    full = log._listener.queue.full()
+    results.append(check("Slow console fills the queue", full, "%d dropped" % log._listener.source.dropped))
+
+    errors = []
+
+    def flush():
+        try:
+            log.flush()
+        except Exception as e:
+            errors.append(e)
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    # Let flush() give up waiting for room, then let the console catch up.
+    time.sleep(log.STOP_TIMEOUT + 0.5)
+    handler.released.set()
+    flusher.join(10)
+    results.append(check("flush() returns on a full queue", not flusher.is_alive() and not errors, errors))
+    results.append(check("Listener thread has stopped", log._listener._thread is None, ""))
+    # The record being written when the console stalled, plus what was queued minus the one dropped for
+    # the stop sentinel.
+    results.append(check("Queued records are written", len(handler.records) == QUEUE_SIZE, handler.records))
+    dropped = log._listener.source.dropped
+    results.append(check("Every dropped record is counted", dropped == QUEUE_SIZE * 2, "%d dropped" % dropped))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
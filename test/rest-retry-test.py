@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+###
+# rest-retry-test.py
+#
+# Runs the REST client's retry logic against a local HTTP stand-in for the BitMEX API that fails on
+# purpose: 503s, 429s with retry-after, responses too slow for the client's timeout, a bulk create that
+# times out and is then rejected as a duplicate, and a port nobody listens on. Checks each call is
+# retried, backed off, recovered and given up on as it should be.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/rest-retry-test.py
+###
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker import bitmex  # noqa: E402
+from market_maker.utils import errors, retry  # noqa: E402
+
+
+class FailingServer(ThreadingMixIn, HTTPServer):
+
+    """Answers each request with the next failure queued for it, or a 200 once none are left.
+
+    Failures are queued with fail(), per path: an int is a status code to return, a float is a number of
+    seconds to stall before answering, and a (status, body) tuple is a response to send as it is.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FailingHandler)
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def fail(self, path, *failures):
+        self.plans['/api/v1/' + path] = list(failures)
+
+    def next_failure(self, path):
+        path = path.split('?')[0]
+        with self.lock:
+            plan = self.plans.get(path)
+            return plan.pop(0) if plan else None
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+
+    def handle_request(self):
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        failure = self.server.next_failure(self.path)
+        if isinstance(failure, float):
+            time.sleep(failure)
+            failure = None
+        if isinstance(failure, tuple):
+            status, body = failure
+        else:
+            status = failure or 200
+            body = {'error': {'message': 'Injected failure', 'name': 'HTTPError'}} if failure else {'ok': True}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if status == 429:
+            self.send_header('retry-after', '1')
+            self.send_header('x-ratelimit-remaining', '0')
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (IOError, OSError):
+            pass  # The client timed out and hung up. That was the point.
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+def make_client(url, **policy):
+    policy.setdefault('base_delay', 0.05)
+    return bitmex.BitMEX(base_url=url, symbol='XBTUSD', connectWS=False, retryPolicy=retry.RetryPolicy(**policy))
+
+
+def check(name, ok, detail):
+    print("%-48s %s  %s" % (name, "ok  " if ok else "FAIL", detail))
+    return ok
+
+
+def main():
+    # The client logs every retry; we only want our own summary.
+    logging.getLogger('root').setLevel(logging.CRITICAL)
+    server = FailingServer()
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:%d/api/v1/' % server.server_address[1]
+    results = []
+
+    client = make_client(url)
+    server.fail('instrument', 503, 503)
+    client._curl_bitmex('instrument')
+    stats = client.retry_stats()
+    results.append(check("503s are retried", stats['retries_by_reason'] == {retry.UNAVAILABLE: 2}, stats))
+
+    client = make_client(url)
+    server.fail('position', 429)
+    start = time.time()
+    client._curl_bitmex('position')
+    waited = time.time() - start
+    results.append(check("429 waits for retry-after", waited >= 1, "waited %.2fs" % waited))
+
+    client = make_client(url)
+    server.fail('order', 0.5)
+    client._curl_bitmex('order', timeout=0.2)
+    stats = client.retry_stats()
+    results.append(check("GET timeouts are retried", stats['retries_by_reason'] == {retry.TIMEOUT: 1}, stats))
+
+    client = make_client(url)
+    server.fail('user/requestWithdrawal', 0.5)
+    try:
+        client._curl_bitmex('user/requestWithdrawal', postdict={'amount': 1}, timeout=0.2, rethrow_errors=True)
+        gave_up = False
+    except errors.RetriesExhaustedError:
+        gave_up = True
+    results.append(check("Non-idempotent POST is not resent", gave_up and client.retry_stats()['requests'] == 1,
+                         client.retry_stats()))
+
+    # The first attempt times out but goes through, so BitMEX rejects the resend as a duplicate and we
+    # look the orders up instead.
+    client = make_client(url)
+    posted = [{'clOrdID': 'mm_bitmex_%d' % i, 'symbol': 'XBTUSD', 'orderQty': 100, 'price': 1000 + i}
+              for i in range(2)]
+    duplicate = (400, {'error': {'message': 'Duplicate clOrdID', 'name': 'ValidationError'}})
+    server.fail('order/bulk', 0.5, duplicate)
+    server.fail('order', (200, [dict(order, orderID=str(i)) for i, order in enumerate(posted)]))
+    orders = client._curl_bitmex('order/bulk', postdict={'orders': posted}, timeout=0.2, rethrow_errors=True)
+    results.append(check("Bulk create resent after timeout recovers",
+                         [o['orderID'] for o in orders] == ['0', '1'], orders))
+
+    client = make_client(url)
+    server.fail('order/bulk', 0.5, duplicate)
+    server.fail('order', (200, [dict(posted[0], orderQty=200)]))
+    try:
+        client._curl_bitmex('order/bulk', postdict={'orders': posted[:1]}, timeout=0.2, rethrow_errors=True)
+        mismatch = False
+    except Exception as e:
+        mismatch = 'did not match' in str(e)
+    results.append(check("Duplicate with other terms is an error", mismatch, "raised" if mismatch else "returned"))
+
+    client = make_client(url, deadline=1, deadlines={('PUT', 'order/bulk'): 0.5})
+    server.fail('order/bulk', *([503] * 100))
+    start = time.time()
+    try:
+        client._curl_bitmex('order/bulk', postdict={'orders': []}, verb='PUT', rethrow_errors=True)
+        gave_up = False
+    except errors.RetriesExhaustedError:
+        gave_up = True
+    took = time.time() - start
+    results.append(check("Per-endpoint deadline is kept", gave_up and took < 1, "gave up after %.2fs" % took))
+
+    client = make_client('http://127.0.0.1:1/api/v1/', max_attempts=4)
+    try:
+        client._curl_bitmex('instrument', rethrow_errors=True)
+        gave_up = False
+    except errors.RetriesExhaustedError:
+        gave_up = True
+    stats = client.retry_stats()
+    results.append(check("Connection errors stop at max_attempts", gave_up and stats['requests'] == 4, stats))
+
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import threading
+import time
+
+###
+# simulator-load-test.py
+#
+# Runs the REST and websocket clients against the local exchange simulator, with background order flow
+# and the given one-way latency, and measures:
+#   - round trip times of bulk creates, bulk amends and cancels of ORDERS orders at a time,
+#     from CLIENTS threads at once, and how many of each get through per second;
+#   - how long after a create is sent its orders show up in the websocket's order table.
+# The simulator's rate limit is set out of the way, so this measures the client and simulator themselves.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/simulator-load-test.py [seconds] [latency]
+###
+
+DURATION = float(sys.argv.pop(1)) if len(sys.argv) > 1 else 5
+LATENCY = float(sys.argv.pop(1)) if len(sys.argv) > 1 else 0.005
+CLIENTS = 4
+ORDERS = 10
+SYMBOL = 'XBTUSD'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker import bitmex  # noqa: E402
+from market_maker.settings import settings  # noqa: E402
+from market_maker.simulator.__main__ import INSTRUMENTS  # noqa: E402
+from market_maker.simulator.flow import run_flows  # noqa: E402
+from market_maker.simulator.server import Simulator  # noqa: E402
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else float('nan')
+
+
+def load(client, stop, timings, acks):
+    prefix = client.orderIDPrefix
+    n = 0
+    while not stop.is_set():
+        # Far from the market, so nothing fills and every order can be amended and cancelled.
+        price = 5000 + (n % 100) * 10
+        n += 1
+        orders = [{'side': 'Buy', 'orderQty': 100, 'price': price - i, 'execInst': 'ParticipateDoNotInitiate'}
+                  for i in range(ORDERS)]
+        start = time.time()
+        created = client.create_bulk_orders(orders)
+        timings['create'].append(time.time() - start)
+
+        # Wait for the websocket to show them.
+        ids = set(o['orderID'] for o in created)
+        while not ids <= set(o['orderID'] for o in client.ws.open_orders(prefix, SYMBOL)):
+            time.sleep(0.0005)
+        acks.append(time.time() - start)
+
+        start = time.time()
+        client.amend_bulk_orders([{'orderID': o['orderID'], 'leavesQty': 50} for o in created])
+        timings['amend'].append(time.time() - start)
+
+        start = time.time()
+        client.cancel([o['orderID'] for o in created])
+        timings['cancel'].append(time.time() - start)
+
+
+def main():
+    simulator = Simulator({SYMBOL: INSTRUMENTS[SYMBOL]}, latency=LATENCY, rateLimit=10 ** 9, ratePeriod=1)
+    run_flows(simulator.engine, [SYMBOL], seed=1)
+    simulator.start()
+
+    settings.API_KEY = 'load-test'  # The websocket client authenticates with the settings' key
+    settings.API_SECRET = 'secret'
+    main_client = bitmex.BitMEX(base_url=simulator.url, symbol=SYMBOL, apiKey=settings.API_KEY,
+                                apiSecret=settings.API_SECRET, orderIDPrefix='load_', poolSize=CLIENTS)
+    clients = [main_client] + [main_client.for_symbol(SYMBOL) for _ in range(CLIENTS - 1)]
+
+    stop = threading.Event()
+    timings = {'create': [], 'amend': [], 'cancel': []}
+    acks = []
+    threads = [threading.Thread(target=load, args=(client, stop, timings, acks)) for client in clients]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print("%d clients, %d orders per request, %.1f ms latency each way, %.0f s\n" %
+          (CLIENTS, ORDERS, LATENCY * 1000, DURATION))
+    print("%-18s %10s %10s %10s %10s" % ("", "requests/s", "p50 ms", "p99 ms", "max ms"))
+    for name, samples in sorted(timings.items()) + [('create to ws ack', acks)]:
+        print("%-18s %10.0f %10.2f %10.2f %10.2f" % (name, len(samples) / DURATION, percentile(samples, 0.5) * 1000,
+                                                     percentile(samples, 0.99) * 1000, max(samples) * 1000))
+    print("\nREST: %s" % main_client.retry_stats())
+    main_client.ws.exit()
+    simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+###
+# ws-decode-benchmark.py
+#
+# Measures how many messages per second BitMEXWebsocket's message handler gets through, before and after
+# the decoding fast path:
+#
+#   before - stdlib json, plus the json.dumps() and %-formatting of message data the handler used to do
+#            on every frame, whatever the log level.
+#   after  - the fastest installed decoder (orjson/ujson/json), debug output skipped at INFO.
+#
+# Run from the repository root, after `python setup.py install` has created settings.py:
+#   python test/ws-decode-benchmark.py [message count]
+###
+
+# market_maker.settings reads a symbol from argv; take our own argument out first.
+COUNT = int(sys.argv.pop(1)) if len(sys.argv) > 1 else 100000
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_maker.ws.ws_thread import BitMEXWebsocket  # noqa: E402
+
+SYMBOL = 'XBTUSD'
+
+
+def make_frames(count):
+    """Build a realistic mix of table partials and updates, as raw JSON strings."""
+    rnd = random.Random(42)
+    frames = [
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+         'data': [{'symbol': SYMBOL, 'tickSize': 0.5, 'lastPrice': 8000.0, 'bidPrice': 7999.5, 'askPrice': 8000.0,
+                   'markPrice': 8000.1, 'state': 'Open'}]},
+        {'table': 'order', 'action': 'partial', 'keys': ['orderID'],
+         'data': [{'orderID': 'o%d' % i, 'clOrdID': 'mm_bitmex_%d' % i, 'symbol': SYMBOL, 'side': 'Buy',
+                   'price': 7990.0 - i, 'orderQty': 100, 'leavesQty': 100} for i in range(12)]},
+        {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+         'data': [{'symbol': SYMBOL, 'id': i, 'side': 'Buy' if i < 500 else 'Sell', 'size': 1000,
+                   'price': 7750.0 + i * 0.5} for i in range(1000)]},
+        {'table': 'trade', 'action': 'partial', 'keys': [], 'data': []},
+        {'table': 'quote', 'action': 'partial', 'keys': [], 'data': []},
+    ]
+    for n in range(count):
+        kind = rnd.random()
+        if kind < 0.6:
+            frames.append({'table': 'orderBookL2', 'action': 'update',
+                           'data': [{'symbol': SYMBOL, 'id': rnd.randrange(1000), 'side': 'Buy',
+                                     'size': rnd.randrange(1, 10000)} for _ in range(rnd.randrange(1, 5))]})
+        elif kind < 0.8:
+            frames.append({'table': 'trade', 'action': 'insert',
+                           'data': [{'timestamp': '2018-01-01T00:00:00.000Z', 'symbol': SYMBOL, 'side': 'Sell',
+                                     'size': rnd.randrange(1, 5000), 'price': 8000.0,
+                                     'tickDirection': 'ZeroMinusTick',
+                                     'trdMatchID': '00000000-0000-0000-0000-%012d' % n, 'grossValue': 1250000,
+                                     'homeNotional': 0.0125, 'foreignNotional': 100}]})
+        elif kind < 0.9:
+            frames.append({'table': 'quote', 'action': 'insert',
+                           'data': [{'timestamp': '2018-01-01T00:00:00.000Z', 'symbol': SYMBOL, 'bidSize': 100,
+                                     'bidPrice': 7999.5, 'askPrice': 8000.0, 'askSize': 200}]})
+        else:
+            frames.append({'table': 'instrument', 'action': 'update',
+                           'data': [{'symbol': SYMBOL, 'lastPrice': 8000.0 + rnd.randrange(-10, 10) * 0.5,
+                                     'markPrice': 8000.1, 'timestamp': '2018-01-01T00:00:00.000Z'}]})
+    return [json.dumps(f) for f in frames]
+
+
+def legacy_decode(raw):
+    """The work the handler used to do per frame before the fast path."""
+    message = json.loads(raw)
+    json.dumps(message)
+    if 'data' in message:
+        '%s: updating %s' % (message.get('table'), message['data'])
+    return message
+
+
+def run(frames, decoder):
+    ws = BitMEXWebsocket()
+    ws.logger = logging.getLogger('benchmark')
+    ws.logger.setLevel(logging.INFO)
+    ws.decode = decoder
+    handle = ws._BitMEXWebsocket__on_message
+    start = time.time()
+    for frame in frames:
+        handle(None, frame)
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    frames = make_frames(COUNT)
+    before = run(frames, legacy_decode)
+    backend = BitMEXWebsocket().decoder
+    after = run(frames, BitMEXWebsocket().decode)
+    print("Messages:           %d" % len(frames))
+    print("Before (json):      %10.0f msg/s" % before)
+    print("After  (%-6s):     %10.0f msg/s" % (backend, after))
+    print("Speedup:            %10.2fx" % (after / before))
+
+
+if __name__ == "__main__":
+    main()